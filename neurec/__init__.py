@@ -3,4 +3,4 @@ __all__ = [
     'neurec'
 ]
 
-from .neurec import setup, run, listModels, listProperties
\ No newline at end of file
+from .neurec import setup, run, listModels, listProperties, loadArtifact
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""Evaluation candidate sets persisted as a single memory-mapped int32 file.
+
+The file is a .npy int32 array laid out as:
+
+    header (8 values): magic, version, num_users, num_items, num_test, num_candidates, num_negatives, 0
+    test offsets (num_users + 1), test items (num_test)
+    candidate offsets (num_users + 1), candidate items (num_candidates)
+
+Items of user u are items[offsets[u]:offsets[u + 1]]. num_negatives is the number
+of negatives sampled per user, rec.evaluate.neg.
+"""
+import os
+import numpy as np
+import scipy.sparse as sp
+
+MAGIC = 0x4e524353 # "NRCS"
+VERSION = 2
+HEADER_SIZE = 8
+
+class CandidateSet(object):
+    """Read-only per-user item lists backed by offsets into one item array."""
+    def __init__(self, offsets, items):
+        self.offsets = offsets
+        self.items = items
+
+    @classmethod
+    def from_dict(cls, candidates, num_users):
+        """Builds a candidate set from a {user: [items]} dictionary.
+
+        candidates -- dictionary of items per user
+        num_users -- number of users
+        """
+        lengths = np.array([len(candidates.get(u, ())) for u in range(num_users)], dtype=np.int32)
+        offsets = np.zeros(num_users + 1, dtype=np.int32)
+        np.cumsum(lengths, out=offsets[1:])
+        items = np.zeros(offsets[-1], dtype=np.int32)
+        for u, user_items in candidates.items():
+            items[offsets[u]:offsets[u + 1]] = user_items
+        return cls(offsets, items)
+
+    @classmethod
+    def from_matrix(cls, matrix):
+        """Builds a candidate set from the rows of a sparse matrix."""
+        csr = matrix.tocsr()
+        csr.sort_indices()
+        return cls(csr.indptr.astype(np.int32), csr.indices.astype(np.int32))
+
+    def to_matrix(self, num_items):
+        """Returns the candidate set as a binary csr_matrix."""
+        data = np.ones(len(self.items), dtype=np.float32)
+        return sp.csr_matrix((data, self.items, self.offsets), shape=(len(self), num_items))
+
+    def __getitem__(self, user):
+        return self.items[self.offsets[user]:self.offsets[user + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+def write_candidate_file(path, num_items, test_matrix, candidates, num_negatives):
+    """Writes the test split and the evaluation candidates to a file.
+
+    path -- path of the file to write
+    num_items -- number of items
+    test_matrix -- sparse matrix of test interactions
+    candidates -- CandidateSet of evaluation candidates per user
+    num_negatives -- number of negatives sampled per user
+    """
+    test = CandidateSet.from_matrix(test_matrix)
+    header = np.array([MAGIC, VERSION, len(test), num_items, len(test.items), len(candidates.items), num_negatives, 0],
+                      dtype=np.int32)
+    data = np.concatenate([header, test.offsets, test.items, candidates.offsets, candidates.items])
+    # write to a temporary file first, so concurrent runs never map a partial file
+    temp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp_path, "wb") as file:
+        np.save(file, data.astype(np.int32))
+    os.replace(temp_path, path)
+
+def read_candidate_file(path, num_users, num_items):
+    """Memory-maps a candidate file and returns the test split, the candidates and the number of negatives per user.
+
+    path -- path of the file to read
+    num_users -- expected number of users
+    num_items -- expected number of items
+    """
+    data = np.load(path, mmap_mode="r")
+    magic, version, file_users, file_items, num_test, num_candidates, num_negatives = data[:7]
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(str(path) + " is not a version " + str(VERSION) + " candidate file.")
+    if file_users != num_users or file_items != num_items:
+        raise ValueError("Candidate file " + str(path) + " has " + str(file_users) + " users and " + str(file_items)
+                         + " items, but the dataset has " + str(num_users) + " users and " + str(num_items) + " items.")
+
+    start = HEADER_SIZE
+    test_offsets = data[start:start + num_users + 1]
+    start += num_users + 1
+    test_items = data[start:start + num_test]
+    start += num_test
+    candidate_offsets = data[start:start + num_users + 1]
+    start += num_users + 1
+    candidate_items = data[start:start + num_candidates]
+    return CandidateSet(test_offsets, test_items), CandidateSet(candidate_offsets, candidate_items), int(num_negatives)
@@ -5,18 +5,25 @@ Processing datasets.
 @author: Xiangnan He (xiangnanhe@gmail.com)
 '''
 import numpy as np
+import scipy.sparse as sp
 from neurec.data.LeaveOneOutDataSplitter import LeaveOneOutDataSplitter
 from neurec.data.HoldOutDataSplitter import HoldOutDataSplitter
 from neurec.data.GivenData import GivenData
+from neurec.data.CandidateSet import CandidateSet, write_candidate_file, read_candidate_file
 from neurec.util.singleton import Singleton
 from importlib import util
+import hashlib
+import logging
 import os
 
 class Dataset(metaclass=Singleton):
 
-    def __init__(self, dataset_path, dataset_name, data_format, splitter,separator,threshold,evaluate_neg,splitterRatio=[0.8,0.2]):
+    def __init__(self, dataset_path, dataset_name, data_format, splitter,separator,threshold,evaluate_neg,splitterRatio=[0.8,0.2],validation=False,candidates_path=None,user_buckets=0,item_buckets=0):
         '''
         Constructor
+
+        user_buckets, item_buckets -- hash the raw user/item ids into this many
+        inner ids instead of numbering them (default 0, numbering)
         '''
         if (dataset_path == 'neurec'):
             neurec_path = util.find_spec('neurec', package='neurec').submodule_search_locations[0]
@@ -35,25 +42,29 @@ class Dataset(metaclass=Singleton):
         self.trainDict =  None
         self.testMatrix =  None
         self.testNegatives =  None
+        self.validMatrix = None
+        self.validNegatives = None
         self.timeMatrix = None
         self.userseq = None
         self.userids = None
         self.itemids = None
+        self._train_csr = None
+        self._fingerprint = None
         if splitter == "loo" :
-            loo = LeaveOneOutDataSplitter(self.path, self.dataset_name, self.data_format,self.separator, self.threshold)
+            loo = LeaveOneOutDataSplitter(self.path, self.dataset_name, self.data_format,self.separator, self.threshold, user_buckets, item_buckets)
             self.trainMatrix,self.trainDict,self.testMatrix,\
             self.userseq,self.userids,self.itemids,self.timeMatrix = loo.load_data_by_user_time()
             self.num_users = self.trainMatrix.shape[0]
             self.num_items = self.trainMatrix.shape[1]
         elif splitter == "ratio" :
-            hold_out = HoldOutDataSplitter(self.path, self.dataset_name,self.data_format, self.separator,self.threshold,self.splitterRatio)
+            hold_out = HoldOutDataSplitter(self.path, self.dataset_name,self.data_format, self.separator,self.threshold,self.splitterRatio, user_buckets, item_buckets)
             self.trainMatrix,self.trainDict,self.testMatrix,\
             self.userseq,self.userids,self.itemids,self.timeMatrix =\
             hold_out.load_data_by_user_time()
             self.num_users = self.trainMatrix.shape[0]
             self.num_items = self.trainMatrix.shape[1]
         elif splitter == "given":
-            given = GivenData(self.path, self.dataset_name,self.separator,self.threshold)
+            given = GivenData(self.path, self.dataset_name,self.separator,self.threshold, user_buckets, item_buckets)
             self.trainMatrix,self.trainDict,self.testMatrix,\
             self.userseq,self.userids,self.itemids,self.timeMatrix =\
             given.load_pre_splitter_data()
@@ -62,7 +73,15 @@ class Dataset(metaclass=Singleton):
         else :
             print("please choose a splitter")
 
-        self.testNegatives = self.get_negatives()
+        if validation:
+            self.validMatrix = self.split_validation()
+            self.validNegatives = self.get_negatives()
+        if candidates_path and self.evaluate_neg > 0 and os.path.exists(candidates_path):
+            self.testNegatives = self.load_candidates(candidates_path)
+        else:
+            self.testNegatives = self.get_negatives()
+            if candidates_path and self.testNegatives is not None:
+                self.save_candidates(candidates_path)
         self.num_users = self.trainMatrix.shape[0]
         self.num_items = self.trainMatrix.shape[1]
 
@@ -74,6 +93,7 @@ class Dataset(metaclass=Singleton):
                 for _ in np.arange(self.evaluate_neg):
                     neg_item_id = np.random.randint(0,self.num_items)
                     while (u,neg_item_id) in self.trainMatrix.keys() or  (u,neg_item_id) in self.testMatrix.keys() \
+                          or (self.validMatrix is not None and (u,neg_item_id) in self.validMatrix.keys()) \
                           or neg_item_id in negative_per_user:
                         neg_item_id = np.random.randint(0, self.num_items)
                     negative_per_user.append(neg_item_id)
@@ -82,3 +102,78 @@ class Dataset(metaclass=Singleton):
             else :
                 negatives=None
         return  negatives
+
+    def get_train_csr(self):
+        """Returns the training interactions as a binary csr_matrix, built on first use.
+
+        Models slice user rows out of it instead of building dense rating rows.
+        """
+        if self._train_csr is None:
+            train_csr = self.trainMatrix.tocsr()
+            train_csr.eliminate_zeros()
+            train_csr.sort_indices()
+            train_csr.data[:] = 1
+            self._train_csr = train_csr
+        return self._train_csr
+
+    def get_item_counts(self):
+        """Returns the number of training interactions of every item as an int array."""
+        return np.bincount(self.get_train_csr().indices, minlength=self.num_items)
+
+    def fingerprint(self):
+        """Returns a hex digest identifying the training interactions.
+
+        Data derived from the training split can be cached on disk under this key.
+        """
+        if self._fingerprint is None:
+            train = self.trainMatrix.tocsr()
+            train.eliminate_zeros()
+            train.sort_indices()
+            digest = hashlib.sha1(np.array(train.shape, dtype=np.int64).tobytes())
+            for array in (train.indptr, train.indices, train.data):
+                digest.update(np.ascontiguousarray(array).tobytes())
+            self._fingerprint = digest.hexdigest()[:16]
+        return self._fingerprint
+
+    def split_validation(self):
+        """Holds out the latest training interaction of every user as a validation set.
+
+        The held out interactions are removed from trainMatrix and trainDict, so models
+        never train on them. Users with less than two training interactions are skipped.
+        """
+        valid_matrix = sp.dok_matrix((self.num_users, self.num_items), dtype=np.float32)
+        for u, items in self.trainDict.items():
+            if len(items) < 2:
+                continue
+            valid_item = items.pop()
+            valid_matrix[u, valid_item] = self.trainMatrix[u, valid_item]
+            self.trainMatrix[u, valid_item] = 0
+        return valid_matrix
+
+    def save_candidates(self, path):
+        """Writes the test split and the sampled test negatives to a candidate file.
+
+        path -- path of the file to write
+        """
+        negatives = CandidateSet.from_dict(self.testNegatives, self.num_users)
+        write_candidate_file(path, self.num_items, self.testMatrix, negatives, self.evaluate_neg)
+        logging.info("saved evaluation candidates to %s" % (path))
+
+    def load_candidates(self, path):
+        """Returns the test negatives of a candidate file, memory-mapped.
+
+        The test split and the number of negatives stored in the file must match
+        this dataset and rec.evaluate.neg, so that every run is scored against the
+        same candidates.
+
+        path -- path of the file to read
+        """
+        test, negatives, num_negatives = read_candidate_file(path, self.num_users, self.num_items)
+        if num_negatives != self.evaluate_neg:
+            raise ValueError("The candidates in " + str(path) + " have " + str(num_negatives) + " negatives per user, but rec.evaluate.neg is "
+                             + str(self.evaluate_neg) + ". Delete the file to sample new candidates.")
+        expected = CandidateSet.from_matrix(self.testMatrix)
+        if not (np.array_equal(test.offsets, expected.offsets) and np.array_equal(test.items, expected.items)):
+            raise ValueError("The test split in " + str(path) + " does not match the dataset. Delete the file to sample new candidates.")
+        logging.info("loaded evaluation candidates from %s" % (path))
+        return negatives
@@ -1,20 +1,26 @@
 import scipy.sparse as sp
 import numpy as np
 from neurec.util import reader
+from neurec.util import hashing
 import logging
 
 class GivenData(object):
-    def __init__(self, path, dataset_name, separator,threshold):
+    def __init__(self, path, dataset_name, separator,threshold,user_buckets=0,item_buckets=0):
         self.path =path
         self.dataset_name = dataset_name
         self.separator = separator
         self.threshold = threshold
+        self.user_buckets = user_buckets
+        self.item_buckets = item_buckets
         global num_items,num_users,userids,itemids,idusers,iditems
 
     def load_pre_splitter_data(self):
-        pos_per_user={}
-        num_items,num_users = 0,0
-        userids,itemids,idusers,iditems = {},{},{},{}
+        # {raw id, inner id} maps, or hashed ids (see neurec.util.hashing)
+        userids = hashing.get_id_map(self.user_buckets, "user")
+        itemids = hashing.get_id_map(self.item_buckets, "item")
+        idusers,iditems = {},{}
+        num_items,num_users = len(itemids),len(userids)
+        pos_per_user = {u: [] for u in range(num_users)}
         # Get number of users and items
 
         data = reader.lines(self.path + '/' + self.dataset_name)
@@ -99,6 +105,7 @@ class GivenData(object):
                 time_matrix[user, item] = time
                 line = f.readline()
         logging.info("already load the trainMatrix...")
+        hashing.log_stats(logging.getLogger(__name__), userids, itemids)
 
         test_matrix = sp.dok_matrix((num_users, num_items), dtype=np.float32)
         with open(self.path+".test.rating", "r") as f:
@@ -3,28 +3,32 @@ import numpy as np
 import math
 from copy import deepcopy
 from neurec.util import reader
+from neurec.util import hashing
 import logging
 
 class HoldOutDataSplitter(object):
-    def __init__(self, path, dataset_name, data_format,separator,threshold,splitterRatio=[0.8,0.2]):
+    def __init__(self, path, dataset_name, data_format,separator,threshold,splitterRatio=[0.8,0.2],user_buckets=0,item_buckets=0):
         self.path =path
         self.dataset_name = dataset_name
         self.separator = separator
         self.data_format = data_format
         self.splitterRatio = splitterRatio
         self.threshold = threshold
+        self.user_buckets = user_buckets
+        self.item_buckets = item_buckets
         self.logger = logging.getLogger("neurec.data.HoldOutDataSplitter.HoldOutDataSplitter")
         if float(splitterRatio[0])+ float(splitterRatio[1]) != 1.0:
             raise ValueError("please given a correct splitterRatio")
     def load_data_by_user_time(self):
         logging.info("Loading interaction records from %s "%(self.path))
-        pos_per_user={}
         num_ratings=0
-        num_items=0
-        num_users=0
-        #user/item {raw id, inner id} map
-        userids = {}
-        itemids = {}
+        #user/item {raw id, inner id} map, or hashed ids (see neurec.util.hashing)
+        userids = hashing.get_id_map(self.user_buckets, "user")
+        itemids = hashing.get_id_map(self.item_buckets, "item")
+        # all the hashed ids exist from the start
+        num_items=len(itemids)
+        num_users=len(userids)
+        pos_per_user = {u: [] for u in range(num_users)}
         # inverse views of userIds, itemIds,
         idusers = {}
         iditems={}
@@ -69,6 +73,7 @@ class HoldOutDataSplitter(object):
             for u in range(num_users):
                 pos_per_user[u]=sorted(pos_per_user[u], key=lambda d: d[2])
         self.logger.info("\"num_users\": %d,\"num_items\":%d, \"num_ratings\":%d"%(num_users,num_items,num_ratings))
+        hashing.log_stats(self.logger, userids, itemids)
         userseq = deepcopy(pos_per_user)
         train_dict = {}
         train_matrix = sp.dok_matrix((num_users, num_items), dtype=np.float32)
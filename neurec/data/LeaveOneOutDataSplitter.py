@@ -2,25 +2,29 @@ import scipy.sparse as sp
 import numpy as np
 from copy import deepcopy
 from neurec.util import reader
+from neurec.util import hashing
 import logging
 
 class LeaveOneOutDataSplitter(object):
-    def __init__(self, path, dataset_name, data_format, separator, threshold):
+    def __init__(self, path, dataset_name, data_format, separator, threshold, user_buckets=0, item_buckets=0):
         self.path =path
         self.dataset_name = dataset_name
         self.data_format = data_format
         self.separator = separator
         self.threshold = threshold
+        self.user_buckets = user_buckets
+        self.item_buckets = item_buckets
         self.logger = logging.getLogger("neurec.data.LeaveOneOutDataSplitter.LeaveOneOutDataSplitter")
     def load_data_by_user_time(self):
         self.logger.info("Loading interaction records from %s "%(self.path))
-        pos_per_user = {}
         num_ratings=0
-        num_items=0
-        num_users=0
-        #user/item {raw id, inner id} map
-        userids = {}
-        itemids = {}
+        #user/item {raw id, inner id} map, or hashed ids (see neurec.util.hashing)
+        userids = hashing.get_id_map(self.user_buckets, "user")
+        itemids = hashing.get_id_map(self.item_buckets, "item")
+        # all the hashed ids exist from the start
+        num_items=len(itemids)
+        num_users=len(userids)
+        pos_per_user = {u: [] for u in range(num_users)}
         # inverse views of userIds, itemIds,
         idusers = {}
         iditems={}
@@ -66,6 +70,7 @@ class LeaveOneOutDataSplitter(object):
             for u in np.arange(num_users):
                 pos_per_user[u]=sorted(pos_per_user[u], key=lambda d: d[2])
         self.logger.info("\"num_users\": %d,\"num_items\":%d, \"num_ratings\":%d\n"%(num_users,num_items,num_ratings))
+        hashing.log_stats(self.logger, userids, itemids)
         userseq = deepcopy(pos_per_user)
         train_dict = {}
         time_matrix = sp.dok_matrix((num_users, num_items), dtype=np.float32)
@@ -74,6 +79,8 @@ class LeaveOneOutDataSplitter(object):
         for u in np.arange(num_users):
             if len(pos_per_user[u])<2:
                 test_item=-1
+                # users without a test item, such as empty hash buckets, have no training items either
+                train_dict[u]=[]
                 continue
             test_item=pos_per_user[u][-1]
             pos_per_user[u].pop()
@@ -98,6 +105,7 @@ class LeaveOneOutDataSplitter(object):
             for u in np.arange(num_users):
                 if len(pos_per_user[u])<3:
                     test_item=-1
+                    train_dict[u]=[]
                     continue
 
                 test_item=pos_per_user[u][-1]
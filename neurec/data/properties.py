@@ -9,8 +9,29 @@ types = {
     "data.convert.binarize.threshold": float,
     "recommender": str,
     "rec.evaluate.neg": int,
+    "data.validation": to_bool,
+    "rec.earlystop.metric": str,
+    "rec.earlystop.patience": int,
+    "rec.earlystop.restore": to_bool,
+    "rec.evaluate.async": to_bool,
+    "rec.evaluate.candidates": str,
+    "data.cache.path": str,
+    "data.hash.users": int,
+    "data.hash.items": int,
     "data.splitterratio": to_list,
     "rec.number.thread": int,
+    "rec.train.workers": int,
+    "rec.export.path": str,
+    "hogwild_workers": int,
+    "embedding_partitioner": str,
+    "embedding_partitions": int,
+    "embedding_min_slice_bytes": int,
+    "embedding_hash_rows": int,
+    "embedding_hash_functions": int,
+    "embedding_compression": str,
+    "embedding_tail_count": int,
+    "embedding_tail_size": int,
+    "embedding_shared_rows": int,
     "topk": int,
     "epochs": int,
     "batch_size": int,
@@ -60,6 +81,7 @@ types = {
     "weight_size": int,
     "regw": to_list,
     "alpha": float,
+    "cg_steps": int,
     "beta": float,
     "activation": str,
     "algorithm": int,
@@ -86,9 +108,11 @@ types = {
     "layer_size": to_list,
     "node_dropout_flag": to_bool,
     "adj_type": str,
+    "fold_memory": int,
     "alg_type": str,
     "socialpath": str,
     "num_epochs": int,
     "num_layers": int,
+    "num_eigen": int,
     "dropout": float
 }
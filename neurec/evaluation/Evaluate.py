@@ -12,23 +12,35 @@ from neurec.evaluation.leaveoneout.LeaveOneOutEvaluate import evaluate_by_loo
 from neurec.evaluation.foldout.FoldOutEvaluate import evaluate_by_foldout
 import logging
 def test_model(model,dataset,num_thread=10):
+    """Evaluates the model on the test set and returns a dictionary of metrics."""
+    return evaluate_model(model, dataset, dataset.testMatrix, dataset.testNegatives, num_thread, "Test")
+
+def validate_model(model,dataset,num_thread=10):
+    """Evaluates the model on the validation set and returns a dictionary of metrics."""
+    return evaluate_model(model, dataset, dataset.validMatrix, dataset.validNegatives, num_thread, "Valid")
+
+def evaluate_model(model,dataset,evaluateMatrix,evaluateNegatives,num_thread=10,tag="Test"):
     eval_begin = time()
-    model_name=str(model.__class__).split(sep=".")[-1].replace("\'>","")
+    model_name=getattr(model, "model_name", None) or str(model.__class__).split(sep=".")[-1].replace("\'>","")
     if dataset.splitter == "loo":
-        (hits, ndcgs,aucs) = evaluate_by_loo(model,dataset.testMatrix,dataset.testNegatives,num_thread)
+        (hits, ndcgs,aucs) = evaluate_by_loo(model,evaluateMatrix,evaluateNegatives,num_thread)
         hr = np.array(hits).mean()
         ndcg = np.array(ndcgs).mean()
         auc = np.array(aucs).mean()
+        eval_time = time() - eval_begin
         logging.info(
-            "[model=%s]: [Test HR = %.6f, NDCG = %.6f,AUC = %.6f] [Time=%.1fs]" % (model_name,
-            hr, ndcg,auc, time() - eval_begin))
+            "[model=%s]: [%s HR = %.6f, NDCG = %.6f,AUC = %.6f] [Time=%.1fs, %.1f users/sec]" % (model_name, tag,
+            hr, ndcg,auc, eval_time, len(hits)/eval_time))
+        return {"hr": hr, "ndcg": ndcg, "auc": auc}
 
     else:
-        (pres,recs,maps,ndcgs,mrrs) = evaluate_by_foldout(model,dataset.testMatrix,dataset.testNegatives,num_thread)
+        (pres,recs,maps,ndcgs,mrrs) = evaluate_by_foldout(model,evaluateMatrix,evaluateNegatives,num_thread)
         Precision = np.array(pres).mean()
         Recall = np.array(recs).mean()
         MAP = np.array(maps).mean()
         NDCG = np.array(ndcgs).mean()
         MRR = np.array(mrrs).mean()
-        logging.info("[model=%s][%.1fs]: [Test Precision = %.6f, Recall= %.6f, MAP= %.6f, NDCG= %.6f, MRR= %.6f][topk=%.4s]"
-               %(model_name,time() - eval_begin, Precision, Recall,MAP,NDCG,MRR,model.topK))
+        eval_time = time() - eval_begin
+        logging.info("[model=%s][%.1fs, %.1f users/sec]: [%s Precision = %.6f, Recall= %.6f, MAP= %.6f, NDCG= %.6f, MRR= %.6f][topk=%.4s]"
+               %(model_name,eval_time, len(pres)/eval_time, tag, Precision, Recall,MAP,NDCG,MRR,model.topK))
+        return {"precision": Precision, "recall": Recall, "map": MAP, "ndcg": NDCG, "mrr": MRR}
@@ -29,7 +29,7 @@ def evaluate_by_foldout(model,evaluateMatrix,evaluateNegatives,num_thread):
     _K = _model.topK
     Pres, Recs,MAPs,NDCGs,MRRs = [],[],[],[],[]
     for u in range(_model.num_users):
-        items_test = _testMatrix[u].indices
+        items_test = _evaluateMatrix[u].indices
         if len(items_test) >0:
             _evaluateusers.append(u)
     if(num_thread > 1): # Multi-thread
@@ -60,7 +60,7 @@ def eval_by_foldout_user(u):
     target_items= _evaluateMatrix[u].indices
     eval_items =[]
     if _evaluateNegatives != None:
-        eval_items = _evaluateNegatives[u]
+        eval_items = list(_evaluateNegatives[u])
     else :
         all_items = set(np.arange(_model.num_items))
         eval_items = list(all_items - set(_trainMatrix[u].indices))
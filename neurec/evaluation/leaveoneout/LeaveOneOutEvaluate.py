@@ -31,9 +31,6 @@ def evaluate_by_loo(model,evaluateMatrix,evaluateNegatives,num_thread):
         with ThreadPoolExecutor() as executor:
             res = executor.map(eval_by_loo_user, _evaluateusers)
         res = list(res)
-        with ThreadPoolExecutor() as executor:
-            res = executor.map(eval_by_loo_user, range(_evaluateMatrix.shape[0]))
-        res = list(res)
         hits = [r[0] for r in res]
         ndcgs = [r[1] for r in res]
         aucs = [r[2] for r in res]
@@ -53,7 +50,7 @@ def eval_by_loo_user(u):
     target_item = _evaluateMatrix[u].indices[0]
     eval_items =[]
     if _evaluateNegatives != None:
-        eval_items = _evaluateNegatives[u]
+        eval_items = list(_evaluateNegatives[u])
     else :
         all_items = set(np.arange(_model.num_items))
         eval_items = list(all_items - set(_trainMatrix[u].indices))
@@ -1,10 +1,16 @@
 from abc import ABC, abstractmethod
 from neurec.data.Dataset import Dataset
 from neurec.util.properties import Properties
+from neurec.util.controller import TrainingController
 import logging
+import threading
+import numpy as np
 
 class AbstractRecommender(ABC):
     """Abstract class for building a Recommender class."""
+    # True for models that can be trained by several workers (see neurec.util.parallel)
+    data_parallel = False
+
     @property
     @abstractmethod
     def properties(self):
@@ -16,6 +22,9 @@ class AbstractRecommender(ABC):
         self.conf = Properties().getProperties(self.properties)
         self.dataset = Dataset()
         self.sess = sess
+        self.controller = TrainingController.from_properties(self)
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
 
         self.logger.info("Arguments: %s " %(self.conf))
 
@@ -30,3 +39,43 @@ class AbstractRecommender(ABC):
     @abstractmethod
     def predict(self):
         pass
+
+    def make_step(self, fetches, feeds):
+        """Returns a function running fetches, precompiled with Session.make_callable.
+
+        The function takes the values of feeds as positional arguments and skips the
+        feed_dict and fetch processing of Session.run, which dominates the cost of
+        small steps. Models declare their train and score steps once in build_graph.
+
+        fetches -- tensor, operation, or a list or tuple of them, as for Session.run
+        feeds -- list of dense placeholders
+        """
+        step = self.sess.make_callable(fetches, feed_list=feeds)
+        dtypes = [feed.dtype.as_numpy_dtype for feed in feeds]
+
+        def run(*values):
+            return step(*[np.asarray(value, dtype=dtype) for value, dtype in zip(values, dtypes)])
+        return run
+
+    def snapshot(self):
+        """Returns a copy of the learned factors that can be scored without the session.
+
+        Models that support asynchronous evaluation return an EmbeddingSnapshot;
+        the default None makes the model evaluate synchronously.
+        """
+        return None
+
+    def cached_snapshot(self):
+        """Returns a snapshot of the current weights, taken once until it is invalidated.
+
+        Lets predict() serve every user of an evaluation from one copy of the
+        factors instead of fetching them from the session on each call.
+        """
+        with self._snapshot_lock:
+            if self._snapshot is None:
+                self._snapshot = self.snapshot()
+            return self._snapshot
+
+    def invalidate_snapshot(self):
+        """Drops the cached snapshot; call after any step that changes the weights."""
+        self._snapshot = None
@@ -0,0 +1,80 @@
+from abc import abstractmethod
+from neurec.model.AbstractRecommender import AbstractRecommender
+import numpy as np
+import tensorflow as tf
+
+class AbstractSeqRecommender(AbstractRecommender):
+    """Abstract class for sequential recommenders scored in two phases.
+
+    A query state is computed once per user from the user factor and the
+    user's recent items, then all candidate items are scored against it with a
+    single kernel. Subclasses build these tensors in _create_state_inference:
+
+    state_users -- placeholder of user ids
+    state_recents -- placeholder of the recent items of each user, shape (users, high_order)
+    state_weights -- placeholder of the weights of the recent items, 0 for padding, shape (users, high_order)
+    user_state -- query state of each user, shape (users, d)
+    state_input -- placeholder fed with query states, shape (states, d)
+    state_items -- placeholder of the items to score
+    state_scores -- scores of state_items for each state, shape (states, items)
+
+    The placeholders are created by _create_state_placeholders, and build_graph
+    calls _create_steps once these tensors exist.
+    """
+    high_order = 1
+
+    @abstractmethod
+    def _create_state_inference(self):
+        pass
+
+    def _create_state_placeholders(self):
+        self.state_users = tf.placeholder(tf.int32, shape = [None,], name = "state_users")
+        self.state_recents = tf.placeholder(tf.int32, shape = [None,None], name = "state_recents")
+        self.state_weights = tf.placeholder(tf.float32, shape = [None,None], name = "state_weights")
+
+    def _create_steps(self):
+        self.state_step = self.make_step(self.user_state, [self.state_users, self.state_recents, self.state_weights])
+        self.score_step = self.make_step(self.state_scores, [self.state_input, self.state_items])
+
+    def get_recent_items(self, user_ids):
+        """Returns the last high_order training items of each user and their weights, both of shape (users, high_order).
+
+        The items of users with a shorter history are left-padded with their first
+        item, or item 0 when they have none, and the padding has weight 0.
+        """
+        item_recents = np.zeros((len(user_ids), self.high_order), dtype=np.int32)
+        recent_weights = np.zeros((len(user_ids), self.high_order), dtype=np.float32)
+        for row, u in enumerate(user_ids):
+            items = self.dataset.trainDict[u][-self.high_order:]
+            if len(items) > 0:
+                item_recents[row] = items[0]
+                item_recents[row, self.high_order - len(items):] = items
+                recent_weights[row, self.high_order - len(items):] = 1
+        return item_recents, recent_weights
+
+    def get_user_states(self, user_ids, item_recents=None, recent_weights=None):
+        """Returns the query states of users.
+
+        user_ids -- ids of the users
+        item_recents -- recent items of each user, shape (users, high_order)
+                        (default, the last items of their training history)
+        recent_weights -- weights of item_recents, 0 for padding (default, all 1 when item_recents is given)
+        """
+        if item_recents is None:
+            item_recents, recent_weights = self.get_recent_items(user_ids)
+        elif recent_weights is None:
+            recent_weights = np.ones(np.shape(item_recents), dtype=np.float32)
+        return self.state_step(user_ids, item_recents, recent_weights)
+
+    def score_states(self, states, items=None):
+        """Returns the scores of items for query states, shape (states, items).
+
+        states -- query states returned by get_user_states
+        items -- items to score (default, all items)
+        """
+        if items is None:
+            items = np.arange(self.num_items, dtype=np.int32)
+        return self.score_step(states, items)
+
+    def predict(self, user_id, items):
+        return self.score_states(self.get_user_states([user_id]), items)[0]
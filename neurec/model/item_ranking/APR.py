@@ -8,13 +8,15 @@ import os
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import learner,data_gen
+from neurec.util import learner,data_gen,embedding
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 class APR(AbstractRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -57,15 +59,15 @@ class APR(AbstractRecommender):
             self.user_input = tf.placeholder(tf.int32, shape=[None,], name="user_input")
             self.item_input_pos = tf.placeholder(tf.int32, shape=[None,], name="item_input_pos")
             self.item_input_neg = tf.placeholder(tf.int32, shape=[None,], name="item_input_neg")
+            # 1 from adv_epoch on, switching the training loss from L(Theta) to opt_loss
+            self.adversarial = tf.placeholder_with_default(0.0, shape=[], name="adversarial")
 
     def _create_variables(self):
         with tf.name_scope("embedding"):
-            self.embedding_P = tf.Variable(
-                tf.truncated_normal(shape=[self.num_users, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embedding_P', dtype=tf.float32)  # (users, embedding_size)
-            self.embedding_Q = tf.Variable(
-                tf.truncated_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embedding_Q', dtype=tf.float32)  # (items, embedding_size)
+            initializer = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
+            self.embedding_P = embedding.embedding_table('embedding_P', [self.num_users, self.embedding_size], initializer)  # (users, embedding_size)
+            self.embedding_Q = embedding.embedding_table('embedding_Q', [self.num_items, self.embedding_size], initializer,
+                                                         counts=self.dataset.get_item_counts())  # (items, embedding_size)
 
             self.delta_P = tf.Variable(tf.zeros(shape=[self.num_users, self.embedding_size]),
                                        name='delta_P', dtype=tf.float32, trainable=False)  # (users, embedding_size)
@@ -75,15 +77,15 @@ class APR(AbstractRecommender):
     def _create_inference(self, item_input):
         with tf.name_scope("inference"):
             # embedding look up
-            self.embedding_p = tf.nn.embedding_lookup(self.embedding_P, self.user_input)
-            self.embedding_q = tf.nn.embedding_lookup(self.embedding_Q, item_input)  # (b, embedding_size)
+            self.embedding_p = embedding.lookup(self.embedding_P, self.user_input)
+            self.embedding_q = embedding.lookup(self.embedding_Q, item_input)  # (b, embedding_size)
             return tf.reduce_sum(self.embedding_p * self.embedding_q,1) # (b, embedding_size) * (embedding_size, 1)
 
     def _create_inference_adv(self, item_input):
         with tf.name_scope("inference_adv"):
             # embedding look up
-            self.embedding_p = tf.nn.embedding_lookup(self.embedding_P, self.user_input)
-            self.embedding_q = tf.nn.embedding_lookup(self.embedding_Q, item_input)  # (b, embedding_size)
+            self.embedding_p = embedding.lookup(self.embedding_P, self.user_input)
+            self.embedding_q = embedding.lookup(self.embedding_Q, item_input)  # (b, embedding_size)
             # add adversarial noise
             self.P_plus_delta = self.embedding_p + tf.nn.embedding_lookup(self.delta_P, self.user_input)
             self.Q_plus_delta = self.embedding_q + tf.nn.embedding_lookup(self.delta_Q, item_input)
@@ -98,9 +100,10 @@ class APR(AbstractRecommender):
             # self.loss = tf.reduce_sum(tf.log(1 + tf.exp(-self.result))) # this is numerically unstable
             self.loss = tf.reduce_sum(tf.nn.softplus(-self.result))
 
-            # loss to be omptimized
-            self.opt_loss = self.loss + self.reg * (
-                        tf.reduce_sum(tf.square(self.embedding_P)) + tf.reduce_sum(tf.square(self.embedding_Q)))
+            # loss to be omptimized, regularizing the rows of the batch only
+            batch_P = embedding.lookup(self.embedding_P, self.user_input)
+            batch_Q = embedding.lookup(self.embedding_Q, tf.concat([self.item_input_pos, self.item_input_neg], 0))
+            adversarial_terms = self.reg * (tf.reduce_sum(tf.square(batch_P)) + tf.reduce_sum(tf.square(batch_Q)))
 
             if self.adver:
                 # loss for L(Theta + adv_Delta)
@@ -109,38 +112,47 @@ class APR(AbstractRecommender):
                 self.result_adv = self.output_adv - self.output_neg_adv
                 # self.loss_adv = tf.reduce_sum(tf.log(1 + tf.exp(-self.result_adv)))
                 self.loss_adv = tf.reduce_sum(tf.nn.softplus(-self.result_adv))
-                self.opt_loss += self.reg_adv * self.loss_adv
+                adversarial_terms += self.reg_adv * self.loss_adv
+            self.opt_loss = self.loss + adversarial_terms
+            # a single optimizer trains both phases, so its slots carry over at adv_epoch
+            self.train_loss = self.loss + self.adversarial * adversarial_terms
 
 
     def _create_adversarial(self):
+        # The perturbations are computed for the users and items of the batch only and
+        # written into delta_P and delta_Q with scatter updates. The adversarial loss of
+        # a batch reads no other rows, so a step does not depend on the catalog size.
         with tf.name_scope("adversarial"):
             # generate the adversarial weights by random method
             if self.adv == "random":
                 # generation
-                self.adv_P = tf.truncated_normal(shape=[self.num_users, self.embedding_size], mean=0.0, stddev=0.01)
-                self.adv_Q = tf.truncated_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01)
-
-                # normalization and multiply epsilon
-                self.update_P = self.delta_P.assign(tf.nn.l2_normalize(self.adv_P, 1) * self.eps)
-                self.update_Q = self.delta_Q.assign(tf.nn.l2_normalize(self.adv_Q, 1) * self.eps)
+                self.rows_P, _ = tf.unique(self.user_input)
+                self.rows_Q, _ = tf.unique(tf.concat([self.item_input_pos, self.item_input_neg], 0))
+                self.adv_P = tf.truncated_normal(shape=[tf.size(self.rows_P), self.embedding_size], mean=0.0, stddev=0.01)
+                self.adv_Q = tf.truncated_normal(shape=[tf.size(self.rows_Q), self.embedding_size], mean=0.0, stddev=0.01)
 
             # generate the adversarial weights by gradient-based method
             elif self.adv == "grad":
                 # return the IndexedSlice Data: [(values, indices, dense_shape)]
-                # grad_var_P: [grad,var], grad_var_Q: [grad, var]
-                self.grad_P, self.grad_Q = tf.gradients(self.loss, [self.embedding_P, self.embedding_Q])
+                self.grad_P = embedding.gradient(self.loss, self.embedding_P)
+                self.grad_Q = embedding.gradient(self.loss, self.embedding_Q)
+
+                # sum the slices of repeated rows instead of densifying the whole table
+                self.rows_P, self.adv_P = self._sum_slices(self.grad_P)
+                self.rows_Q, self.adv_Q = self._sum_slices(self.grad_Q)
 
-                # convert the IndexedSlice Data to Dense Tensor
-                self.grad_P_dense = tf.stop_gradient(self.grad_P)
-                self.grad_Q_dense = tf.stop_gradient(self.grad_Q)
+            # normalization: new_grad = (grad / |grad|) * eps
+            self.update_P = tf.scatter_update(self.delta_P, self.rows_P, tf.nn.l2_normalize(self.adv_P, 1) * self.eps)
+            self.update_Q = tf.scatter_update(self.delta_Q, self.rows_Q, tf.nn.l2_normalize(self.adv_Q, 1) * self.eps)
 
-                # normalization: new_grad = (grad / |grad|) * eps
-                self.update_P = self.delta_P.assign(tf.nn.l2_normalize(self.grad_P_dense, 1) * self.eps)
-                self.update_Q = self.delta_Q.assign(tf.nn.l2_normalize(self.grad_Q_dense, 1) * self.eps)
+    def _sum_slices(self, grad):
+        rows, index = tf.unique(grad.indices)
+        values = tf.unsorted_segment_sum(tf.stop_gradient(grad.values), index, tf.size(rows))
+        return rows, values
 
     def _create_optimizer(self):
         with tf.name_scope("learner"):
-            self.optimizer = learner.optimizer(self.learner, self.loss, self.learning_rate)
+            self.optimizer = learner.optimizer(self.learner, self.train_loss, self.learning_rate)
 
     def build_graph(self):
         self._create_placeholders()
@@ -163,12 +175,24 @@ class APR(AbstractRecommender):
                 feed_dict = {self.user_input:bat_users,self.item_input_pos:bat_items_pos,\
                             self.item_input_neg:bat_items_neg}
 
-                loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
+                if self.adver and epoch >= self.adv_epoch:
+                    # perturb the rows of the batch, then train on L(Theta) + L(Theta + adv_Delta)
+                    self.sess.run((self.update_P, self.update_Q), feed_dict=feed_dict)
+                    feed_dict[self.adversarial] = 1.0
+                    loss,_ = self.sess.run((self.opt_loss,self.optimizer),feed_dict=feed_dict)
+                else:
+                    loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
         users = np.full(len(items), user_id, dtype=np.int32)
         return self.sess.run(self.output, feed_dict={self.user_input: users, self.item_input_pos: items})
+
+    def snapshot(self):
+        embedding_P, embedding_Q = embedding.get_values(self.sess, [self.embedding_P, self.embedding_Q])
+        return EmbeddingSnapshot(self, embedding_P, embedding_Q)
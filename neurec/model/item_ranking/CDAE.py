@@ -14,6 +14,7 @@ import numpy as np
 from time import time
 from neurec.util import learner,tool
 from neurec.evaluation import Evaluate
+from neurec.util.scorer import UserBlockScorer
 
 class CDAE(AbstractRecommender):
     properties = [
@@ -48,12 +49,13 @@ class CDAE(AbstractRecommender):
         self.corruption_level = self.conf["corruption_level"]
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
+        self.scorer = UserBlockScorer(self.predict_users, self.num_users, self.num_items)
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
             self.user_input = tf.placeholder(tf.int32, shape=[None,],name = 'user_input')
-            self.input_R = tf.placeholder(tf.float32, [None, self.num_items])
-            self.mask_corruption = tf.placeholder(tf.float32, [None, self.num_items])
+            self.input_R = tf.sparse_placeholder(tf.float32, [None, self.num_items])
+            self.mask_corruption = tf.placeholder(tf.float32, [None,]) # one value per non-zero of input_R
 
     def _create_variables(self):
         with tf.name_scope("embedding"):  # The embedding initialization is unknown now
@@ -73,9 +75,10 @@ class CDAE(AbstractRecommender):
 
             self.user_latent =  tf.nn.embedding_lookup(self.V, self.user_input)
 
-            corrupted_input = tf.multiply(self.input_R,self.mask_corruption)
+            corrupted_input = tf.SparseTensor(self.input_R.indices, self.input_R.values*self.mask_corruption,
+                                              self.input_R.dense_shape)
             encoder_op = tool.activation_function(self.h_act,\
-            tf.matmul(corrupted_input, self.weights['encoder'])+self.biases['encoder']+self.user_latent)
+            tf.sparse_tensor_dense_matmul(corrupted_input, self.weights['encoder'])+self.biases['encoder']+self.user_latent)
 
             self.decoder_op = tf.matmul(encoder_op, self.weights['decoder'])+self.biases['decoder']
             self.output = tool.activation_function(self.g_act,self.decoder_op)
@@ -83,7 +86,8 @@ class CDAE(AbstractRecommender):
     def _create_loss(self):
         with tf.name_scope("loss"):
 
-            self.loss = - tf.reduce_sum(self.input_R* tf.log(self.output) + (1 - self.input_R) * tf.log(1 - self.output))
+            input_R = tf.sparse_tensor_to_dense(self.input_R)
+            self.loss = - tf.reduce_sum(input_R* tf.log(self.output) + (1 - input_R) * tf.log(1 - self.output))
 
             self.reg_loss = self.reg*(tf.nn.l2_loss(self.weights['encoder'])+tf.nn.l2_loss(self.weights['decoder'])+
                 tf.nn.l2_loss(self.biases['encoder'])+tf.nn.l2_loss(self.biases['decoder']))
@@ -102,11 +106,8 @@ class CDAE(AbstractRecommender):
         self._create_optimizer()
 
     def train_model(self):
-
+        train_matrix = self.dataset.get_train_csr()
         for epoch in  range(self.num_epochs):
-            # Generate training instances
-            mask_corruption_np = np.random.binomial(1, 1-self.corruption_level,
-                                                (self.num_users, self.num_items))
             random_perm_doc_idx = np.random.permutation(self.num_users)
             self.total_batch = self.num_users
             total_loss = 0.0
@@ -118,32 +119,30 @@ class CDAE(AbstractRecommender):
                 elif num_batch < self.total_batch - 1:
                     batch_set_idx = random_perm_doc_idx[num_batch * self.batch_size: (num_batch + 1) * self.batch_size]
 
-                batch_matrix = np.zeros((len(batch_set_idx),self.num_items))
-
-                batch_uid = 0
-                trainDict = self.dataset.trainDict
-                for userid in batch_set_idx:
-                    items_by_userid = trainDict[userid]
-                    for itemid in items_by_userid:
-                        batch_matrix[batch_uid,itemid] = 1
-
-                    batch_uid=batch_uid+1
+                batch_matrix = train_matrix[batch_set_idx]
+                # corruption only matters where the input is non-zero
+                mask_corruption_np = np.random.binomial(1, 1-self.corruption_level, batch_matrix.nnz)
 
-                feed_dict = feed_dict={self.mask_corruption:
-                    mask_corruption_np[batch_set_idx, :],\
-                    self.input_R: batch_matrix, self.user_input: batch_set_idx}
+                feed_dict = {self.mask_corruption: mask_corruption_np,\
+                    self.input_R: tool.csr_to_sparse_tensor(batch_matrix), self.user_input: batch_set_idx}
                 _, loss = self.sess.run([self.optimizer, self.loss],feed_dict=feed_dict)
                 total_loss+=loss
+            self.invalidate_snapshot()
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
+
+    def invalidate_snapshot(self):
+        super().invalidate_snapshot()
+        self.scorer.reset()
+
+    def predict_users(self, user_ids):
+        rating_matrix = self.dataset.get_train_csr()[user_ids]
+        feed_dict = {self.mask_corruption: np.ones(rating_matrix.nnz, dtype=np.float32),
+                     self.input_R: tool.csr_to_sparse_tensor(rating_matrix), self.user_input: user_ids}
+        return self.sess.run(self.output, feed_dict=feed_dict)
 
     def predict(self, user_id, items):
-        mask = np.ones((1,self.num_items), dtype=np.int32)
-        rating_matrix = np.zeros((1,self.num_items), dtype=np.int32)
-        items_by_userid = self.dataset.trainDict[user_id]
-        for itemid in items_by_userid:
-            rating_matrix[0,itemid] = 1
-        output = self.sess.run(self.output, feed_dict={self.mask_corruption:mask,self.input_R:rating_matrix,
-            self.user_input: np.array([user_id])})
-        return output[0,items]
+        return self.scorer.predict(user_id, items)
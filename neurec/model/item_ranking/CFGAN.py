@@ -8,33 +8,30 @@ based on Generative Adversarial Networks." in CIKM2018
 from neurec.model.AbstractRecommender import AbstractRecommender
 import numpy as np
 import tensorflow as tf
-from scipy.sparse import csr_matrix
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
+from neurec.util.scorer import UserBlockScorer
 
-def csr_to_user_dict(sparse_matrix_data):
-    """convert a scipy.sparse.csr_matrix to a dict,
-    where the key is row number, and value is the
-    non-empty index in each row.
+def sample_unobserved(batch_matrix, ratio):
+    """Returns a dense 0/1 mask of int(ratio * unobserved) unobserved entries per row.
+
+    The entries of a row are drawn uniformly without replacement among the
+    zero columns of that row of the csr_matrix batch_matrix. Rows without
+    observed entries get no samples.
     """
-    idx_value_dict = {}
-    for idx, value in enumerate(sparse_matrix_data):
-        if any(value.indices):
-            idx_value_dict[idx] = value.indices
-    return idx_value_dict
-
-
-def random_choice(a, size=None, replace=True, p=None, exclusion=None):
-    if exclusion is not None:
-        if p is None:
-            p = np.ones_like(a)
-        else:
-            p = np.array(p, copy=True)
-        p = np.ndarray.flatten(p)
-        p[exclusion] = 0
-        p = p / np.sum(p)
-    sample = np.random.choice(a, size=size, replace=replace, p=p)
-    return sample
+    observed = batch_matrix.toarray() > 0
+    num_unobserved = observed.shape[1] - batch_matrix.getnnz(axis=1)
+    num_samples = np.where(batch_matrix.getnnz(axis=1) > 0, (num_unobserved * ratio).astype(np.int64), 0)
+
+    # the num_samples smallest random keys of the unobserved entries of every row
+    keys = np.random.random_sample(observed.shape)
+    keys[observed] = np.inf
+    # partitioned once per distinct number of samples, linear in the size of the batch
+    kth = np.full(len(keys), -np.inf)
+    for k in np.unique(num_samples[num_samples > 0]):
+        rows = np.flatnonzero(num_samples == k)
+        kth[rows] = np.partition(keys[rows], k - 1, axis=1)[:, k - 1]
+    return ((keys <= kth[:, None]) & (num_samples > 0)[:, None]).astype(np.float32)
 
 
 class CFGAN(AbstractRecommender):
@@ -60,7 +57,7 @@ class CFGAN(AbstractRecommender):
         "verbose"
     ]
 
-    def __init__(self, sess, dataset):
+    def __init__(self, **kwds):
         super().__init__(**kwds)
 
         self.epochs = self.conf["epochs"]
@@ -85,34 +82,33 @@ class CFGAN(AbstractRecommender):
         self.ZR_coefficient = self.conf["zr_coefficient"]
         self.verbose= self.conf["verbose"]
 
-        train_matrix = dataset.trainMatrix.tocsr()
-        self.train_matrix = train_matrix.copy()
+        # rows are users (userBased) or items (itemBased) of the binary rating matrix
+        self.train_matrix = self.dataset.get_train_csr()
         if self.mode == "itemBased":
             self.train_matrix = self.train_matrix.transpose(copy=True).tocsr()
 
-        self.num_users, self.num_items = self.train_matrix.shape
-        self.user_pos_train = csr_to_user_dict(self.train_matrix)
-        self.all_items = np.arange(self.num_items)
+        self.num_users = self.dataset.num_users
+        self.num_items = self.dataset.num_items
+        self.num_rows, self.num_cols = self.train_matrix.shape
         self.loss_function = "None"
-
-        # self._build_model()
-        # self.sess.run(tf.global_variables_initializer())
+        self.row_hidden = None
+        self.scorer = UserBlockScorer(self.predict_users, self.num_users, self.num_items)
 
     def build_graph(self):
         self._create_layer()
 
         # generator
-        self.condition = tf.placeholder(tf.float32, [None, self.num_items])
-        self.G_ZR_dims = tf.placeholder(tf.float32, [None, self.num_items])
+        self.condition = tf.placeholder(tf.float32, [None, self.num_cols])
+        self.G_ZR_dims = tf.placeholder(tf.float32, [None, self.num_cols])
         self.G_output = self.gen(self.condition)
         self.G_ZR_loss = tf.reduce_mean(tf.reduce_sum(tf.square(self.G_output - 0) * self.G_ZR_dims, 1, keepdims=True))
 
         # discriminator
-        self.mask = tf.placeholder(tf.float32, [None, self.num_items])  # purchased = 1, otherwise 0
+        self.mask = tf.placeholder(tf.float32, [None, self.num_cols])  # purchased = 1, otherwise 0
         fakeData = self.G_output * self.mask
         fakeData = tf.concat([self.condition, fakeData], 1)
 
-        self.realData = tf.placeholder(tf.float32, [None, self.num_items])
+        self.realData = tf.placeholder(tf.float32, [None, self.num_cols])
         realData = tf.concat([self.condition, self.realData], 1)
 
         D_fake = self.dis(fakeData)
@@ -141,6 +137,17 @@ class CFGAN(AbstractRecommender):
         elif self.opt_D == 'adam':
             self.trainer_D = tf.train.AdamOptimizer(self.lr_D).minimize(d_loss, var_list=d_vars)
 
+        # itemBased scoring: the last hidden layer of every item row is computed
+        # once, then only the output columns of the scored users are decoded
+        self.G_hidden = self.condition
+        for layer in self.gen_layers[:-1]:
+            self.G_hidden = layer.apply(self.G_hidden)
+        self.hidden_input = tf.placeholder(tf.float32, [None, None])
+        self.output_idx = tf.placeholder(tf.int32, [None])
+        output_layer = self.gen_layers[-1]
+        self.G_output_columns = tf.matmul(self.hidden_input, tf.gather(output_layer.kernel, self.output_idx, axis=1)) \
+                                + tf.gather(output_layer.bias, self.output_idx)
+
     def _l2loss(self, var):
         l2loss = 0
         for v in var:
@@ -158,7 +165,7 @@ class CFGAN(AbstractRecommender):
             self.gen_layers.append(hidden_layer)
 
         # hidden -> output
-        output_layer = tf.layers.Dense(self.num_items, activation=tf.identity,
+        output_layer = tf.layers.Dense(self.num_cols, activation=tf.identity,
                                        kernel_initializer=xavier_init, name="gen_out")
         self.gen_layers.append(output_layer)
 
@@ -185,60 +192,65 @@ class CFGAN(AbstractRecommender):
             input = layer.apply(input)
         return input
 
-    def get_train_data(self):
-        train_matrix = self.train_matrix.copy()
-        ZR_matrix = self.train_matrix.todense()
-        PM_matrix = self.train_matrix.todense()
-
-        for u, pos_items in self.user_pos_train.items():
-            num = int((self.num_items-len(pos_items)) * self.ZR_ratio)
-            sample = random_choice(self.all_items, size=num, replace=False, exclusion=pos_items).tolist()
-            ZR_matrix[u, sample] = 1
-
-            num = int((self.num_items-len(pos_items)) * self.ZP_ratio)
-            sample = random_choice(self.all_items, size=num, replace=False, exclusion=pos_items).tolist()
-            PM_matrix[u, sample] = 1
-        return train_matrix, csr_matrix(ZR_matrix), csr_matrix(PM_matrix)
+    def get_train_batch(self, idx):
+        # dense rows and ZR/PM masks of one minibatch; a mask holds the observed
+        # entries plus the sampled unobserved ones
+        batch_matrix = self.train_matrix[idx]
+        train_data = batch_matrix.toarray()
+        ZR_mask = np.maximum(train_data, sample_unobserved(batch_matrix, self.ZR_ratio))
+        PM_mask = np.maximum(train_data, sample_unobserved(batch_matrix, self.ZP_ratio))
+        return train_data, ZR_mask, PM_mask
 
     def train_model(self):
-        gen_batch_index = np.arange(self.num_users)
-        np.random.shuffle(gen_batch_index)
-        dis_batch_index = np.arange(self.num_users)
+        dis_batch_index = np.arange(self.num_rows)
         np.random.shuffle(dis_batch_index)
 
         totalEpochs = self.epochs
         totalEpochs = int(totalEpochs / self.step_G)
         for epoch in range(totalEpochs):
-            train_matrix, ZR_matrix, PM_matrix = self.get_train_data()
             # training discriminator
             for d_epoch in range(self.step_D):
-                for idx in np.arange(0, self.num_users, step=self.batchSize_D):
+                for idx in np.arange(0, self.num_rows, step=self.batchSize_D):
                     idx = dis_batch_index[idx:idx + self.batchSize_D]
-                    train_data = train_matrix[idx].toarray()
-                    train_mask = PM_matrix[idx].toarray()
+                    train_data, _, train_mask = self.get_train_batch(idx)
                     feed = {self.realData: train_data, self.mask: train_mask, self.condition: train_data}
                     self.sess.run(self.trainer_D, feed_dict=feed)
 
             # training generator
             for g_epoch in range(self.step_G):
-                for idx in np.arange(0, self.num_users, step=self.batchSize_G):
+                for idx in np.arange(0, self.num_rows, step=self.batchSize_G):
                     idx = dis_batch_index[idx:idx + self.batchSize_G]
-                    train_data = train_matrix[idx].toarray()
-                    train_z_mask = ZR_matrix[idx].toarray()
-                    train_p_mask = PM_matrix[idx].toarray()
+                    train_data, train_z_mask, train_p_mask = self.get_train_batch(idx)
                     feed = {self.realData: train_data, self.condition: train_data,
                             self.mask: train_p_mask, self.G_ZR_dims: train_z_mask}
                     self.sess.run(self.trainer_G, feed_dict=feed)
+            self.invalidate_snapshot()
             if epoch %self.verbose == 0:
-                self.eval_rating_matrix()
-                Evaluate.test_model(self, self.dataset)
-
-
-    def eval_rating_matrix(self):
-        allRatings = self.sess.run(self.G_output, feed_dict={self.condition: self.train_matrix.toarray()})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
+
+    def encode_rows(self):
+        # last hidden layer of the generator for every row, in batches of rows
+        hidden = []
+        for start in range(0, self.num_rows, self.batchSize_G):
+            condition = self.train_matrix[start:start + self.batchSize_G].toarray()
+            hidden.append(self.sess.run(self.G_hidden, feed_dict={self.condition: condition}))
+        return np.concatenate(hidden)
+
+    def invalidate_snapshot(self):
+        super().invalidate_snapshot()
+        self.row_hidden = None
+        self.scorer.reset()
+
+    def predict_users(self, user_ids):
         if self.mode == "itemBased":
-            allRatings = np.transpose(allRatings)
-        self.allRatings_for_test = allRatings
+            if self.row_hidden is None:
+                self.row_hidden = self.encode_rows()
+            ratings = self.sess.run(self.G_output_columns,
+                                    feed_dict={self.hidden_input: self.row_hidden, self.output_idx: user_ids})
+            return np.transpose(ratings)
+        return self.sess.run(self.G_output, feed_dict={self.condition: self.train_matrix[user_ids].toarray()})
 
     def predict(self, user_id, items):
-        return self.allRatings_for_test[user_id, items]
+        return self.scorer.predict(user_id, items)
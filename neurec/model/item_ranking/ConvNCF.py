@@ -12,10 +12,11 @@ import tensorflow as tf
 import numpy as np
 from time import time
 from neurec.evaluation import Evaluate
-from neurec.util import data_gen, learner
+from neurec.util import data_gen, learner, parallel
 from neurec.util.properties import Properties
 
 class ConvNCF(AbstractRecommender):
+    data_parallel = True
     properties = [
         "embedding_size",
         "topk",
@@ -140,14 +141,15 @@ class ConvNCF(AbstractRecommender):
         # seperated optimizer
             var_list1 = [self.embedding_P, self.embedding_Q]
             #[self.W1,self.W2,self.W3,self.W4,self.b1,self.b2,self.b3,self.b4,self.P1,self.P2,self.P3]
-            var_list2 = list(set(tf.trainable_variables()) - set(var_list1))
+            # sorted, so that every data-parallel worker reduces the gradients in the same order
+            var_list2 = sorted(set(tf.trainable_variables()) - set(var_list1), key=lambda var: var.name)
             opt1 = tf.train.AdagradOptimizer(self.lr_embed)
             opt2 = tf.train.AdagradOptimizer(self.lr_net)
             grads = tf.gradients(self.opt_loss, var_list1 + var_list2)
-            grads1 = grads[:len(var_list1)]
-            grads2 = grads[len(var_list1):]
-            train_op1 = opt1.apply_gradients(zip(grads1, var_list1))
-            train_op2 = opt2.apply_gradients(zip(grads2, var_list2))
+            grads_and_vars = parallel.average_gradients(list(zip(grads, var_list1 + var_list2)))
+            num_embeddings = sum(1 for _, var in grads_and_vars if var in var_list1)
+            train_op1 = opt1.apply_gradients(grads_and_vars[:num_embeddings])
+            train_op2 = opt2.apply_gradients(grads_and_vars[num_embeddings:])
             self.optimizer = tf.group(train_op1, train_op2)
 
     def build_graph(self):
@@ -178,7 +180,9 @@ class ConvNCF(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset,epoch)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
         users = np.full(len(items), user_id, dtype=np.int32)
@@ -11,7 +11,8 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import learner
+from neurec.util import learner, tool
+from neurec.util.snapshot import EmbeddingSnapshot
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 
@@ -53,8 +54,9 @@ class DMF(AbstractRecommender):
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
-            self.one_hot_u = tf.placeholder(tf.float32, shape=[None,None],name = 'user_input')
-            self.one_hot_v = tf.placeholder(tf.float32, shape=[None,None],name = 'item_input')
+            # rows of the rating matrix of the batch users and columns of the batch items
+            self.one_hot_u = tf.sparse_placeholder(tf.float32, shape=[None,self.num_items],name = 'user_input')
+            self.one_hot_v = tf.sparse_placeholder(tf.float32, shape=[None,self.num_users],name = 'item_input')
             self.lables = tf.placeholder(tf.float32, shape=[None,],name="labels")
 
     def _create_variables(self):
@@ -71,16 +73,16 @@ class DMF(AbstractRecommender):
 
     def _create_inference(self):
         with tf.name_scope("inference"):
-            net_u_1 = tf.nn.relu(tf.matmul(self.one_hot_u, self.u_w1) + self.u_b1)
-            net_u_2 = tf.matmul(net_u_1, self.u_w2) + self.u_b2
+            net_u_1 = tf.nn.relu(tf.sparse_tensor_dense_matmul(self.one_hot_u, self.u_w1) + self.u_b1)
+            self.net_u_2 = tf.matmul(net_u_1, self.u_w2) + self.u_b2
 
-            net_v_1 = tf.nn.relu(tf.matmul(self.one_hot_v, self.v_w1) + self.v_b1)
-            net_v_2 = tf.matmul(net_v_1, self.v_w2) + self.v_b2
+            net_v_1 = tf.nn.relu(tf.sparse_tensor_dense_matmul(self.one_hot_v, self.v_w1) + self.v_b1)
+            self.net_v_2 = tf.matmul(net_v_1, self.v_w2) + self.v_b2
 
-            fen_zhi = tf.reduce_sum(net_u_2 * net_v_2, 1)
+            fen_zhi = tf.reduce_sum(self.net_u_2 * self.net_v_2, 1)
 
-            norm_u = tf.reduce_sum(tf.square(net_u_2), 1)
-            norm_v = tf.reduce_sum(tf.square(net_v_2), 1)
+            norm_u = tf.reduce_sum(tf.square(self.net_u_2), 1)
+            norm_v = tf.reduce_sum(tf.square(self.net_v_2), 1)
             fen_mu = norm_u * norm_v
             self.output =  tf.nn.relu(fen_zhi / fen_mu)
 
@@ -113,39 +115,35 @@ class DMF(AbstractRecommender):
                 id_end = (num_batch + 1) *  self.batch_size
                 if id_end>num_training_instances:
                     id_end=num_training_instances
-                bat_users = user_input[id_start:id_end].tolist()
-                bat_items = item_input[id_start:id_end].tolist()
+                bat_users = user_input[id_start:id_end]
+                bat_items = item_input[id_start:id_end]
                 bat_lables = np.array(lables[id_start:id_end])
-                feed_dict = {self.one_hot_u:bat_users, self.one_hot_v:bat_items,
+                feed_dict = {self.one_hot_u:tool.csr_to_sparse_tensor(self.user_matrix[bat_users]),
+                             self.one_hot_v:tool.csr_to_sparse_tensor(self.item_matrix[:, bat_items].T),
                              self.lables:bat_lables}
                 loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
                 total_loss+=loss
+            self.invalidate_snapshot()
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
     def _get_input_all_data(self):
-        user_input,item_input,lables = [],[],[]
-        for u in range(self.num_users):
-            # positive instance
-            items_by_user = self.user_matrix[u].indices
-            u_vector = np.reshape(self.user_matrix.getrow(u).toarray(),[self.num_items])
-            for i in items_by_user:
-                i_vector = np.reshape(self.item_matrix.getcol(i).toarray(),[self.num_users])
-                user_input.append(u_vector)
-                item_input.append(i_vector)
-                lables.append(1)
-            # negative instance
-                for _ in range(self.num_negatives):
-                    j = np.random.randint(self.num_items)
-                    while (u, j) in self.dataset.trainMatrix.keys():
-                        j = np.random.randint(self.num_items)
-                    j_vector = np.reshape(self.item_matrix.getcol(i).toarray(),[self.num_users])
-                    user_input.append(u_vector)
-                    item_input.append(j_vector)
-                    lables.append(0)
-        user_input = np.array(user_input, dtype=np.int32)
-        item_input = np.array(item_input, dtype=np.int32)
-        lables = np.array(lables, dtype=np.float32)
+        # user and item ids of the positive instances and of num_negatives
+        # unobserved items drawn for each of them
+        pos_users, pos_items = self.user_matrix.nonzero()
+        observed = np.sort(pos_users.astype(np.int64) * self.num_items + pos_items)
+        neg_users = np.repeat(pos_users, self.num_negatives)
+        neg_items = np.zeros(len(neg_users), dtype=np.int64)
+        redraw = np.ones(len(neg_users), dtype=bool)
+        while redraw.any():
+            neg_items[redraw] = np.random.randint(self.num_items, size=np.count_nonzero(redraw))
+            redraw = np.isin(neg_users.astype(np.int64) * self.num_items + neg_items, observed)
+
+        user_input = np.concatenate([pos_users, neg_users]).astype(np.int32)
+        item_input = np.concatenate([pos_items, neg_items]).astype(np.int32)
+        lables = np.concatenate([np.ones(len(pos_users)), np.zeros(len(neg_users))]).astype(np.float32)
         num_training_instances = len(user_input)
         shuffle_index = np.arange(num_training_instances,dtype=np.int32)
         np.random.shuffle(shuffle_index)
@@ -153,11 +151,22 @@ class DMF(AbstractRecommender):
         item_input=item_input[shuffle_index]
         lables = lables[shuffle_index]
         return user_input,item_input,lables
+    def _run_tower(self, output, sparse_input, matrix):
+        # tower outputs of all rows of a rating matrix, in batches of rows
+        towers = []
+        for start in range(0, matrix.shape[0], self.batch_size):
+            rows = tool.csr_to_sparse_tensor(matrix[start:start + self.batch_size])
+            towers.append(self.sess.run(output, feed_dict={sparse_input: rows}))
+        return np.concatenate(towers)
+
+    def snapshot(self):
+        # output = relu(u.v / (|u|^2 * |v|^2)), so the towers are scaled by their
+        # squared norms once and the score is a clipped dot product
+        user_towers = self._run_tower(self.net_u_2, self.one_hot_u, self.user_matrix)
+        item_towers = self._run_tower(self.net_v_2, self.one_hot_v, self.item_matrix.T.tocsr())
+        user_towers /= np.sum(np.square(user_towers), axis=1, keepdims=True)
+        item_towers /= np.sum(np.square(item_towers), axis=1, keepdims=True)
+        return EmbeddingSnapshot(self, user_towers, item_towers, clip_negative=True)
+
     def predict(self, user_id, items):
-        user_input,item_input = [],[]
-        u_vector = np.reshape(self.user_matrix.getrow(user_id).toarray(),[self.num_items])
-        for i in items:
-            user_input.append(u_vector)
-            i_vector = np.reshape(self.item_matrix.getcol(i).toarray(),[self.num_users])
-            item_input.append(i_vector)
-        return self.sess.run(self.output, feed_dict={self.one_hot_u: user_input, self.one_hot_v: item_input})
+        return self.cached_snapshot().predict(user_id, items)
@@ -17,6 +17,7 @@ from neurec.util import learner,data_gen
 from neurec.util.properties import Properties
 
 class FISM(AbstractRecommender):
+    data_parallel = True
     properties = [
         "verbose",
         "batch_size",
@@ -85,6 +86,19 @@ class FISM(AbstractRecommender):
             coeff = tf.pow(num_idx, -tf.constant(self.alpha, tf.float32, [1]))
             output = coeff * tf.reduce_sum(tf.multiply(embedding_p,embedding_q), 1) + bias_i
         return embedding_p, embedding_q,output
+
+    def _create_history_inference(self):
+        # Scores many candidates of one user: the history is embedded and summed
+        # once and every candidate in item_input is scored against that vector.
+        with tf.name_scope("history_inference"):
+            self.history_input = tf.placeholder(tf.int32, shape=[None,], name = "history_input")
+            embedding_p = tf.reduce_sum(tf.nn.embedding_lookup(self.embedding_Q_, self.history_input), 0, keepdims=True) # (1, e)
+            embedding_q = tf.nn.embedding_lookup(self.embedding_Q, self.item_input) # (m, e)
+            bias_i = tf.nn.embedding_lookup(self.bias, self.item_input)
+            num_idx = tf.cast(tf.shape(self.history_input)[0], tf.float32)
+            coeff = tf.pow(num_idx, -tf.constant(self.alpha, tf.float32))
+            self.history_output = coeff * tf.squeeze(tf.matmul(embedding_q, embedding_p, transpose_b=True), 1) + bias_i
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             p1, q1, self.output = self._create_inference(self.user_input,self.item_input,self.num_idx)
@@ -106,6 +120,7 @@ class FISM(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_history_inference()
         self._create_optimizer()
 
     def train_model(self):
@@ -141,16 +156,11 @@ class FISM(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id,items):
         cand_items = self.dataset.trainDict[user_id]
-        num_idx = len(cand_items)
-        # Get prediction scores
-        item_idx = np.full(len(items), num_idx, dtype=np.int32)
-        user_input = []
-        for _ in range(len(items)):
-            user_input.append(cand_items)
-        feed_dict = {self.user_input: np.array(user_input), \
-                     self.num_idx: item_idx, self.item_input:items}
-        return self.sess.run((self.output), feed_dict=feed_dict)
+        feed_dict = {self.history_input: cand_items, self.item_input: items}
+        return self.sess.run(self.history_output, feed_dict=feed_dict)
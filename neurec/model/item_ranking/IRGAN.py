@@ -7,10 +7,10 @@ from neurec.model.AbstractRecommender import AbstractRecommender
 import tensorflow as tf
 import pickle
 import numpy as np
-from concurrent.futures import ThreadPoolExecutor
 from neurec.util import data_gen, reader
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
 
 class GEN(object):
     def __init__(self, itemNum, userNum, emb_dim, lamda, param=None, initdelta=0.05, learning_rate=0.05):
@@ -62,6 +62,43 @@ class GEN(object):
         self.all_rating = tf.matmul(self.u_embedding, self.item_embeddings, transpose_a=False,
                                     transpose_b=True) + self.item_bias
 
+        # policy gradient for a block of users, self.u: [block_size]; the samples are
+        # given as (row in the block, item) pairs and their rewards already include
+        # the per-user averaging, so the step equals the sum of the per-user steps
+        self.block_rows = tf.placeholder(tf.int32, shape=[None])
+        self.block_items = tf.placeholder(tf.int32, shape=[None])
+        block_log_prob = tf.gather_nd(tf.nn.log_softmax(self.all_rating),
+                                      tf.stack([self.block_rows, self.block_items], axis=1))
+        block_i_embedding = tf.nn.embedding_lookup(self.item_embeddings, self.block_items)
+        block_i_bias = tf.gather(self.item_bias, self.block_items)
+        self.block_loss = -tf.reduce_sum(block_log_prob * self.reward) + self.lamda * (
+            tf.nn.l2_loss(self.u_embedding) + tf.nn.l2_loss(block_i_embedding) + tf.nn.l2_loss(block_i_bias))
+        self.block_updates = g_opt.minimize(self.block_loss, var_list=self.g_params)
+
+
+def sample_rows(prob, counts):
+    """Samples items with replacement from every row of a probability matrix by inverse CDF.
+
+    Returns the row and the item of each sample, rows in increasing order.
+
+    prob -- array of shape (rows, items), rows sum to one
+    counts -- number of samples of each row
+    """
+    num_rows, num_items = prob.shape
+    # shifting the cdf of row r by r makes a single sorted array for all rows
+    cdf = np.cumsum(prob, axis=1, dtype=np.float64)
+    cdf /= cdf[:, -1:]
+    cdf += np.arange(num_rows)[:, None]
+    rows = np.repeat(np.arange(num_rows), counts)
+    index = np.searchsorted(cdf.ravel(), rows + np.random.rand(len(rows)), side='right')
+    items = np.minimum(index - rows * num_items, num_items - 1)
+    return rows, items
+
+
+def softmax_rows(logits):
+    exp_logits = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+    return exp_logits / np.sum(exp_logits, axis=1, keepdims=True)
+
 
 class DIS(object):
     def __init__(self, itemNum, userNum, emb_dim, lamda, param=None, initdelta=0.05, learning_rate=0.05):
@@ -125,6 +162,11 @@ class DIS(object):
 
 
 class IRGAN(AbstractRecommender):
+    # users whose generator distributions are sampled and updated together
+    user_block_size = 256
+    # bound on the elements of the dense distributions of a block
+    max_block_elements = 1 << 24
+
     properties = [
         "factors_num",
         "lr",
@@ -139,13 +181,9 @@ class IRGAN(AbstractRecommender):
         "pretrain_file"
     ]
 
-    def __init__(self, sess, dataset):
-        # super(IRGAN, self).__init__()
+    def __init__(self, **kwds):
         super().__init__(**kwds)
 
-        train_matrix = dataset.trainMatrix.tocsr()
-        self.num_users, self.num_items = train_matrix.shape
-
         self.factors_num = self.conf["factors_num"]
         self.lr = self.conf["lr"]
         self.g_reg = self.conf["g_reg"]
@@ -159,17 +197,10 @@ class IRGAN(AbstractRecommender):
         self.pretrain_file = self.conf["pretrain_file"]
         self.loss_function = "None"
 
-        idx_value_dict = {}
-        for idx, value in enumerate(train_matrix):
-            if any(value.indices):
-                idx_value_dict[idx] = value.indices
-
-        self.user_pos_train = idx_value_dict
-
-        self.num_users, self.num_items = dataset.num_users, dataset.num_items
-
-
-        self.all_items = np.arange(self.num_items)
+        self.train_csr = self.dataset.get_train_csr()
+        self.num_users, self.num_items = self.dataset.num_users, self.dataset.num_items
+        self.train_users = np.flatnonzero(self.train_csr.getnnz(axis=1))
+        self.block_size = max(1, min(self.user_block_size, self.max_block_elements // self.num_items))
 
     def build_graph(self):
         file = reader.lines(self.pretrain_file)
@@ -179,47 +210,42 @@ class IRGAN(AbstractRecommender):
         self.discriminator = DIS(self.num_items, self.num_users, self.factors_num, self.d_reg, param=None,
                                  learning_rate=self.lr)
 
+    def get_user_blocks(self):
+        for start in range(0, len(self.train_users), self.block_size):
+            yield self.train_users[start:start + self.block_size]
+
     def get_train_data(self):
+        # the generator distributions of a block of users are computed in one run,
+        # and one negative is sampled for every positive item of the users
         users_list, items_list, labels_list = [], [], []
-        train_users = list(self.user_pos_train.keys())
-        with ThreadPoolExecutor() as executor:
-            data = executor.map(self.get_train_data_one_user, train_users)
-        data = list(data)
-        for users, items, labels in data:
-            users_list.extend(users)
-            items_list.extend(items)
-            labels_list.extend(labels)
-
-        return users_list, items_list, labels_list
-
-    def get_train_data_one_user(self, user):
-        user_list, items_list, label_list = [], [], []
-        pos = self.user_pos_train[user]
-
-        rating = self.sess.run(self.generator.all_rating, {self.generator.u: [user]})
-        rating = np.reshape(rating, [-1])
-        rating = np.array(rating) / self.d_tau  # Temperature
-        exp_rating = np.exp(rating)
-        prob = exp_rating / np.sum(exp_rating)
-        neg = np.random.choice(self.all_items, size=len(pos), p=prob)
-        for i, j in zip(pos, neg):
-            user_list.append(user)
-            items_list.append(i)
-            label_list.append(1.0)
-
-            user_list.append(user)
-            items_list.append(j)
-            label_list.append(0.0)
-        return (user_list, items_list, label_list)
+        for users in self.get_user_blocks():
+            rating = self.sess.run(self.generator.all_rating, {self.generator.u: users})
+            prob = softmax_rows(rating / self.d_tau)  # Temperature
+            pos = self.train_csr[users]
+            rows, neg = sample_rows(prob, pos.getnnz(axis=1))
+            block_users = users[rows]
+            users_list.append(np.stack([block_users, block_users], axis=1).ravel())
+            items_list.append(np.stack([pos.indices, neg], axis=1).ravel())
+            labels_list.append(np.tile([1.0, 0.0], len(rows)))
+
+        return np.concatenate(users_list), np.concatenate(items_list), np.concatenate(labels_list)
 
     def train_model(self):
+        epoch = 0
         for _ in range(self.epochs):
             for _ in range(self.d_epoch):
                 users_list, items_list, labels_list = self.get_train_data()
                 self.training_discriminator(users_list, items_list, labels_list)
+            stop = False
             for _ in range(self.g_epoch):
                 self.training_generator()
-                Evaluate.test_model(self, self.dataset)
+                stop = self.controller.evaluate(epoch)
+                epoch += 1
+                if stop:
+                    break
+            if stop:
+                break
+        self.controller.finish()
 
     def training_discriminator(self, user, item, label):
         num_training_instances = len(user)
@@ -233,34 +259,38 @@ class IRGAN(AbstractRecommender):
             self.sess.run(self.discriminator.d_updates, feed_dict=feed)
 
     def training_generator(self):
-        for user, pos in self.user_pos_train.items():
-            sample_lambda = 0.2
-            rating = self.sess.run(self.generator.all_logits, {self.generator.u: user})
-            exp_rating = np.exp(rating)
-            prob = exp_rating / np.sum(exp_rating)  # prob is generator distribution p_\theta
+        sample_lambda = 0.2
+        for users in self.get_user_blocks():
+            rating = self.sess.run(self.generator.all_rating, {self.generator.u: users})
+            prob = softmax_rows(rating)  # prob is generator distribution p_\theta
 
+            pos = self.train_csr[users]
+            pos_len = pos.getnnz(axis=1)
             pn = (1 - sample_lambda) * prob
-            pn[pos] += sample_lambda * 1.0 / len(pos)
+            pos_rows = np.repeat(np.arange(len(users)), pos_len)
+            pn[pos_rows, pos.indices] += sample_lambda / pos_len[pos_rows]
             # Now, pn is the Pn in importance sampling, prob is generator distribution p_\theta
 
-            sample = np.random.choice(self.all_items, 2 * len(pos), p=pn)
+            rows, sample = sample_rows(pn, 2 * pos_len)
             ###########################################################################
             # Get reward and adapt it with importance sampling
             ###########################################################################
-            feed = {self.discriminator.u: user, self.discriminator.i: sample}
+            feed = {self.discriminator.u: users[rows], self.discriminator.i: sample}
             reward = self.sess.run(self.discriminator.reward, feed_dict=feed)
-            reward = reward * prob[sample] / pn[sample]
+            reward = reward * prob[rows, sample] / pn[rows, sample]
+            # average the rewards of each user, as a per-user update would
+            reward = reward / (2 * pos_len[rows])
             ###########################################################################
             # Update G
             ###########################################################################
-            feed = {self.generator.u: user, self.generator.i: sample, self.generator.reward: reward}
-            self.sess.run(self.generator.gan_updates, feed_dict=feed)
+            feed = {self.generator.u: users, self.generator.block_rows: rows,
+                    self.generator.block_items: sample, self.generator.reward: reward}
+            self.sess.run(self.generator.block_updates, feed_dict=feed)
+        self.invalidate_snapshot()
 
     def predict(self, user_id, items):
-        user_embedding, item_embedding, item_bias = self.sess.run(self.generator.g_params)
-        u_embedding = user_embedding[user_id]
-        item_embedding = item_embedding[items]
-        item_bias = item_bias[items]
+        return self.cached_snapshot().predict(user_id, items)
 
-        ratings = np.matmul(u_embedding, item_embedding.T) + item_bias
-        return ratings
+    def snapshot(self):
+        user_embedding, item_embedding, item_bias = self.sess.run(self.generator.g_params)
+        return EmbeddingSnapshot(self, user_embedding, item_embedding, item_bias)
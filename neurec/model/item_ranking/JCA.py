@@ -15,6 +15,7 @@ from time import time
 from neurec.util import learner,tool
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
+from neurec.util.scorer import UserBlockScorer
 
 class JCA(AbstractRecommender):
     properties = [
@@ -52,18 +53,21 @@ class JCA(AbstractRecommender):
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
 
-        self.train_R = self.dataset.trainMatrix.toarray()
-        self.U_OH_mat = np.eye(self.num_users, dtype=float)
-        self.I_OH_mat = np.eye(self.num_items, dtype=float)
+        # user rows and item rows (columns) of the binary rating matrix
+        self.train_csr = self.dataset.get_train_csr()
+        self.train_csc = self.train_csr.tocsc()
+        self.item_encoder = None
+        self.scorer = UserBlockScorer(self.predict_users, self.num_users, self.num_items)
         self.num_batch_U = int(self.num_users / float(self.batch_size)) + 1
         self.num_batch_I = int(self.num_items / float(self.batch_size)) + 1
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
-            # input rating vector
-            self.input_R_U = tf.placeholder(dtype=tf.float32, shape=[None, self.num_items], name="input_R_U")
-            self.input_R_I = tf.placeholder(dtype=tf.float32, shape=[self.num_users, None], name="input_R_I")
-            self.input_OH_I = tf.placeholder(dtype=tf.float32, shape=[None, self.num_items], name="input_OH_I")
+            # input rating vectors of the batch users and of the batch items
+            self.input_R_U = tf.sparse_placeholder(dtype=tf.float32, shape=[None, self.num_items], name="input_R_U")
+            self.input_R_I = tf.sparse_placeholder(dtype=tf.float32, shape=[None, self.num_users], name="input_R_I")
+            # hidden layer of the item component for all items, fed when scoring users
+            self.input_I_Encoder = tf.placeholder(dtype=tf.float32, shape=[None, self.hidden_neuron], name="input_I_Encoder")
             self.input_P_cor = tf.placeholder(dtype=tf.int32, shape=[None, 2], name="input_P_cor")
             self.input_N_cor = tf.placeholder(dtype=tf.int32, shape=[None, 2], name="input_N_cor")
 
@@ -109,14 +113,14 @@ class JCA(AbstractRecommender):
         with tf.name_scope("inference"):
 
             # user component
-            U_pre_Encoder = tf.matmul(self.input_R_U, self.UV) + self.Ub1  # input to the hidden layer
+            U_pre_Encoder = tf.sparse_tensor_dense_matmul(self.input_R_U, self.UV) + self.Ub1  # input to the hidden layer
             self.U_Encoder = tool.activation_function(self.g_act,U_pre_Encoder)  # output of the hidden layer
             U_pre_Decoder = tf.matmul(self.U_Encoder, self.UW) + self.Ub2  # input to the output layer
             self.U_Decoder = tool.activation_function(self.f_act,U_pre_Decoder)  # output of the output layer
 
             # item component
-            I_pre_mul = tf.transpose(tf.matmul(self.I_factor_vector, tf.transpose(self.input_OH_I)))
-            I_pre_Encoder = tf.matmul(tf.transpose(self.input_R_I), self.IV) + self.Ib1  # input to the hidden layer
+            I_pre_mul = tf.gather_nd(tf.transpose(self.I_factor_vector), self.col_idx)
+            I_pre_Encoder = tf.sparse_tensor_dense_matmul(self.input_R_I, self.IV) + self.Ib1  # input to the hidden layer
             self.I_Encoder = tool.activation_function(self.g_act,I_pre_Encoder * I_pre_mul)  # output of the hidden layer
             I_pre_Decoder = tf.matmul(self.I_Encoder, self.IW) + self.Ib2  # input to the output layer
             self.I_Decoder = tool.activation_function(self.f_act,I_pre_Decoder)  # output of the output layer
@@ -131,6 +135,14 @@ class JCA(AbstractRecommender):
             self.pre_cost1 = tf.maximum(neg_data - pos_data + self.margin,
                                    tf.zeros(tf.shape(neg_data)[0]))
 
+            # scores of the batch users for all items, with the item component
+            # decoded from input_I_Encoder only for the columns of these users
+            user_idx = tf.reshape(self.row_idx, [-1])
+            I_pre_Decoder_U = tf.matmul(self.input_I_Encoder, tf.gather(self.IW, user_idx, axis=1)) \
+                              + tf.gather(self.Ib2, user_idx, axis=1)
+            I_Decoder_U = tool.activation_function(self.f_act,I_pre_Decoder_U)  # (items, batch users)
+            self.user_ratings = (self.U_Decoder + tf.transpose(I_Decoder_U)) / 2.0
+
     def _create_loss(self):
         with tf.name_scope("loss"):
 
@@ -173,64 +185,80 @@ class JCA(AbstractRecommender):
                         col_idx = random_col_idx[(j * self.batch_size):((j + 1) * self.batch_size)]
 
                     p_input, n_input = self.pairwise_neg_sampling(row_idx, col_idx)
-                    input_tmp = self.train_R[row_idx, :]
-                    input_tmp = input_tmp[:, col_idx]
 
-                    input_R_U = self.train_R[row_idx, :]
-                    input_R_I = self.train_R[:, col_idx]
+                    input_R_U = self.train_csr[row_idx]
+                    input_R_I = self.train_csc[:, col_idx].T
                     _, loss = self.sess.run(  # do the optimization by the minibatch
                         [self.optimizer, self.cost],
                         feed_dict={
-                            self.input_R_U: input_R_U,
-                            self.input_R_I: input_R_I,
-                            self.input_OH_I: self.I_OH_mat[col_idx, :],
+                            self.input_R_U: tool.csr_to_sparse_tensor(input_R_U),
+                            self.input_R_I: tool.csr_to_sparse_tensor(input_R_I),
                             self.input_P_cor: p_input,
                             self.input_N_cor: n_input,
                             self.row_idx: np.reshape(row_idx, (len(row_idx), 1)),
                             self.col_idx: np.reshape(col_idx, (len(col_idx), 1))})
                 total_loss+=loss
+            self.invalidate_snapshot()
             self.logger.info("[iter %d : total_loss : %f, time: %f]" %(epoch+1,total_loss,time()-training_start_time))
             if epoch %self.verbose == 0:
-                self.eval_rating_matrix()
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def pairwise_neg_sampling(self,row_idx, col_idx):
-        R = self.train_R[row_idx, :]
-        R = R[:, col_idx]
-        p_input, n_input = [], []
-        obsv_list = np.where(R == 1)
-
-        unobsv_mat = []
-        for r in range(R.shape[0]):
-            unobsv_list = np.where(R[r, :] == 0)
-            unobsv_list = unobsv_list[0]
-            unobsv_mat.append(unobsv_list)
-
-        for i in range(len(obsv_list[1])):
-            # positive instance
-            u = obsv_list[0][i]
-            # negative instances
-            unobsv_list = unobsv_mat[u]
-            neg_samp_list = np.random.choice(unobsv_list, size=self.neg_sample_rate, replace=False)
-            for ns in neg_samp_list:
-                p_input.append([u, obsv_list[1][i]])
-                n_input.append([u, ns])
-        # self.logger.info('dataset size = ' + str(len(p_input)))
-        return np.array(p_input), np.array(n_input)
-
-    def eval_rating_matrix(self):
-        self.allRatings = self.sess.run(self.Decoder,
-            feed_dict={
-            self.input_R_U: self.train_R,
-            self.input_R_I: self.train_R,
-            self.input_OH_I: self.I_OH_mat,
-            self.input_P_cor: [[0, 0]],
-            self.input_N_cor: [[0, 0]],
-            self.row_idx: np.reshape(range(self.num_users), (self.num_users, 1)),
-            self.col_idx: np.reshape(range(self.num_items), (self.num_items, 1))})
+        # samples neg_sample_rate distinct unobserved columns of the batch for every
+        # observed entry, by rejection: draws hitting an observed entry or repeating
+        # a column of the same positive are drawn again
+        R = self.train_csr[row_idx][:, col_idx]
+        num_cols = R.shape[1]
+        num_neg = self.neg_sample_rate
+        # rows without enough unobserved columns cannot be sampled without replacement
+        R = R.multiply((num_cols - R.getnnz(axis=1) >= num_neg)[:, None]).tocsr()
+        R.eliminate_zeros()
+        rows, cols = R.nonzero()
+        observed = np.sort(rows.astype(np.int64) * num_cols + cols)
+
+        neg = np.zeros((len(rows), num_neg), dtype=np.int64)
+        redraw = np.ones(neg.shape, dtype=bool)
+        while redraw.any():
+            neg[redraw] = np.random.randint(num_cols, size=np.count_nonzero(redraw))
+            keys = rows[:, None].astype(np.int64) * num_cols + neg
+            hit = observed[np.minimum(np.searchsorted(observed, keys), len(observed) - 1)] == keys
+            order = np.argsort(neg, axis=1)
+            sorted_neg = np.take_along_axis(neg, order, axis=1)
+            repeated = np.zeros(neg.shape, dtype=bool)
+            np.put_along_axis(repeated, order[:, 1:], sorted_neg[:, 1:] == sorted_neg[:, :-1], axis=1)
+            redraw = hit | repeated
+
+        p_input = np.stack([np.repeat(rows, num_neg), np.repeat(cols, num_neg)], axis=1)
+        n_input = np.stack([np.repeat(rows, num_neg), neg.reshape(-1)], axis=1)
+        return p_input, n_input
+
+    def encode_items(self):
+        # hidden layer of the item component for all items, in batches of items
+        item_encoders = []
+        for start in range(0, self.num_items, self.batch_size):
+            col_idx = np.arange(start, min(start + self.batch_size, self.num_items))
+            item_encoders.append(self.sess.run(self.I_Encoder, feed_dict={
+                self.input_R_I: tool.csr_to_sparse_tensor(self.train_csc[:, col_idx].T),
+                self.col_idx: np.reshape(col_idx, (len(col_idx), 1))}))
+        return np.concatenate(item_encoders)
+
+    def invalidate_snapshot(self):
+        super().invalidate_snapshot()
+        self.item_encoder = None
+        self.scorer.reset()
+
+    def predict_users(self, user_ids):
+        if self.item_encoder is None:
+            self.item_encoder = self.encode_items()
+        return self.sess.run(self.user_ratings, feed_dict={
+            self.input_R_U: tool.csr_to_sparse_tensor(self.train_csr[user_ids]),
+            self.input_I_Encoder: self.item_encoder,
+            self.row_idx: np.reshape(user_ids, (len(user_ids), 1))})
 
     def predict(self, user_id, items):
-        return self.allRatings[user_id, items]
+        return self.scorer.predict(user_id, items)
 
     def l2_norm(self,tensor):
         return tf.sqrt(tf.reduce_sum(tf.square(tensor)))
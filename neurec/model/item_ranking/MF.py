@@ -10,13 +10,15 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import learner,data_gen
+from neurec.util import learner,data_gen,embedding
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 class MF(AbstractRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -45,6 +47,8 @@ class MF(AbstractRecommender):
         self.batch_size= self.conf["batch_size"]
         self.verbose= self.conf["verbose"]
         self.num_negatives= self.conf["num_neg"]
+        # number of NumPy worker processes training with Hogwild SGD (default 0, train with TensorFlow)
+        self.hogwild_workers = Properties().getProperty("hogwild_workers", 0)
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
 
@@ -58,15 +62,15 @@ class MF(AbstractRecommender):
                 self.lables = tf.placeholder(tf.float32, shape=[None,],name="labels")
     def _create_variables(self):
         with tf.name_scope("embedding"):
-            self.user_embeddings = tf.Variable(tf.random_normal(shape=[self.num_users, self.embedding_size], mean=0.0, stddev=0.01),
-                                                                name='user_embeddings', dtype=tf.float32)  #(users, embedding_size)
-            self.item_embeddings = tf.Variable(tf.random_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01),
-                                                                name='item_embeddings', dtype=tf.float32)  #(items, embedding_size)
+            initializer = tf.random_normal_initializer(mean=0.0, stddev=0.01)
+            self.user_embeddings = embedding.embedding_table('user_embeddings', [self.num_users, self.embedding_size], initializer)  #(users, embedding_size)
+            self.item_embeddings = embedding.embedding_table('item_embeddings', [self.num_items, self.embedding_size], initializer,
+                                                             counts=self.dataset.get_item_counts())  #(items, embedding_size)
     def _create_inference(self, item_input):
         with tf.name_scope("inference"):
             # embedding look up
-            user_embedding = tf.nn.embedding_lookup(self.user_embeddings, self.user_input)
-            item_embedding = tf.nn.embedding_lookup(self.item_embeddings, item_input)
+            user_embedding = embedding.lookup(self.user_embeddings, self.user_input)
+            item_embedding = embedding.lookup(self.item_embeddings, item_input)
             predict = tf.reduce_sum(tf.multiply(user_embedding, item_embedding),1)
             return user_embedding, item_embedding, predict
 
@@ -93,8 +97,21 @@ class MF(AbstractRecommender):
         self._create_variables()
         self._create_loss()
         self._create_optimizer()
+        self._create_steps()
+
+    def _create_steps(self):
+        if self.ispairwise == True:
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.item_input_neg])
+        else :
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.lables])
+        self.score_step = self.make_step(self.output, [self.user_input, self.item_input])
 #---------- training process -------
     def train_model(self):
+        if self.hogwild_workers > 0:
+            self._train_hogwild()
+            return
 
         for epoch in  range(self.num_epochs):
             # Generate training instances
@@ -111,22 +128,48 @@ class MF(AbstractRecommender):
                     bat_users,bat_items_pos,bat_items_neg =\
                      data_gen._get_pairwise_batch_data(user_input,\
                      item_input_pos, item_input_neg, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users,self.item_input:bat_items_pos,\
-                                self.item_input_neg:bat_items_neg}
+                    loss,_ = self.train_step(bat_users, bat_items_pos, bat_items_neg)
                 else:
                     bat_users, bat_items,bat_lables =\
                      data_gen._get_pointwise_batch_data(user_input, \
                      item_input, lables, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users, self.item_input:bat_items,
-                                 self.lables:bat_lables}
-
-                loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
+                    loss,_ = self.train_step(bat_users, bat_items, bat_lables)
                 total_loss+=loss
-            self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
+            training_time = time()-training_start_time
+            self.logger.info("[iter %d : loss : %f, time: %f, %.1f steps/sec]" %(epoch+1,total_loss/num_training_instances,training_time,
+                             int(num_training_instances/self.batch_size)/training_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-                #Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
+
+    def _train_hogwild(self):
+        # the factors are trained by lock-free NumPy SGD in worker processes, and
+        # loaded into the variables after every epoch for evaluation
+        if self.ispairwise != True or self.loss_function.lower() != "bpr":
+            raise ValueError("hogwild_workers requires ispairwise=true and loss_function=bpr")
+        # imported here, the shared memory it needs is only available from Python 3.8
+        from neurec.util.hogwild import HogwildTrainer
+        variables = [self.user_embeddings, self.item_embeddings]
+        if any(embedding.is_compressed(variable) for variable in variables):
+            raise ValueError("hogwild_workers requires uncompressed embedding tables")
+        with HogwildTrainer(embedding.get_values(self.sess, variables), [(0, 0, 1)], self.hogwild_workers,
+                            self.learning_rate, self.reg_mf) as trainer:
+            for epoch in range(self.num_epochs):
+                user_input, item_input_pos, item_input_neg = data_gen._get_pairwise_all_data(self.dataset)
+                training_start_time = time()
+                total_loss = trainer.train_epoch(self.batch_size, [user_input], item_input_pos, item_input_neg)
+                trainer.load_into(variables, self.sess)
+                self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/len(user_input),time()-training_start_time))
+                if epoch %self.verbose == 0:
+                    if self.controller.evaluate(epoch):
+                        break
+        self.controller.finish()
 
     def predict(self, user_id, items):
         users = np.full(len(items), user_id, dtype=np.int32)
-        return self.sess.run(self.output, feed_dict={self.user_input: users, self.item_input: items})
+        return self.score_step(users, items)
+
+    def snapshot(self):
+        user_embeddings, item_embeddings = embedding.get_values(self.sess, [self.user_embeddings, self.item_embeddings])
+        return EmbeddingSnapshot(self, user_embeddings, item_embeddings)
@@ -12,10 +12,11 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import data_gen, learner
+from neurec.util import data_gen, learner, embedding
 from neurec.evaluation import Evaluate
 
 class MLP(AbstractRecommender):
+    data_parallel = True
     properties = [
         "layers",
         "learning_rate",
@@ -61,15 +62,16 @@ class MLP(AbstractRecommender):
 
     def _create_variables(self):
         with tf.name_scope("embedding"):  # The embedding initialization is unknown now
-            self.mlp_embedding_user = tf.Variable(tf.random_normal(shape = [self.num_users,\
-             int(self.layers[0]/2)],mean=0.0,stddev=0.01),name = "mlp_embedding_user",dtype=tf.float32)
-            self.mlp_embedding_item = tf.Variable(tf.random_normal(shape = [self.num_items,\
-             int(self.layers[0]/2)],mean=0.0,stddev=0.01),name = "mlp_embedding_item",dtype=tf.float32)
+            initializer = tf.random_normal_initializer(mean=0.0,stddev=0.01)
+            self.mlp_embedding_user = embedding.embedding_table("mlp_embedding_user",\
+             [self.num_users,int(self.layers[0]/2)],initializer)
+            self.mlp_embedding_item = embedding.embedding_table("mlp_embedding_item",\
+             [self.num_items,int(self.layers[0]/2)],initializer,counts=self.dataset.get_item_counts())
     def _create_inference(self,item_input):
         with tf.name_scope("inference"):
             # Crucial to flatten an embedding vector!
-            mlp_user_latent = tf.nn.embedding_lookup(self.mlp_embedding_user,self.user_input)
-            mlp_item_latent = tf.nn.embedding_lookup(self.mlp_embedding_item,item_input)
+            mlp_user_latent = embedding.lookup(self.mlp_embedding_user,self.user_input)
+            mlp_item_latent = embedding.lookup(self.mlp_embedding_item,item_input)
             # The 0-th layer is the concatenation of embedding layers
             mlp_vector = tf.concat([mlp_user_latent, mlp_item_latent],axis=1)
             # MLP layers
@@ -133,7 +135,9 @@ class MLP(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
         users = np.full(len(items), user_id, dtype=np.int32)
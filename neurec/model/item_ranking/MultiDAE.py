@@ -10,6 +10,7 @@ from tensorflow.contrib.layers import apply_regularization, l2_regularizer
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.util.properties import Properties
+from neurec.util.scorer import UserBlockScorer
 
 class MultiDAE(AbstractRecommender):
     properties = [
@@ -33,6 +34,7 @@ class MultiDAE(AbstractRecommender):
         self.batch_size= self.conf["batch_size"]
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
+        self.scorer = UserBlockScorer(self.predict_users, self.num_users, self.num_items)
         self.p_dims = self.conf["p_dim"] + [self.num_items]
         self.q_dims = self.p_dims[::-1]
         self.dims = self.q_dims + self.p_dims[1:]
@@ -44,7 +46,7 @@ class MultiDAE(AbstractRecommender):
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
-            self.input_ph = tf.placeholder(dtype=tf.float32, shape=[None, self.num_items])
+            self.input_ph = tf.sparse_placeholder(dtype=tf.float32, shape=[None, self.num_items])
             self.keep_prob_ph = tf.placeholder_with_default(1.0, shape=None)
 
     def _create_variables(self):
@@ -69,11 +71,14 @@ class MultiDAE(AbstractRecommender):
     def _create_inference(self):
         with tf.name_scope("inference"):
             # construct forward graph
-            self.h = tf.nn.l2_normalize(self.input_ph, 1)
-            self.h = tf.nn.dropout(self.h, self.keep_prob_ph)
+            h = tool.sparse_l2_normalize(self.input_ph)
+            h = tool.sparse_dropout(h, self.keep_prob_ph)
 
             for i, (w, b) in enumerate(zip(self.weights, self.biases)):
-                self.h = tf.matmul(self.h, w) + b
+                if i == 0:
+                    self.h = tf.sparse_tensor_dense_matmul(h, w) + b
+                else:
+                    self.h = tf.matmul(self.h, w) + b
 
                 if i != len(self.weights) - 1:
                     self.h = tool.activation_function(self.act, self.h)
@@ -83,8 +88,9 @@ class MultiDAE(AbstractRecommender):
     def _create_loss(self):
         with tf.name_scope("loss"):
             # per-user average negative log-likelihood
-            neg_ll = -tf.reduce_mean(tf.reduce_sum(
-            self.log_softmax_var * self.input_ph, axis=1))
+            # only the non-zero inputs contribute to the likelihood
+            neg_ll = -tf.reduce_sum(tf.gather_nd(self.log_softmax_var, self.input_ph.indices) *
+            self.input_ph.values) / tf.cast(tf.shape(self.log_softmax_var)[0], tf.float32)
             # apply regularization to weights
             regularization = l2_regularizer(self.reg)
             reg_var = apply_regularization(regularization, self.weights)
@@ -104,7 +110,7 @@ class MultiDAE(AbstractRecommender):
         self._create_optimizer()
 
     def train_model(self):
-
+        train_matrix = self.dataset.get_train_csr()
         for epoch in  range(self.num_epochs):
             random_perm_doc_idx = np.random.permutation(self.num_users)
             self.total_batch = self.num_users
@@ -117,28 +123,25 @@ class MultiDAE(AbstractRecommender):
                 elif num_batch < self.total_batch - 1:
                     batch_set_idx = random_perm_doc_idx[num_batch * self.batch_size: (num_batch + 1) * self.batch_size]
 
-                batch_matrix = np.zeros((len(batch_set_idx),self.num_items))
-
-                batch_uid = 0
-                trainDict = self.dataset.trainDict
-                for userid in batch_set_idx:
-                    items_by_userid = trainDict[userid]
-                    for itemid in items_by_userid:
-                        batch_matrix[batch_uid,itemid] = 1
-
-                    batch_uid=batch_uid+1
+                batch_matrix = train_matrix[batch_set_idx]
 
-                feed_dict = feed_dict={self.input_ph: batch_matrix,self.keep_prob_ph: 0.5}
+                feed_dict = {self.input_ph: tool.csr_to_sparse_tensor(batch_matrix),self.keep_prob_ph: 0.5}
                 _, loss = self.sess.run([self.optimizer, self.loss],feed_dict=feed_dict)
                 total_loss+=loss
+            self.invalidate_snapshot()
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
+
+    def invalidate_snapshot(self):
+        super().invalidate_snapshot()
+        self.scorer.reset()
+
+    def predict_users(self, user_ids):
+        rating_matrix = self.dataset.get_train_csr()[user_ids]
+        return self.sess.run(self.h, feed_dict={self.input_ph: tool.csr_to_sparse_tensor(rating_matrix)})
 
     def predict(self, user_id, items):
-        rating_matrix = np.zeros((1,self.num_items), dtype=np.int32)
-        items_by_userid = self.dataset.trainDict[user_id]
-        for itemid in items_by_userid:
-            rating_matrix[0,itemid] = 1
-        output = self.sess.run(self.h, feed_dict={self.input_ph:rating_matrix})
-        return output[0,items]
+        return self.scorer.predict(user_id, items)
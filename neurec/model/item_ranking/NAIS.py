@@ -18,6 +18,10 @@ from neurec.util import data_gen,learner
 from neurec.util.properties import Properties
 
 class NAIS(AbstractRecommender):
+    data_parallel = True
+    # candidate-history pairs scored per session run in predict
+    history_chunk_size = 1 << 20
+
     properties = [
         "pretrain",
         "verbose",
@@ -152,6 +156,7 @@ class NAIS(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_history_inference()
         self._create_optimizer()
 
     def _attention_MLP(self, q_,embedding_q_,num_idx):
@@ -161,12 +166,7 @@ class NAIS(AbstractRecommender):
                 r = (self.algorithm + 1)*self.embedding_size
 
                 MLP_output = tf.matmul(tf.reshape(q_,[-1,r]), self.W) + self.b #(b*n, e or 2*e) * (e or 2*e, w) + (1, w)
-                if self.activation == 0:
-                    MLP_output = tf.nn.relu( MLP_output )
-                elif self.activation == 1:
-                    MLP_output = tf.nn.sigmoid( MLP_output )
-                elif self.activation == 2:
-                    MLP_output = tf.nn.tanh( MLP_output )
+                MLP_output = self._attention_activation(MLP_output)
 
                 A_ = tf.reshape(tf.matmul(MLP_output, self.h),[b,n]) #(b*n, w) * (w, 1) => (None, 1) => (b, n)
 
@@ -181,6 +181,48 @@ class NAIS(AbstractRecommender):
 
                 return tf.reduce_sum(A * embedding_q_, 1)
 
+    def _attention_activation(self, MLP_output):
+        if self.activation == 0:
+            MLP_output = tf.nn.relu( MLP_output )
+        elif self.activation == 1:
+            MLP_output = tf.nn.sigmoid( MLP_output )
+        elif self.activation == 2:
+            MLP_output = tf.nn.tanh( MLP_output )
+        return MLP_output
+
+    def _create_history_inference(self):
+        # Scores many candidates of one user: the history is embedded once and the
+        # attention of every candidate in item_input is computed over that shared
+        # (n, e) tensor instead of an (m, n) matrix of repeated history indices.
+        with tf.name_scope("history_inference"):
+            self.history_input = tf.placeholder(tf.int32, shape=[None,], name = "history_input")
+            embedding_h = tf.nn.embedding_lookup(self.embedding_Q_, self.history_input) # (n, e)
+            embedding_q = tf.nn.embedding_lookup(self.embedding_Q, self.item_input) # (m, e)
+            m = tf.shape(embedding_q)[0]
+            n = tf.shape(embedding_h)[0]
+
+            with tf.name_scope("attention_MLP"):
+                if self.algorithm == 0:
+                    q_ = tf.expand_dims(embedding_q, 1) * tf.expand_dims(embedding_h, 0) # (m, n, e)
+                    MLP_output = tf.reshape(tf.matmul(tf.reshape(q_, [-1, self.embedding_size]), self.W),
+                                            tf.stack([m, n, self.weight_size]))
+                else:
+                    # [h, q] * W = h * W_h + q * W_q, so the history half is projected once
+                    W_h, W_q = tf.split(self.W, 2, axis=0)
+                    MLP_output = tf.expand_dims(tf.matmul(embedding_h, W_h), 0) + \
+                                 tf.expand_dims(tf.matmul(embedding_q, W_q), 1) # (m, n, w)
+                MLP_output = self._attention_activation(MLP_output + self.b)
+
+                A_ = tf.squeeze(tf.tensordot(MLP_output, self.h, 1), 2) # (m, n)
+                exp_A_ = tf.exp(A_)
+                exp_sum = tf.reduce_sum(exp_A_, 1, keepdims=True) # (m, 1)
+                exp_sum = tf.pow(exp_sum, tf.constant(self.beta, tf.float32))
+                embedding_p = tf.matmul(tf.div(exp_A_, exp_sum), embedding_h) # (m, e)
+
+            bias_i = tf.nn.embedding_lookup(self.bias, self.item_input)
+            coeff = tf.pow(tf.cast(n, tf.float32), tf.constant(self.alpha, tf.float32))
+            self.history_output = coeff * tf.reduce_sum(embedding_p * embedding_q, 1) + bias_i
+
     def train_model(self):
 
         for epoch in  range(self.num_epochs):
@@ -214,16 +256,15 @@ class NAIS(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id,items):
         cand_items = self.dataset.trainDict[user_id]
-        num_idx = len(cand_items)
-        # Get prediction scores
-        item_idx = np.full(len(items), num_idx, dtype=np.int32)
-        user_input = []
-        for _ in range(len(items)):
-            user_input.append(cand_items)
-        feed_dict = {self.user_input: np.array(user_input), \
-                     self.num_idx: item_idx, self.item_input:items}
-        return self.sess.run((self.output), feed_dict=feed_dict)
+        items = np.asarray(items, dtype=np.int32)
+        chunk_size = max(1, self.history_chunk_size // max(len(cand_items), 1))
+        outputs = [self.sess.run(self.history_output, feed_dict={self.history_input: cand_items,
+                                                                  self.item_input: items[start:start + chunk_size]})
+                   for start in range(0, len(items), chunk_size)]
+        return np.concatenate(outputs) if outputs else np.zeros(0, dtype=np.float32)
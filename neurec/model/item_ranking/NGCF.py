@@ -11,8 +11,12 @@ from neurec.util import data_gen
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
+from neurec.util.cache import cached_sparse_matrix
+from neurec.util import parallel, embedding
 
 class NGCF(AbstractRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "learner",
@@ -45,13 +49,15 @@ class NGCF(AbstractRecommender):
         self.node_dropout_flag = self.conf["node_dropout_flag"]
         self.adj_type = self.conf["adj_type"]
         self.alg_type = self.conf["alg_type"]
-        self.n_fold = 100
+        # memory budget in MB of one adjacency fold and of its propagated embeddings
+        self.fold_memory = Properties().getProperty("fold_memory", 256)
         self.verbose=self.conf["verbose"]
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
-        self.graph = self.dataset.trainMatrix.toarray()
-        self.norm_adj= self.get_adj_mat()
-        self.n_nonzero_elems = self.norm_adj.count_nonzero()
+        self.norm_adj = cached_sparse_matrix(self.dataset, "ngcf_adj_%s" % self.adj_type, self.get_adj_mat)
+        self.n_nonzero_elems = self.norm_adj.nnz
+        self.n_fold = self._get_n_fold()
+        self.logger.info("split the adjacency matrix into %d folds" % self.n_fold)
         self.pretrain_data = None
 
     def _create_placeholders(self):
@@ -127,7 +133,7 @@ class NGCF(AbstractRecommender):
             self.loss = mf_loss + emb_loss + reg_loss
     def _create_optimizer(self):
         with tf.name_scope("learner"):
-            self.optimizer=tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.loss)
+            self.optimizer=parallel.minimize(tf.train.AdamOptimizer(learning_rate=self.learning_rate), self.loss)
 
     def build_graph(self):
         self._create_placeholders()
@@ -155,14 +161,21 @@ class NGCF(AbstractRecommender):
 
                 loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
                 total_loss+=loss
+            self.invalidate_snapshot()
 
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
-        users = np.full(len(items), user_id, dtype=np.int32)
-        return self.sess.run(self.pos_scores, feed_dict={self.users: users, self.pos_items: items})
+        return self.cached_snapshot().predict(user_id, items)
+
+    def snapshot(self):
+        # propagates over the adjacency folds once for all users and items
+        ua_embeddings, ia_embeddings = self.sess.run([self.ua_embeddings, self.ia_embeddings])
+        return EmbeddingSnapshot(self, ua_embeddings, ia_embeddings)
 
     def _create_ngcf_embed(self):
         # Generate a set of adjacency sub-matrix.
@@ -172,7 +185,7 @@ class NGCF(AbstractRecommender):
         else:
             A_fold_hat = self._split_A_hat(self.norm_adj)
 
-        ego_embeddings = tf.concat([self.weights['user_embedding'], self.weights['item_embedding']], axis=0)
+        ego_embeddings = tf.concat([embedding.as_tensor(self.weights['user_embedding']), embedding.as_tensor(self.weights['item_embedding'])], axis=0)
 
         all_embeddings = [ego_embeddings]
 
@@ -211,7 +224,7 @@ class NGCF(AbstractRecommender):
 
     def _create_gcn_embed(self):
         A_fold_hat = self._split_A_hat(self.norm_adj)
-        embeddings = tf.concat([self.weights['user_embedding'], self.weights['item_embedding']], axis=0)
+        embeddings = tf.concat([embedding.as_tensor(self.weights['user_embedding']), embedding.as_tensor(self.weights['item_embedding'])], axis=0)
 
 
         all_embeddings = [embeddings]
@@ -234,7 +247,7 @@ class NGCF(AbstractRecommender):
     def _create_gcmc_embed(self):
         A_fold_hat = self._split_A_hat(self.norm_adj)
 
-        embeddings = tf.concat([self.weights['user_embedding'], self.weights['item_embedding']], axis=0)
+        embeddings = tf.concat([embedding.as_tensor(self.weights['user_embedding']), embedding.as_tensor(self.weights['item_embedding'])], axis=0)
 
         all_embeddings = []
 
@@ -261,15 +274,16 @@ class NGCF(AbstractRecommender):
         initializer = tf.contrib.layers.xavier_initializer()
 
         if self.pretrain_data is None:
-            all_weights['user_embedding'] = tf.Variable(initializer([self.num_users, self.emb_dim]), name='user_embedding')
-            all_weights['item_embedding'] = tf.Variable(initializer([self.num_items, self.emb_dim]), name='item_embedding')
+            # the same xavier initialization, scaled by the full shape of partitioned tables
+            user_initializer = item_initializer = tf.glorot_uniform_initializer()
             self.logger.info('using xavier initialization')
         else:
-            all_weights['user_embedding'] = tf.Variable(initial_value=self.pretrain_data['user_embed'], trainable=True,
-                                                        name='user_embedding', dtype=tf.float32)
-            all_weights['item_embedding'] = tf.Variable(initial_value=self.pretrain_data['item_embed'], trainable=True,
-                                                        name='item_embedding', dtype=tf.float32)
+            user_initializer = self.pretrain_data['user_embed']
+            item_initializer = self.pretrain_data['item_embed']
             self.logger.info('using pretrained initialization')
+        all_weights['user_embedding'] = embedding.embedding_table('user_embedding', [self.num_users, self.emb_dim], user_initializer)
+        all_weights['item_embedding'] = embedding.embedding_table('item_embedding', [self.num_items, self.emb_dim], item_initializer,
+                                                                  counts=self.dataset.get_item_counts())
 
         self.weight_size_list = [self.emb_dim] + self.weight_size
 
@@ -292,21 +306,18 @@ class NGCF(AbstractRecommender):
         return all_weights
 
     def normalized_adj_single(self,adj):
-        rowsum = np.array(adj.sum(1))
+        rowsum = np.asarray(adj.sum(1)).ravel()
 
-        d_inv = np.power(rowsum, -1).flatten()
-        d_inv[np.isinf(d_inv)] = 0.
-        d_mat_inv = sp.diags(d_inv)
-        norm_adj = d_mat_inv.dot(adj)
-        # norm_adj = adj.dot(d_mat_inv)
+        d_inv = np.zeros_like(rowsum)
+        np.divide(1., rowsum, out=d_inv, where=rowsum != 0)
+        norm_adj = sp.diags(d_inv).dot(adj)
         self.logger.info('generate single-normalized adjacency matrix.')
-        return norm_adj.tocoo()
+        return norm_adj.tocsr()
     def get_adj_mat(self):
-        A = sp.dok_matrix((self.num_users + self.num_items, self.num_users + self.num_items), dtype=np.float32)
-        A = A.tolil()
-        A[:self.num_users, self.num_users:] = self.graph
-        A[self.num_users:, :self.num_users] = self.graph.transpose()
-        A = A.todok()
+        # bipartite adjacency [[0, R], [R^T, 0]] assembled from the sparse rating matrix
+        R = self.dataset.trainMatrix.tocsr().astype(np.float32)
+        R.eliminate_zeros()
+        A = sp.bmat([[None, R], [R.T, None]], format='csr')
         if self.adj_type== 'plain':
             adj_mat = A
             self.logger.info('use the plain adjacency matrix')
@@ -320,37 +331,36 @@ class NGCF(AbstractRecommender):
             adj_mat = self.normalized_adj_single(A) + sp.eye(A.shape[0])
             self.logger.info('use the mean adjacency matrix')
 
-        return adj_mat.tocsr()
+        return adj_mat.astype(np.float32).tocsr()
+
+    def _get_n_fold(self):
+        # a fold holds its nonzeros as int64 indices and float32 values, and its
+        # product with the embeddings as a dense float32 block
+        n_nodes = self.num_users + self.num_items
+        width = max([self.emb_dim] + self.weight_size)
+        fold_bytes = self.n_nonzero_elems * 20 + n_nodes * width * 4
+        n_fold = int(np.ceil(fold_bytes / (self.fold_memory * 2.0**20)))
+        return min(max(n_fold, 1), n_nodes)
+
+    def _get_fold_bounds(self):
+        return np.linspace(0, self.num_users + self.num_items, self.n_fold + 1).astype(np.int64)
 
     def _split_A_hat(self, X):
         A_fold_hat = []
 
-        fold_len = (self.num_users + self.num_items) // self.n_fold
-        for i_fold in range(self.n_fold):
-            start = i_fold * fold_len
-            if i_fold == self.n_fold -1:
-                end = self.num_users + self.num_items
-            else:
-                end = (i_fold + 1) * fold_len
-
+        bounds = self._get_fold_bounds()
+        for start, end in zip(bounds[:-1], bounds[1:]):
             A_fold_hat.append(self._convert_sp_mat_to_sp_tensor(X[start:end]))
         return A_fold_hat
 
     def _split_A_hat_node_dropout(self, X):
         A_fold_hat = []
 
-        fold_len = (self.num_users + self.num_items) // self.n_fold
-        for i_fold in range(self.n_fold):
-            start = i_fold * fold_len
-            if i_fold == self.n_fold -1:
-                end = self.num_users + self.num_items
-            else:
-                end = (i_fold + 1) * fold_len
-
-            # A_fold_hat.append(self._convert_sp_mat_to_sp_tensor(X[start:end]))
-            temp = self._convert_sp_mat_to_sp_tensor(X[start:end])
-            n_nonzero_temp = X[start:end].count_nonzero()
-            A_fold_hat.append(self._dropout_sparse(temp, 1 - self.node_dropout[0], n_nonzero_temp))
+        bounds = self._get_fold_bounds()
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            fold = X[start:end]
+            temp = self._convert_sp_mat_to_sp_tensor(fold)
+            A_fold_hat.append(self._dropout_sparse(temp, 1 - self.node_dropout[0], fold.nnz))
         return A_fold_hat
 
     def _dropout_sparse(self, X, keep_prob, n_nonzero_elems):
@@ -367,5 +377,5 @@ class NGCF(AbstractRecommender):
 
     def _convert_sp_mat_to_sp_tensor(self, X):
         coo = X.tocoo().astype(np.float32)
-        indices = np.mat([coo.row, coo.col]).transpose()
+        indices = np.stack([coo.row, coo.col], axis=1).astype(np.int64)
         return tf.SparseTensor(indices, coo.data, coo.shape)
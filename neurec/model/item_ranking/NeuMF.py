@@ -11,11 +11,12 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import data_gen,learner
+from neurec.util import data_gen,learner,embedding
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 
 class NeuMF(AbstractRecommender):
+    data_parallel = True
     properties = [
         "embedding_size",
         "layers",
@@ -67,22 +68,24 @@ class NeuMF(AbstractRecommender):
 
     def _create_variables(self):
         with tf.name_scope("embedding"):  # The embedding initialization is unknown now
-            self.mf_embedding_user = tf.Variable(tf.random_normal(shape=[self.num_users,self.embedding_size],\
-                mean=0.0,stddev=0.01),name = 'mf_embedding_user',dtype=tf.float32)
-            self.mf_embedding_item = tf.Variable(tf.random_normal(shape=[self.num_items,self.embedding_size],\
-                mean=0.0,stddev=0.01),name = 'mf_embedding_item',dtype=tf.float32)
-            self.mlp_embedding_user = tf.Variable(tf.random_normal(shape = [self.num_users,\
-             int(self.layers[0]/2)],mean=0.0,stddev=0.01),name = "mlp_embedding_user",dtype=tf.float32)
-            self.mlp_embedding_item = tf.Variable(tf.random_normal(shape = [self.num_items,\
-             int(self.layers[0]/2)],mean=0.0,stddev=0.01),name = "mlp_embedding_item",dtype=tf.float32)
+            initializer = tf.random_normal_initializer(mean=0.0,stddev=0.01)
+            item_counts = self.dataset.get_item_counts()
+            self.mf_embedding_user = embedding.embedding_table('mf_embedding_user',\
+                [self.num_users,self.embedding_size],initializer)
+            self.mf_embedding_item = embedding.embedding_table('mf_embedding_item',\
+                [self.num_items,self.embedding_size],initializer,counts=item_counts)
+            self.mlp_embedding_user = embedding.embedding_table("mlp_embedding_user",\
+             [self.num_users,int(self.layers[0]/2)],initializer)
+            self.mlp_embedding_item = embedding.embedding_table("mlp_embedding_item",\
+             [self.num_items,int(self.layers[0]/2)],initializer,counts=item_counts)
 
     def _create_inference(self,item_input):
         with tf.name_scope("inference"):
 
-            mf_user_latent = tf.nn.embedding_lookup(self.mf_embedding_user,self.user_input)
-            mf_item_latent = tf.nn.embedding_lookup(self.mf_embedding_item,item_input)
-            mlp_user_latent = tf.nn.embedding_lookup(self.mlp_embedding_user,self.user_input)
-            mlp_item_latent = tf.nn.embedding_lookup(self.mlp_embedding_item,item_input)
+            mf_user_latent = embedding.lookup(self.mf_embedding_user,self.user_input)
+            mf_item_latent = embedding.lookup(self.mf_embedding_item,item_input)
+            mlp_user_latent = embedding.lookup(self.mlp_embedding_user,self.user_input)
+            mlp_item_latent = embedding.lookup(self.mlp_embedding_item,item_input)
 
             mf_vector = tf.multiply(mf_user_latent, mf_item_latent)# element-wise multiply
 
@@ -149,7 +152,9 @@ class NeuMF(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
         users = np.full(len(items), user_id, dtype=np.int32)
@@ -16,19 +16,8 @@ from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 import logging
 from neurec.util.properties import Properties
+from neurec.util.hashing import HashedIds
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-def random_choice(a, size=None, replace=True, p=None, exclusion=None):
-    # TODO exclusion is element, not the index
-    if exclusion is not None:
-        if p is None:
-            p = np.ones_like(a)
-        else:
-            p = np.array(p, copy=True)
-        p = np.ndarray.flatten(p)
-        p[exclusion] = 0
-        p = p / np.sum(p)
-    sample = np.random.choice(a, size=size, replace=replace, p=p)
-    return sample
 
 class SBPR(AbstractRecommender):
     properties = [
@@ -39,6 +28,7 @@ class SBPR(AbstractRecommender):
         "loss_function",
         "topk",
         "num_epochs",
+        "reg_mf",
         "batch_size",
         "verbose"
     ]
@@ -60,41 +50,44 @@ class SBPR(AbstractRecommender):
         self.num_items = self.dataset.num_items
         self.userids = self.dataset.userids
         self.dataset_name = self.dataset.dataset_name
-        self.userouterids = self.userids.keys()
-        trainMatrix = self.dataset.trainMatrix.tocsr()
-        self.train_dict = {u: set(pos_item.indices) for u, pos_item in enumerate(trainMatrix)}
+        self.train_csr = self.dataset.get_train_csr()
         self.socialMatrix=self._get_social_data()
-        self.userSocialItemsSetList = self._get_SocialItemsSet_sun()
+        self.socialItems = self._get_social_items()
 
     def _get_social_data(self):
-        social_users = np.genfromtxt(self.socialpath, dtype=None, names=["user0", "user1"], delimiter=',')
-        users_key = np.array(list(self.userids.keys()))
-        user0 = social_users["user0"].astype(np.str)
-        index = np.in1d(user0, users_key)
-        social_users = social_users[index]
-
-        user1 = social_users["user1"].astype(np.str)
-        index = np.in1d(user1, users_key)
-        social_users = social_users[index]
-
-        user0 = social_users["user0"].astype(np.str)
-        user0_id = [self.userids[u] for u in user0]
-        user1 = social_users["user1"].astype(np.str)
-        user1_id = [self.userids[u] for u in user1]
-        social_matrix = sp.csr_matrix(([1]*len(user0_id), (user0_id, user1_id)),
+        social_users = np.genfromtxt(self.socialpath, dtype=str, delimiter=',', autostrip=True, ndmin=2)
+        if isinstance(self.userids, HashedIds):
+            user0_id = self.userids.get_buckets(social_users[:, 0])
+            user1_id = self.userids.get_buckets(social_users[:, 1])
+            return self._get_social_matrix(user0_id, user1_id)
+
+        # maps the outer user ids of both columns to inner ids with a sorted lookup
+        users_key = np.array(list(self.userids.keys()), dtype=str)
+        users_id = np.array(list(self.userids.values()), dtype=np.int32)
+        order = np.argsort(users_key)
+        users_key, users_id = users_key[order], users_id[order]
+        position = np.minimum(np.searchsorted(users_key, social_users[:, :2]), len(users_key) - 1)
+        known = np.all(users_key[position] == social_users[:, :2], axis=1)
+        user0_id, user1_id = users_id[position[known]].T
+        return self._get_social_matrix(user0_id, user1_id)
+
+    def _get_social_matrix(self, user0_id, user1_id):
+        social_matrix = sp.csr_matrix((np.ones(len(user0_id), dtype=np.float32), (user0_id, user1_id)),
                                       shape=(self.num_users, self.num_users))
+        social_matrix.sum_duplicates()
+        social_matrix.data[:] = 1
         return social_matrix
 
-    def _get_SocialItemsSet_sun(self):
-        #find items rated by trusted neighbors only
-        userSocialItemsSetList = {}
-        for u, _ in self.train_dict.items():
-            trustors = self.socialMatrix[u].indices
-            items = [item for f_u in trustors for item in self.train_dict[f_u] if item not in self.train_dict[u]]
-            items = set(items)
-            if len(items) > 0:
-                userSocialItemsSetList[u] = list(items)
-        return userSocialItemsSetList
+    def _get_social_items(self):
+        """Returns the items rated by trusted neighbors only, with the number of
+        neighbors who rated them, as a users x items csr_matrix."""
+        # (S R)[u, k] counts the trusted neighbors of u who rated k
+        social_counts = self.socialMatrix.dot(self.train_csr).tocsr()
+        social_items = social_counts - social_counts.multiply(self.train_csr)
+        social_items = social_items.tocsr()
+        social_items.eliminate_zeros()
+        social_items.sort_indices()
+        return social_items
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
@@ -143,7 +136,7 @@ class SBPR(AbstractRecommender):
         for epoch in range(self.num_epochs):
             # Generate training instances
 #             logging.info("get training data")
-            user_input, item_input_pos,item_input_social,item_input_neg,suk_input = self._get_pairwise_all_data_sun()
+            user_input, item_input_pos,item_input_social,item_input_neg,suk_input = self._get_pairwise_all_data()
 #             logging.info("begin training")
             total_loss = 0.0
             training_start_time = time()
@@ -168,88 +161,43 @@ class SBPR(AbstractRecommender):
                 total_loss+=loss
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def _get_pairwise_all_data(self):
-        user_input, item_input_pos,item_input_social,item_input_neg,suk_input = [],[],[],[],[]
-        trainMatrix = self.dataset.trainMatrix
-        num_items = self.dataset.num_items
-        for (u, i) in trainMatrix.keys():
-            if u in self.userSocialItemsSetList:
-                user_input.append(u)
-                item_input_pos.append(i)
-                socialItemsList = self.userSocialItemsSetList[u]
-                j = np.random.randint(num_items)
-                while (u, j) in trainMatrix.keys() or j in socialItemsList:
-                    j = np.random.randint(num_items)
-                item_input_neg.append(j)
-                k = np.random.choice(socialItemsList)
-                item_input_social.append(k)
-                trustorIndices = self.socialMatrix[u].indices
-                socialWeight = 0
-                for trustedUserIdx in trustorIndices:
-                    indices = trainMatrix[trustedUserIdx].tocsr().indices
-                    if k in indices:
-                        socialWeight += 1
-                suk_input.append(socialWeight+1)
-        user_input = np.array(user_input, dtype=np.int32)
-        item_input_pos = np.array(item_input_pos, dtype=np.int32)
-        item_input_social = np.array(item_input_social, dtype=np.int32)
-        item_input_neg = np.array(item_input_neg, dtype=np.int32)
-        suk_input = np.array(suk_input, dtype=np.float32)
-        num_training_instances = len(user_input)
-        shuffle_index = np.arange(num_training_instances,dtype=np.int32)
-        np.random.shuffle(shuffle_index)
-        user_input=user_input[shuffle_index]
-        item_input_pos=item_input_pos[shuffle_index]
-        item_input_social=item_input_social[shuffle_index]
-        item_input_neg=item_input_neg[shuffle_index]
-        suk_input = suk_input[shuffle_index]
-        return user_input, item_input_pos,item_input_social,item_input_neg,suk_input
-
-    def _get_pairwise_all_data_sun(self):
-        user_input, item_input_pos, item_input_social, item_input_neg, suk_input = [],[],[],[],[]
-
-        num_items = self.dataset.num_items
-        all_items = np.arange(num_items)
-
-        for u, pos_item in self.train_dict.items():
-            if u not in self.userSocialItemsSetList:
-                continue
-            # pos_item = pos_item.indices.tolist()
-            pos_len = len(pos_item)
-            user_input.extend([u]*pos_len)
-            item_input_pos.extend(pos_item)
-
-            socialItemsList = self.userSocialItemsSetList[u]
-            # a, size = None, replace = True, p = None, exclusion = None
-            neg_excl = np.concatenate([socialItemsList, list(pos_item)], axis=0)
-
-            neg_item = random_choice(all_items, pos_len, replace=True, exclusion=neg_excl)
-            item_input_neg.extend(neg_item)
-            social_item = np.random.choice(socialItemsList, size=pos_len)
-            item_input_social.extend(social_item)
-
-            trustedUserIdices = self.socialMatrix[u].indices
-            socialWeight_bool = [[1 if k in self.train_dict[f_u] else 0 for f_u in trustedUserIdices]
-                                 for k in social_item]
-            socialWeight = np.sum(socialWeight_bool, axis=-1) + 1
-            suk_input.extend(socialWeight)
-
-        user_input = np.array(user_input, dtype=np.int32)
-        item_input_pos = np.array(item_input_pos, dtype=np.int32)
-        item_input_social = np.array(item_input_social, dtype=np.int32)
-        item_input_neg = np.array(item_input_neg, dtype=np.int32)
-        suk_input = np.array(suk_input, dtype=np.float32)
-        num_training_instances = len(user_input)
-        shuffle_index = np.arange(num_training_instances,dtype=np.int32)
-        np.random.shuffle(shuffle_index)
-        user_input=user_input[shuffle_index]
-        item_input_pos=item_input_pos[shuffle_index]
-        item_input_social=item_input_social[shuffle_index]
-        item_input_neg=item_input_neg[shuffle_index]
-        suk_input = suk_input[shuffle_index]
-        return user_input, item_input_pos,item_input_social,item_input_neg,suk_input
+        # samples a social item and a negative item for every training pair of the
+        # users who have social items; negatives are neither rated by the user nor
+        # by the trusted neighbors, and are drawn again until they are
+        num_items = self.num_items
+        excluded = (self.train_csr + self.socialItems).tocsr()
+        excluded.sort_indices()
+        social_len = np.diff(self.socialItems.indptr)
+        valid_users = (social_len > 0) & (np.diff(excluded.indptr) < num_items)
+
+        train = self.train_csr.tocoo()
+        sampled = valid_users[train.row]
+        user_input = train.row[sampled].astype(np.int32)
+        item_input_pos = train.col[sampled].astype(np.int32)
+
+        social_index = self.socialItems.indptr[user_input] + \
+                       (np.random.rand(len(user_input)) * social_len[user_input]).astype(np.int64)
+        item_input_social = self.socialItems.indices[social_index].astype(np.int32)
+        suk_input = self.socialItems.data[social_index].astype(np.float32) + 1
+
+        excluded_rows = np.repeat(np.arange(self.num_users, dtype=np.int64), np.diff(excluded.indptr))
+        observed = excluded_rows * num_items + excluded.indices
+        item_input_neg = np.zeros(len(user_input), dtype=np.int32)
+        redraw = np.ones(len(user_input), dtype=bool)
+        while redraw.any():
+            item_input_neg[redraw] = np.random.randint(num_items, size=np.count_nonzero(redraw))
+            keys = user_input[redraw].astype(np.int64) * num_items + item_input_neg[redraw]
+            hit = observed[np.minimum(np.searchsorted(observed, keys), len(observed) - 1)] == keys
+            redraw[redraw] = hit
+
+        shuffle_index = np.random.permutation(len(user_input))
+        return user_input[shuffle_index], item_input_pos[shuffle_index], item_input_social[shuffle_index], \
+               item_input_neg[shuffle_index], suk_input[shuffle_index]
 
     def predict(self, user_id, eval_items):
         users = np.full(len(eval_items), user_id, dtype=np.int32)
@@ -4,13 +4,18 @@ Reference: Lei, Zheng, et al. "Spectral Collaborative Filtering." in RecSys2018
 '''
 import tensorflow as tf
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.linalg import eigsh
 from time import time
 from neurec.util import data_gen, learner, tool
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
+from neurec.util.cache import cached_arrays
 
 class SpectralCF(AbstractRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "learner",
@@ -43,12 +48,9 @@ class SpectralCF(AbstractRecommender):
         self.verbose=self.conf["verbose"]
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
-        self.graph = self.dataset.trainMatrix.toarray()
-        self.A = self.adjacient_matrix(self_connection=True)
-        self.D = self.degree_matrix()
-        self.L = self.laplacian_matrix(normalized=True)
-        self.lamda, self.U = np.linalg.eig(self.L)
-        self.lamda = np.diag(self.lamda)
+        # number of eigenpairs of the graph Laplacian used by the spectral filters
+        self.num_eigen = min(Properties().getProperty("num_eigen", 64), self.num_users + self.num_items - 1)
+        self.lamda, self.U = cached_arrays(self.dataset, "spectralcf_rw_eigen_%d" % self.num_eigen, self.eigen_decomposition)
 
     def _create_placeholders(self):
         with tf.name_scope("input_data"):
@@ -64,6 +66,10 @@ class SpectralCF(AbstractRecommender):
             tf.random_normal([self.num_items, self.embedding_size], mean=0, stddev=0.01, dtype=tf.float32),
             name='item_embeddings')
 
+        # the eigenvectors are loaded by train_model, a constant would store the
+        # (users + items) x num_eigen basis in the GraphDef, which is limited to 2GB
+        self.eigenvectors = tf.Variable(tf.zeros(self.U.shape, dtype=tf.float32), trainable=False, name='eigenvectors')
+
         self.filters = []
         for _ in range(self.num_layers):
             self.filters.append(
@@ -72,15 +78,16 @@ class SpectralCF(AbstractRecommender):
 
     def _create_inference(self):
         with tf.name_scope("inference"):
-            A_hat = np.dot(self.U, self.U.T) + np.dot(np.dot(self.U, self.lamda), self.U.T)
-            #A_hat += np.dot(np.dot(self.U, self.lamda_2), self.U.T)
-            A_hat = A_hat.astype(np.float32)
+            # A_hat = U U^T + U lamda U^T is applied as U ((1 + lamda) U^T x),
+            # without materializing the (users + items)^2 filter
+            U = self.eigenvectors
+            spectrum = tf.constant((1. + self.lamda).reshape([-1, 1]), dtype=tf.float32)
 
             embeddings = tf.concat([self.user_embeddings, self.item_embeddings], axis=0)
             all_embeddings = [embeddings]
             for k in range(0, self.num_layers):
 
-                embeddings = tf.matmul(A_hat, embeddings)
+                embeddings = tf.matmul(U, spectrum * tf.matmul(U, embeddings, transpose_a=True))
 
                 #filters = self.filters[k]#tf.squeeze(tf.gather(self.filters, k))
                 embeddings = tool.activation_function(self.activation, (tf.matmul(embeddings, self.filters[k])))
@@ -112,27 +119,42 @@ class SpectralCF(AbstractRecommender):
         self._create_optimizer()
 
     def adjacient_matrix(self, self_connection=False):
-        A = np.zeros([self.num_users+self.num_items, self.num_users+self.num_items], dtype=np.float32)
-        A[:self.num_users, self.num_users:] = self.graph
-        A[self.num_users:, :self.num_users] = self.graph.transpose()
+        R = self.dataset.trainMatrix.tocsr().astype(np.float64)
+        R.eliminate_zeros()
+        A = sp.bmat([[None, R], [R.T, None]], format='csr')
         if self_connection == True:
-            return np.identity(self.num_users+self.num_items,dtype=np.float32) + A
+            return (A + sp.identity(A.shape[0], format='csr')).tocsr()
         return A
 
-    def degree_matrix(self):
-        degree = np.sum(self.A, axis=1, keepdims=False)
-        #degree = np.diag(degree)
-        return degree
-
-    def laplacian_matrix(self, normalized=False):
+    def laplacian_matrix(self, A, normalized=False):
+        degree = np.asarray(A.sum(1)).ravel()
         if normalized == False:
-            return self.D - self.A
-
-        temp = np.dot(np.diag(np.power(self.D, -1)), self.A)
-        #temp = np.dot(temp, np.power(self.D, -0.5))
-        return np.identity(self.num_users+self.num_items,dtype=np.float32) - temp
+            return sp.diags(degree) - A
+
+        # symmetric normalization I - D^-1/2 A D^-1/2; it has the eigenvalues of the
+        # random walk Laplacian I - D^-1 A, whose eigenvectors are D^-1/2 times its own
+        d_inv_sqrt = np.power(degree, -0.5)
+        return sp.identity(A.shape[0]) - sp.diags(d_inv_sqrt).dot(A).dot(sp.diags(d_inv_sqrt))
+
+    def eigen_decomposition(self):
+        """Returns the num_eigen smallest eigenvalues of the random walk Laplacian I - D^-1 A
+        and their unit norm eigenvectors."""
+        training_start_time = time()
+        A = self.adjacient_matrix(self_connection=True)
+        L = self.laplacian_matrix(A, normalized=True)
+        # the smallest eigenvalues of L = I - S are the largest of S, where the
+        # Lanczos iterations converge quickly
+        S = sp.identity(L.shape[0]) - L
+        mu, U = eigsh(S, k=self.num_eigen, which='LA')
+        order = np.argsort(-mu)
+        # maps the eigenvectors of the symmetric Laplacian to those of the random walk one
+        U = np.power(np.asarray(A.sum(1)), -0.5) * U[:, order]
+        U /= np.linalg.norm(U, axis=0)
+        self.logger.info("computed %d eigenpairs of the Laplacian, time: %f" % (self.num_eigen, time()-training_start_time))
+        return [(1. - mu[order]).astype(np.float32), U.astype(np.float32)]
 
     def train_model(self):
+        self.eigenvectors.load(self.U, self.sess)
         for epoch in  range(self.num_epochs):
             # Generate training instances
             user_input, item_input_pos, item_input_neg = data_gen._get_pairwise_all_data(self.dataset)
@@ -149,11 +171,18 @@ class SpectralCF(AbstractRecommender):
 
                 loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
                 total_loss+=loss
+            self.invalidate_snapshot()
 
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
 
     def predict(self, user_id, items):
-        users = np.full(len(items), user_id, dtype=np.int32)
-        return self.sess.run(self.output, feed_dict={self.input_user: users, self.input_item: items})
+        return self.cached_snapshot().predict(user_id, items)
+
+    def snapshot(self):
+        # runs the spectral convolution once for all users and items
+        user_embeddings, item_embeddings = self.sess.run([self.user_new_embeddings, self.item_new_embeddings])
+        return EmbeddingSnapshot(self, user_embeddings, item_embeddings)
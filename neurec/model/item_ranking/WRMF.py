@@ -6,14 +6,83 @@ from __future__ import absolute_import
 from __future__ import division
 import os
 import numpy as np
+import scipy.sparse as sp
 from time import time
+from concurrent.futures import ThreadPoolExecutor
 from neurec.evaluation import Evaluate
 from neurec.model.AbstractRecommender import AbstractRecommender
 import tensorflow as tf
 from neurec.util.properties import Properties
+from neurec.util.snapshot import EmbeddingSnapshot
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+def least_squares(confidence, Y, YTY, reg):
+    """Solves the implicit ALS normal equations of every row of a confidence matrix.
+
+    Row u solves (YTY + Y^T (C_u - I) Y + reg * I) x_u = Y^T C_u p_u. Only the
+    observed items of the row contribute to the correction of the shared YTY.
+
+    confidence -- csr_matrix of C - I, non-zero on the observed entries
+    Y -- fixed factors of the columns
+    YTY -- Y^T Y
+    reg -- L2 regularization
+    """
+    num_rows, k = confidence.shape[0], Y.shape[1]
+    A = np.empty((num_rows, k, k), dtype=Y.dtype)
+    b = np.empty((num_rows, k), dtype=Y.dtype)
+    for u in range(num_rows):
+        start, end = confidence.indptr[u], confidence.indptr[u + 1]
+        Y_u = Y[confidence.indices[start:end]]
+        c_u = confidence.data[start:end]
+        A[u] = YTY + np.dot(Y_u.T * c_u, Y_u)
+        b[u] = np.dot(c_u + 1, Y_u)
+    A += reg * np.eye(k, dtype=Y.dtype)
+    return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+def conjugate_gradient(confidence, Y, YTY, reg, X, cg_steps):
+    """Improves the factors X of every row with a few conjugate gradient steps.
+
+    Solves the same system as least_squares without forming it: the product
+    with the system matrix is X YTY + reg * X plus a sparse correction over the
+    observed entries, computed for all rows of the block at once.
+
+    confidence -- csr_matrix of C - I, non-zero on the observed entries
+    Y -- fixed factors of the columns
+    YTY -- Y^T Y
+    reg -- L2 regularization
+    X -- current factors of the rows, used as the starting point
+    cg_steps -- number of conjugate gradient steps
+    """
+    rows = np.repeat(np.arange(confidence.shape[0]), np.diff(confidence.indptr))
+    Y_observed = Y[confidence.indices]
+
+    def product(P):
+        weights = confidence.data * np.einsum("ij,ij->i", P[rows], Y_observed)
+        correction = sp.csr_matrix((weights, confidence.indices, confidence.indptr), shape=confidence.shape)
+        return np.dot(P, YTY) + reg * P + correction.dot(Y)
+
+    b = sp.csr_matrix((confidence.data + 1, confidence.indices, confidence.indptr), shape=confidence.shape).dot(Y)
+    X = X.copy()
+    R = b - product(X)
+    P = R.copy()
+    residual = np.sum(R * R, axis=1)
+    for _ in range(cg_steps):
+        AP = product(P)
+        curvature = np.sum(P * AP, axis=1)
+        step = np.divide(residual, curvature, out=np.zeros_like(residual), where=curvature > 0)
+        X += step[:, None] * P
+        R -= step[:, None] * AP
+        new_residual = np.sum(R * R, axis=1)
+        beta = np.divide(new_residual, residual, out=np.zeros_like(residual), where=residual > 0)
+        P = R + beta[:, None] * P
+        residual = new_residual
+    return X
+
 class WRMF(AbstractRecommender):
+    # rows solved together by one worker
+    block_size = 1024
+
     properties = [
         "embedding_size",
         "alpha",
@@ -23,7 +92,7 @@ class WRMF(AbstractRecommender):
         "verbose"
     ]
 
-    def __init__(self, sess, dataset):
+    def __init__(self, **kwds):
         super().__init__(**kwds)
 
         self.embedding_size = self.conf["embedding_size"]
@@ -32,73 +101,62 @@ class WRMF(AbstractRecommender):
         self.num_epochs= self.conf["epochs"]
         self.reg_mf = self.conf["reg_mf"]
         self.verbose= self.conf["verbose"]
+        # 0 solves every row exactly, otherwise conjugate gradient steps per half-iteration
+        self.cg_steps = Properties().getProperty("cg_steps", 0)
+        self.num_thread = Properties().getProperty("rec.number.thread", 1)
 
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
 
-        self.Cui = np.zeros(shape=[self.num_users, self.num_items], dtype=np.float32)
-        self.Pui = np.zeros(shape=[self.num_users, self.num_items], dtype=np.float32)
-        for (u, i) in self.dataset.trainMatrix.keys():
-            self.Cui[u,i] = self.alpha
-            self.Pui[u,i] = 1.0
-        self.lambda_eye = self.reg_mf * tf.eye(self.embedding_size)
-
-    def _create_placeholders(self):
-        self.user_id = tf.placeholder(tf.int32, [1])
-        self.Cu = tf.placeholder(tf.float32, [self.num_items, 1])
-        self.Pu = tf.placeholder(tf.float32, [self.num_items, 1])
-
-        self.item_id = tf.placeholder(tf.int32, [1])
-        self.Ci = tf.placeholder(tf.float32, [self.num_users, 1])
-        self.Pi = tf.placeholder(tf.float32, [self.num_users, 1])
+        # C - I of the users (rows) and of the items (rows of the transpose)
+        self.Cui = (self.dataset.get_train_csr() * self.alpha).astype(np.float32)
+        self.Ciu = self.Cui.T.tocsr()
 
     def _create_variables(self):
         self.user_embeddings = tf.Variable(tf.random_normal([self.num_users, self.embedding_size], stddev=0.01))
         self.item_embeddings = tf.Variable(tf.random_normal([self.num_items, self.embedding_size], stddev=0.01))
 
-    def _create_optimizer(self):
-        YTY = tf.matmul(self.item_embeddings, self.item_embeddings, transpose_a=True)
-        YTCuIY = tf.matmul(self.item_embeddings, tf.multiply(self.Cu, self.item_embeddings), transpose_a=True)
-        YTCupu = tf.matmul(self.item_embeddings, tf.multiply(self.Cu+1, self.Pu), transpose_a=True)
-        xu = tf.linalg.solve(YTY + YTCuIY + self.lambda_eye, YTCupu)
-        self.update_user = tf.scatter_update(self.user_embeddings, self.user_id, tf.transpose(xu))
-
-        XTX = tf.matmul(self.user_embeddings, self.user_embeddings, transpose_a=True)
-        XTCIIX = tf.matmul(self.user_embeddings, tf.multiply(self.Ci, self.user_embeddings), transpose_a=True)
-        XTCIpi = tf.matmul(self.user_embeddings, tf.multiply(self.Ci+1, self.Pi), transpose_a=True)
-        xi = tf.linalg.solve(XTX + XTCIIX + self.lambda_eye, XTCIpi)
-        self.update_item = tf.scatter_update(self.item_embeddings, self.item_id, tf.transpose(xi))
-
     def build_graph(self):
-        self._create_placeholders()
         self._create_variables()
-        self._create_optimizer()
+
+    def _solve(self, executor, confidence, X, Y):
+        # solves the rows of X for fixed Y, one block of rows per task
+        YTY = np.dot(Y.T, Y)
+
+        def solve_block(start):
+            block = confidence[start:start + self.block_size]
+            if self.cg_steps > 0:
+                return conjugate_gradient(block, Y, YTY, self.reg_mf, X[start:start + self.block_size], self.cg_steps)
+            return least_squares(block, Y, YTY, self.reg_mf)
+
+        starts = range(0, confidence.shape[0], self.block_size)
+        return np.concatenate(list(executor.map(solve_block, starts)))
 
         #---------- training process -------
     def train_model(self):
-        for epoch in  range(self.num_epochs):
-            training_start_time = time()
-            self.logger.info('solving for user vectors...')
-            for userid in range(self.num_users):
-                feed = {self.user_id: [userid],
-                        self.Pu: self.Pui[userid].T.reshape([-1,1]),
-                        self.Cu: self.Cui[userid].T.reshape([-1,1])}
-                self.sess.run(self.update_user, feed_dict=feed)
-
-            self.logger.info('solving for item vectors...')
-            for itemid in range(self.num_items):
-                feed = {self.item_id: [itemid],
-                        self.Pi: self.Pui[:,itemid].reshape([-1,1]),
-                        self.Ci: self.Cui[:,itemid].reshape([-1,1])}
-                self.sess.run(self.update_item, feed_dict=feed)
-
-            self.logger.info ('iteration %i finished in %f seconds' % (epoch + 1, time()-training_start_time))
-            if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
+        user_factors, item_factors = self.sess.run([self.user_embeddings, self.item_embeddings])
+        with ThreadPoolExecutor(max_workers=self.num_thread) as executor:
+            for epoch in  range(self.num_epochs):
+                training_start_time = time()
+                self.logger.info('solving for user vectors...')
+                user_factors = self._solve(executor, self.Cui, user_factors, item_factors)
+                self.user_embeddings.load(user_factors, self.sess)
+                self.invalidate_snapshot()
+
+                self.logger.info('solving for item vectors...')
+                item_factors = self._solve(executor, self.Ciu, item_factors, user_factors)
+                self.item_embeddings.load(item_factors, self.sess)
+                self.invalidate_snapshot()
+
+                self.logger.info ('iteration %i finished in %f seconds' % (epoch + 1, time()-training_start_time))
+                if epoch %self.verbose == 0:
+                    if self.controller.evaluate(epoch):
+                        break
+        self.controller.finish()
 
     def predict(self, user_id, items):
+        return self.cached_snapshot().predict(user_id, items)
+
+    def snapshot(self):
         user_embeddings, item_embeddings = self.sess.run([self.user_embeddings, self.item_embeddings])
-        user_embedding = user_embeddings[user_id]
-        item_embedding = item_embeddings[items]
-        predictions = user_embedding.dot(item_embedding.T)
-        return predictions
+        return EmbeddingSnapshot(self, user_embeddings, item_embeddings)
@@ -6,18 +6,19 @@ for Next-Basket Recommendation." in WWW 2010.
 from __future__ import absolute_import
 from __future__ import division
 import os
-from neurec.model.AbstractRecommender import AbstractRecommender
+from neurec.model.AbstractSeqRecommender import AbstractSeqRecommender
 from neurec.util.properties import Properties
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
 import numpy as np
 from time import time
-from neurec.util import learner, data_gen
+from neurec.util import learner, data_gen, embedding
 from neurec.evaluation import Evaluate
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-class FPMC(AbstractRecommender):
+class FPMC(AbstractSeqRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -46,6 +47,8 @@ class FPMC(AbstractRecommender):
         self.batch_size= self.conf["batch_size"]
         self.verbose= self.conf["verbose"]
         self.num_negatives= self.conf["num_neg"]
+        # number of NumPy worker processes training with Hogwild SGD (default 0, train with TensorFlow)
+        self.hogwild_workers = Properties().getProperty("hogwild_workers", 0)
         self.num_users = self.dataset.num_users
         self.num_items = self.dataset.num_items
 
@@ -60,28 +63,42 @@ class FPMC(AbstractRecommender):
                 self.lables = tf.placeholder(tf.float32, shape=[None,],name="labels")
     def _create_variables(self):
         with tf.name_scope("embedding"):
-            self.embeddings_UI = tf.Variable(tf.truncated_normal(shape=[self.num_users, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embeddings_UI', dtype=tf.float32)  #(users, embedding_size)
-            self.embeddings_IU = tf.Variable(tf.truncated_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embeddings_IU', dtype=tf.float32)  #(items, embedding_size)
-            self.embeddings_IL = tf.Variable(tf.truncated_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embeddings_IL', dtype=tf.float32)
-            self.embeddings_LI = tf.Variable(tf.truncated_normal(shape=[self.num_items, self.embedding_size], mean=0.0, stddev=0.01),
-                name='embeddings_LI', dtype=tf.float32)  #(items, embedding_size)
+            initializer = tf.truncated_normal_initializer(mean=0.0, stddev=0.01)
+            item_counts = self.dataset.get_item_counts()
+            self.embeddings_UI = embedding.embedding_table('embeddings_UI', [self.num_users, self.embedding_size], initializer)  #(users, embedding_size)
+            self.embeddings_IU = embedding.embedding_table('embeddings_IU', [self.num_items, self.embedding_size], initializer, counts=item_counts)  #(items, embedding_size)
+            self.embeddings_IL = embedding.embedding_table('embeddings_IL', [self.num_items, self.embedding_size], initializer, counts=item_counts)
+            self.embeddings_LI = embedding.embedding_table('embeddings_LI', [self.num_items, self.embedding_size], initializer, counts=item_counts)  #(items, embedding_size)
 
     def _create_inference(self, item_input):
         with tf.name_scope("inference"):
             # embedding look up
-            embeddings_UI_u = tf.nn.embedding_lookup(self.embeddings_UI, self.user_input)
-            embeddings_IU_i = tf.nn.embedding_lookup(self.embeddings_IU,item_input)
-            embeddings_IL_i = tf.nn.embedding_lookup(self.embeddings_IL, item_input)
-            embeddings_LI_l = tf.nn.embedding_lookup(self.embeddings_LI, self.item_input_recent)
+            embeddings_UI_u = embedding.lookup(self.embeddings_UI, self.user_input)
+            embeddings_IU_i = embedding.lookup(self.embeddings_IU,item_input)
+            embeddings_IL_i = embedding.lookup(self.embeddings_IL, item_input)
+            embeddings_LI_l = embedding.lookup(self.embeddings_LI, self.item_input_recent)
             predict_vector = tf.multiply(embeddings_UI_u, embeddings_IU_i) + tf.multiply(embeddings_IL_i, embeddings_LI_l)
             predict = tf.reduce_sum(predict_vector, 1)
             return embeddings_UI_u, embeddings_IU_i,embeddings_IL_i,embeddings_LI_l,predict
 
                 #tf.multiply(user_embedding, item_embedding)+item_embedding_short
 
+    def _create_state_inference(self):
+        # Two-phase scoring: the state of a user is [UI_u, LI_l] and an item is
+        # scored by the dot product of the state with [IU_i, IL_i].
+        with tf.name_scope("state_inference"):
+            self._create_state_placeholders()
+            weights = tf.expand_dims(self.state_weights, 2) #(b, n, 1)
+            embeddings_UI_u = embedding.lookup(self.embeddings_UI, self.state_users)
+            embeddings_LI_l = tf.reduce_sum(embedding.lookup(self.embeddings_LI, self.state_recents) * weights, 1)
+            self.user_state = tf.concat([embeddings_UI_u, embeddings_LI_l], 1) #(b, 2*e)
+
+            self.state_input = tf.placeholder(tf.float32, shape = [None, 2*self.embedding_size], name = "state_input")
+            self.state_items = tf.placeholder(tf.int32, shape = [None,], name = "state_items")
+            item_factors = tf.concat([embedding.lookup(self.embeddings_IU, self.state_items),
+                                      embedding.lookup(self.embeddings_IL, self.state_items)], 1) #(m, 2*e)
+            self.state_scores = tf.matmul(self.state_input, item_factors, transpose_b=True) #(b, m)
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             # loss for L(Theta)
@@ -104,9 +121,24 @@ class FPMC(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_state_inference()
         self._create_optimizer()
+        self._create_steps()
+
+    def _create_steps(self):
+        super()._create_steps()
+        if self.ispairwise == True:
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.item_input_recent, self.item_input_neg])
+        else :
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.item_input_recent, self.lables])
 #---------- training process -------
     def train_model(self):
+        if self.hogwild_workers > 0:
+            self._train_hogwild()
+            return
+
         for epoch in  range(self.num_epochs):
             # Generate training instances
             if self.ispairwise == True:
@@ -124,26 +156,44 @@ class FPMC(AbstractRecommender):
                     bat_users, bat_items_pos, bat_items_recents,bat_items_neg  = \
                     data_gen._get_pairwise_batch_seqdata(user_input, item_input_pos, \
                     item_input_recent, item_input_neg, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users,self.item_input:bat_items_pos,\
-                                self.item_input_recent:bat_items_recents,self.item_input_neg:bat_items_neg}
+                    loss,_ = self.train_step(bat_users, bat_items_pos, bat_items_recents, bat_items_neg)
                 else :
                     bat_users, bat_items, bat_items_recents, bat_lables =\
                     data_gen._get_pointwise_batch_seqdata(user_input, \
                     item_input,item_input_recent, lables, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users, self.item_input:bat_items,
-                                 self.item_input_recent:bat_items_recents,self.lables:bat_lables}
-
-                loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
+                    loss,_ = self.train_step(bat_users, bat_items, bat_items_recents, bat_lables)
                 total_loss+=loss
 
-            self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
+            training_time = time()-training_start_time
+            self.logger.info("[iter %d : loss : %f, time: %f, %.1f steps/sec]" %(epoch+1,total_loss/num_training_instances,training_time,
+                             int(num_training_instances/self.batch_size)/training_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-                #Evaluate.test_model(self,self.dataset)
-    def predict(self, user_id, items):
-        cand_items = self.dataset.trainDict[user_id]
-        item_recent = np.full(len(items), cand_items[-1], dtype='int32')
-
-        users = np.full(len(items), user_id, dtype='int32')
-        return self.sess.run((self.output), feed_dict={self.user_input: users,\
-                self.item_input_recent:item_recent, self.item_input: items})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
+
+    def _train_hogwild(self):
+        # the factors are trained by lock-free NumPy SGD in worker processes, and
+        # loaded into the variables after every epoch for evaluation; the score is
+        # <UI_u, IU_i> + <LI_l, IL_i>
+        if self.ispairwise != True or self.loss_function.lower() != "bpr":
+            raise ValueError("hogwild_workers requires ispairwise=true and loss_function=bpr")
+        # imported here, the shared memory it needs is only available from Python 3.8
+        from neurec.util.hogwild import HogwildTrainer
+        variables = [self.embeddings_UI, self.embeddings_IU, self.embeddings_IL, self.embeddings_LI]
+        if any(embedding.is_compressed(variable) for variable in variables):
+            raise ValueError("hogwild_workers requires uncompressed embedding tables")
+        with HogwildTrainer(embedding.get_values(self.sess, variables), [(0, 0, 1), (3, 1, 2)], self.hogwild_workers,
+                            self.learning_rate, self.reg_mf) as trainer:
+            for epoch in range(self.num_epochs):
+                user_input, item_input_pos, item_input_recent, item_input_neg = \
+                data_gen._get_pairwise_all_firstorder_data(self.dataset)
+                training_start_time = time()
+                total_loss = trainer.train_epoch(self.batch_size, [user_input, item_input_recent],
+                                                 item_input_pos, item_input_neg)
+                trainer.load_into(variables, self.sess)
+                self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/len(user_input),time()-training_start_time))
+                if epoch %self.verbose == 0:
+                    if self.controller.evaluate(epoch):
+                        break
+        self.controller.finish()
@@ -6,7 +6,7 @@ for Next-Basket Recommendation." in WWW 2010.
 from __future__ import absolute_import
 from __future__ import division
 import os
-from neurec.model.AbstractRecommender import AbstractRecommender
+from neurec.model.AbstractSeqRecommender import AbstractSeqRecommender
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
@@ -17,7 +17,8 @@ from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-class FPMCplus(AbstractRecommender):
+class FPMCplus(AbstractSeqRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -114,6 +115,40 @@ class FPMCplus(AbstractRecommender):
             return embeddings_UI_u,embeddings_IU_i, embeddings_IL_i,embeddings_LI_l,predict
 
 
+    def _create_state_inference(self):
+        # Two-phase scoring. The attention input [UI_u, IL_i, LI_l] * W splits into
+        # UI_u * W_u + LI_l * W_l + IL_i * W_i, so the user side is projected once and
+        # kept in the state next to UI_u and LI_l; only IL_i * W_i depends on the item.
+        # The weights of the recent items close the state, so padding gets no attention.
+        e, w, n = self.embedding_size, self.weight_size, self.high_order
+        W_u, W_i, W_l = tf.split(self.W, 3, axis=0)
+        with tf.name_scope("state_inference"):
+            self._create_state_placeholders()
+            embeddings_UI_u = tf.nn.embedding_lookup(self.embeddings_UI, self.state_users) #(b, e)
+            embeddings_LI_l = tf.nn.embedding_lookup(self.embeddings_LI, self.state_recents) #(b, n, e)
+            projection = tf.expand_dims(tf.matmul(embeddings_UI_u, W_u), 1) + \
+                tf.reshape(tf.matmul(tf.reshape(embeddings_LI_l, [-1, e]), W_l), [-1, n, w]) + self.b #(b, n, w)
+            self.user_state = tf.concat([embeddings_UI_u, tf.reshape(embeddings_LI_l, [-1, n*e]),
+                                         tf.reshape(projection, [-1, n*w]), self.state_weights], 1) #(b, e + n*e + n*w + n)
+
+            self.state_input = tf.placeholder(tf.float32, shape = [None, e + n*e + n*w + n], name = "state_input")
+            self.state_items = tf.placeholder(tf.int32, shape = [None,], name = "state_items")
+            UI_u, LI_l, projection, weights = tf.split(self.state_input, [e, n*e, n*w, n], 1)
+            LI_l = tf.reshape(LI_l, [-1, n, e])
+            projection = tf.reshape(projection, [-1, n, w])
+            IU_i = tf.nn.embedding_lookup(self.embeddings_IU, self.state_items) #(m, e)
+            IL_i = tf.nn.embedding_lookup(self.embeddings_IL, self.state_items) #(m, e)
+
+            with tf.name_scope("attention_MLP"):
+                MLP_output = tf.nn.tanh(tf.expand_dims(projection, 1) + \
+                    tf.expand_dims(tf.expand_dims(tf.matmul(IL_i, W_i), 0), 2)) #(b, m, n, w)
+                exp_A_ = tf.exp(tf.squeeze(tf.tensordot(MLP_output, self.h, 1), 3)) * tf.expand_dims(weights, 1) #(b, m, n)
+                A = tf.div(exp_A_, tf.maximum(tf.reduce_sum(exp_A_, 2, keepdims=True), 1e-12))
+                item_embedding_short = tf.matmul(A, LI_l) #(b, m, e)
+
+            self.state_scores = tf.matmul(UI_u, IU_i, transpose_b=True) + \
+                tf.reduce_sum(tf.expand_dims(IL_i, 0) * item_embedding_short, 2) #(b, m)
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             # loss for L(Theta)
@@ -138,7 +173,9 @@ class FPMCplus(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_state_inference()
         self._create_optimizer()
+        self._create_steps()
 #---------- training process -------
     def train_model(self):
         for epoch in  range(self.num_epochs):
@@ -172,12 +209,6 @@ class FPMCplus(AbstractRecommender):
 
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-    def predict(self, user_id, items):
-        cand_items = self.dataset.trainDict[user_id]
-        item_recents = []
-        for _ in range(len(items)):
-            item_recents.append( cand_items[len(cand_items)-self.high_order:])
-        users = np.full(len(items), user_id, dtype='int32')
-        return self.sess.run((self.output), feed_dict={self.user_input: users,\
-                                        self.item_input_recents:item_recents, self.item_input: items})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
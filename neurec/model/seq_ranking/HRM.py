@@ -5,7 +5,7 @@ Reference: Pengfei Wang et al., "Learning Hierarchical Representation Model for
 from __future__ import absolute_import
 from __future__ import division
 import os
-from neurec.model.AbstractRecommender import AbstractRecommender
+from neurec.model.AbstractSeqRecommender import AbstractSeqRecommender
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
@@ -16,7 +16,8 @@ from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-class HRM(AbstractRecommender):
+class HRM(AbstractSeqRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -95,6 +96,31 @@ class HRM(AbstractRecommender):
             return user_embedding, item_embedding,item_embedding_recent,predict
 
 
+    def _create_state_inference(self):
+        # Two-phase scoring: the state of a user is the hybrid user embedding and an
+        # item is scored by its dot product with the item embedding.
+        with tf.name_scope("state_inference"):
+            self._create_state_placeholders()
+            weights = tf.expand_dims(self.state_weights, 2) #(b, n, 1)
+            user_embedding = tf.nn.embedding_lookup(self.user_embeddings, self.state_users)
+            item_embedding_recent = tf.nn.embedding_lookup(self.item_embeddings, self.state_recents) #(b, n, e)
+            # pools the weighted recent items only; users without any get zeros
+            num_recents = tf.reduce_sum(weights, 1) #(b, 1)
+            if self.session_agg == "max":
+                item_embedding_short = self.max_pooling(item_embedding_recent + (weights - 1) * 1e9) * tf.minimum(num_recents, 1)
+            elif self.session_agg == "avg":
+                item_embedding_short = tf.reduce_sum(item_embedding_recent * weights, 1) / tf.maximum(num_recents, 1)
+            concat_user_item = tf.concat([tf.expand_dims(user_embedding,1),tf.expand_dims(item_embedding_short,1)],axis=1)
+            if self.pre_agg == "max":
+                self.user_state = self.max_pooling(concat_user_item)
+            elif self.pre_agg == "avg":
+                self.user_state = self.avg_pooling(concat_user_item)
+
+            self.state_input = tf.placeholder(tf.float32, shape = [None, self.embedding_size], name = "state_input")
+            self.state_items = tf.placeholder(tf.int32, shape = [None,], name = "state_items")
+            item_embedding = tf.nn.embedding_lookup(self.item_embeddings, self.state_items)
+            self.state_scores = tf.matmul(self.state_input, item_embedding, transpose_b=True) #(b, m)
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             # loss for L(Theta)
@@ -110,7 +136,9 @@ class HRM(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_state_inference()
         self._create_optimizer()
+        self._create_steps()
 #---------- training process -------
     def train_model(self):
 
@@ -134,12 +162,6 @@ class HRM(AbstractRecommender):
 
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-    def predict(self, user_id, items):
-        cand_items = self.dataset.trainDict[user_id]
-        item_recents = []
-        for _ in range(len(items)):
-            item_recents.append( cand_items[len(cand_items)-self.high_order:])
-        users = np.full(len(items), user_id, dtype='int32')
-        return self.sess.run((self.output), feed_dict={self.user_input: users,\
-                                        self.item_input_recent:item_recents, self.item_input: items})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
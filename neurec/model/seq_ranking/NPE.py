@@ -5,7 +5,7 @@ Reference: ThaiBinh Nguyen, et al. "NPE: Neural Personalized Embedding for Colla
 from __future__ import absolute_import
 from __future__ import division
 import os
-from neurec.model.AbstractRecommender import AbstractRecommender
+from neurec.model.AbstractSeqRecommender import AbstractSeqRecommender
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
@@ -16,7 +16,8 @@ from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
-class NPE(AbstractRecommender):
+class NPE(AbstractSeqRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -76,6 +77,21 @@ class NPE(AbstractRecommender):
             return embeddings_UI_u,embeddings_IU_i,embeddings_LI_l, predict
 
 
+    def _create_state_inference(self):
+        # Two-phase scoring: relu(UI_u)*relu(IU_i) + relu(IU_i)*relu(context) is the dot
+        # product of the state relu(UI_u) + relu(context) with relu(IU_i).
+        with tf.name_scope("state_inference"):
+            self._create_state_placeholders()
+            weights = tf.expand_dims(self.state_weights, 2) #(b, n, 1)
+            embeddings_UI_u = tf.nn.embedding_lookup(self.embeddings_UI, self.state_users)
+            context_embedding = tf.reduce_sum(tf.nn.embedding_lookup(self.embeddings_IL, self.state_recents) * weights,1)
+            self.user_state = tf.nn.relu(embeddings_UI_u) + tf.nn.relu(context_embedding) #(b, e)
+
+            self.state_input = tf.placeholder(tf.float32, shape = [None, self.embedding_size], name = "state_input")
+            self.state_items = tf.placeholder(tf.int32, shape = [None,], name = "state_items")
+            embeddings_IU_i = tf.nn.relu(tf.nn.embedding_lookup(self.embeddings_IU, self.state_items))
+            self.state_scores = tf.matmul(self.state_input, embeddings_IU_i, transpose_b=True) #(b, m)
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             UI_u,IU_i,LI_l,self.output = self._create_inference()
@@ -90,7 +106,9 @@ class NPE(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_state_inference()
         self._create_optimizer()
+        self._create_steps()
 #---------- training process -------
     def train_model(self):
         for epoch in  range(self.num_epochs):
@@ -114,12 +132,6 @@ class NPE(AbstractRecommender):
 
             self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-    def predict(self, user_id, items):
-        cand_items = self.dataset.trainDict[user_id]
-        item_recents = []
-        for _ in range(len(items)):
-            item_recents.append( cand_items[len(cand_items)-self.high_order:])
-        users = np.full(len(items), user_id, dtype='int32')
-        return self.sess.run((self.output), feed_dict={self.user_input: users,\
-                                        self.item_input_recents:item_recents, self.item_input: items})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
@@ -5,7 +5,7 @@ Reference: Ruining He et al., "Translation-based Recommendation." in RecSys 2017
 from __future__ import absolute_import
 from __future__ import division
 import os
-from neurec.model.AbstractRecommender import AbstractRecommender
+from neurec.model.AbstractSeqRecommender import AbstractSeqRecommender
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
 import tensorflow as tf
@@ -16,7 +16,8 @@ from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-class TransRec(AbstractRecommender):
+class TransRec(AbstractSeqRecommender):
+    data_parallel = True
     properties = [
         "learning_rate",
         "embedding_size",
@@ -80,6 +81,25 @@ class TransRec(AbstractRecommender):
             predict = item_bias-tf.reduce_sum(tf.square(predict_vector),1)
             return user_embedding, item_embedding_recent,item_embedding,item_bias,predict
 
+    def _create_state_inference(self):
+        # Two-phase scoring: the state of a user is the translated point
+        # user + global + recent item, and an item is scored by
+        # bias_i - ||state - item||^2 = bias_i - ||state||^2 + 2*state.item - ||item||^2.
+        with tf.name_scope("state_inference"):
+            self._create_state_placeholders()
+            weights = tf.expand_dims(self.state_weights, 2) #(b, n, 1)
+            user_embedding = tf.nn.embedding_lookup(self.user_embeddings, self.state_users)
+            item_embedding_recent = tf.reduce_sum(tf.nn.embedding_lookup(self.item_embeddings, self.state_recents) * weights, 1)
+            self.user_state = user_embedding + self.global_embedding + item_embedding_recent #(b, e)
+
+            self.state_input = tf.placeholder(tf.float32, shape = [None, self.embedding_size], name = "state_input")
+            self.state_items = tf.placeholder(tf.int32, shape = [None,], name = "state_items")
+            item_embedding = tf.nn.embedding_lookup(self.item_embeddings, self.state_items)
+            item_bias = tf.nn.embedding_lookup(self.item_biases, self.state_items)
+            item_term = item_bias - tf.reduce_sum(tf.square(item_embedding), 1) #(m,)
+            self.state_scores = 2 * tf.matmul(self.state_input, item_embedding, transpose_b=True) \
+                - tf.reduce_sum(tf.square(self.state_input), 1, keepdims=True) + tf.expand_dims(item_term, 0) #(b, m)
+
     def _create_loss(self):
         with tf.name_scope("loss"):
             # loss for L(Theta)
@@ -101,7 +121,18 @@ class TransRec(AbstractRecommender):
         self._create_placeholders()
         self._create_variables()
         self._create_loss()
+        self._create_state_inference()
         self._create_optimizer()
+        self._create_steps()
+
+    def _create_steps(self):
+        super()._create_steps()
+        if self.ispairwise == True:
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.item_input_recent, self.item_input_neg])
+        else :
+            self.train_step = self.make_step((self.loss, self.optimizer),
+                [self.user_input, self.item_input, self.item_input_recent, self.lables])
 #---------- training process -------
     def train_model(self):
 
@@ -122,25 +153,18 @@ class TransRec(AbstractRecommender):
                     bat_users, bat_items_pos, bat_items_recents,bat_items_neg  = \
                     data_gen._get_pairwise_batch_seqdata(user_input, item_input_pos, \
                     item_input_recents, item_input_neg, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users,self.item_input:bat_items_pos,\
-                                self.item_input_recent:bat_items_recents,self.item_input_neg:bat_items_neg}
+                    loss,_ = self.train_step(bat_users, bat_items_pos, bat_items_recents, bat_items_neg)
                 else :
                     bat_users, bat_items, bat_items_recents, bat_lables =\
                     data_gen._get_pointwise_batch_seqdata(user_input, \
                     item_input,item_input_recents, lables, num_batch, self.batch_size)
-                    feed_dict = {self.user_input:bat_users, self.item_input:bat_items,
-                                 self.item_input_recent:bat_items_recents,self.lables:bat_lables}
-
-                loss,_ = self.sess.run((self.loss,self.optimizer),feed_dict=feed_dict)
+                    loss,_ = self.train_step(bat_users, bat_items, bat_items_recents, bat_lables)
                 total_loss+=loss
 
-            self.logger.info("[iter %d : loss : %f, time: %f]" %(epoch+1,total_loss/num_training_instances,time()-training_start_time))
+            training_time = time()-training_start_time
+            self.logger.info("[iter %d : loss : %f, time: %f, %.1f steps/sec]" %(epoch+1,total_loss/num_training_instances,training_time,
+                             int(num_training_instances/self.batch_size)/training_time))
             if epoch %self.verbose == 0:
-                Evaluate.test_model(self,self.dataset)
-    def predict(self, user_id, items):
-        cand_items = self.dataset.trainDict[user_id]
-        item_recent = np.full(len(items), cand_items[-1], dtype='int32')
-
-        users = np.full(len(items), user_id, dtype='int32')
-        return self.sess.run((self.output), feed_dict={self.user_input: users,\
-                                        self.item_input_recent:item_recent, self.item_input: items})
+                if self.controller.evaluate(epoch):
+                    break
+        self.controller.finish()
@@ -3,8 +3,11 @@ import logging
 from neurec.data.properties import types
 from neurec.data.models import models
 from neurec.data.Dataset import Dataset
+from neurec.model.AbstractRecommender import AbstractRecommender
 from neurec.evaluation import Evaluate
 from neurec.util.properties import Properties
+from neurec.util import artifact
+from neurec.util import parallel
 from neurec.util import reader
 from neurec.data.models import models
 import numpy as np
@@ -49,9 +52,13 @@ def setup(properties_path, properties_section="DEFAULT", numpy_seed=2018, tensor
     evaluate_neg = properties.getProperty("rec.evaluate.neg")
     dataset_format = properties.getProperty("data.column.format")
     splitter_ratio = properties.getProperty("data.splitterratio")
+    validation = properties.getProperty("data.validation", False)
+    candidates_path = properties.getProperty("rec.evaluate.candidates", None)
+    user_buckets = properties.getProperty("data.hash.users", 0)
+    item_buckets = properties.getProperty("data.hash.items", 0)
 
     global dataset
-    dataset = Dataset(data_input_path, dataset_name, dataset_format, splitter, separator, threshold, evaluate_neg, splitter_ratio)
+    dataset = Dataset(data_input_path, dataset_name, dataset_format, splitter, separator, threshold, evaluate_neg, splitter_ratio, validation, candidates_path, user_buckets, item_buckets)
 
 def run():
     """Trains and evaluates a model."""
@@ -65,16 +72,50 @@ def run():
     if not recommender in models:
         raise KeyError("Recommender " + str(recommender) + " not recognised. Add recommender to neurec.util.models")
 
+    # only the models that snapshot their factors can be exported, checked before training
+    if properties.getProperty("rec.export.path", None) is not None and models[recommender].snapshot is AbstractRecommender.snapshot:
+        raise ValueError("Recommender " + str(recommender) + " cannot be exported: it has no snapshot of its factors. Unset rec.export.path")
+
+    num_thread = properties.getProperty("rec.number.thread")
+    num_workers = properties.getProperty("rec.train.workers", 0)
+
+    if num_workers > 1 and not models[recommender].data_parallel:
+        raise ValueError("Recommender " + str(recommender) + " does not support data-parallel training. Set rec.train.workers=1")
+    # rec.train.workers=1 runs a single worker, the baseline of the logged scaling
+    if num_workers > 0 and models[recommender].data_parallel:
+        if properties.getProperty("hogwild_workers", 0) > 0:
+            raise ValueError("hogwild_workers and rec.train.workers cannot be combined")
+        logger.info("training with %d data-parallel workers" % num_workers)
+        parallel.run_workers(num_workers, _train, recommender, num_thread)
+    else:
+        _train(recommender, num_thread)
+
+def _train(recommender, num_thread):
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
-    num_thread = properties.getProperty("rec.number.thread")
 
     with tf.Session(config=config) as sess:
         model = models[recommender](sess=sess)
         model.build_graph()
         sess.run(tf.global_variables_initializer())
+        # starts every worker from the same weights
+        parallel.synchronize_variables(sess)
         model.train_model()
-        Evaluate.test_model(model, dataset, num_thread)
+        if parallel.is_chief():
+            Evaluate.test_model(model, dataset, num_thread)
+            export_path = properties.getProperty("rec.export.path", None)
+            if export_path is not None:
+                artifact.export_model(model, export_path)
+
+def loadArtifact(path, evaluate=False):
+    """Opens a model exported with rec.export.path, for scoring without TensorFlow.
+
+    path -- version directory of the artifact, or its base directory for the newest version
+    evaluate -- attach the dataset of setup() so the artifact can be evaluated (default False)
+    """
+    if evaluate and not isinstance(dataset, Dataset):
+        raise RuntimeError("Dataset not set. Call setup() function and pass a properties file to set the dataset")
+    return artifact.Artifact(path, dataset if evaluate else None)
 
 def listModels():
     """Returns a list of available models."""
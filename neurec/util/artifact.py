@@ -0,0 +1,186 @@
+"""Exported models: versioned directories of NumPy factors that can be scored without TensorFlow.
+
+An artifact directory holds
+    manifest.json -- format version, model type, properties, sizes and the list of files
+    user_factors.npy, item_factors.npy -- the factors of the model's snapshot
+    item_bias.npy -- the item biases, for the models that have them
+    user_ids.npy, item_ids.npy -- the raw id of every inner id, unless the ids are hashed
+
+The arrays are plain .npy files, so Artifact opens them with np.load(mmap_mode="r"):
+opening takes milliseconds whatever their size, and the processes that open the
+same artifact share its pages.
+"""
+import json
+import logging
+import os
+import shutil
+import time
+import numpy as np
+from neurec.util.hashing import HashedIds
+from neurec.util.snapshot import EmbeddingSnapshot
+
+FORMAT_VERSION = 1
+
+def export_model(model, base_path):
+    """Writes the model to a new version directory of base_path and returns its path.
+
+    Versions are numbered 1, 2, ...; a number is reserved by creating its
+    directory, so concurrent exports get different versions, and a version is
+    complete once its manifest.json appears.
+
+    model -- trained model whose snapshot() returns an EmbeddingSnapshot
+    base_path -- directory holding the versions of the artifact
+    """
+    snapshot = model.snapshot()
+    if snapshot is None:
+        raise ValueError("Model " + model.__class__.__name__ + " cannot be exported: it has no snapshot of its factors")
+
+    dataset = model.dataset
+    arrays = {"user_factors": snapshot.user_embeddings, "item_factors": snapshot.item_embeddings}
+    if snapshot.item_bias is not None:
+        arrays["item_bias"] = snapshot.item_bias
+    ids = {}
+    for kind, id_map in (("user", dataset.userids), ("item", dataset.itemids)):
+        if isinstance(id_map, HashedIds):
+            ids[kind] = {"hash_buckets": id_map.num_buckets, "salt": id_map.salt.decode()}
+        else:
+            raw_ids = np.empty(len(id_map), dtype=object)
+            raw_ids[list(id_map.values())] = list(id_map.keys())
+            arrays[kind + "_ids"] = raw_ids.astype(str)
+            ids[kind] = {"file": kind + "_ids.npy"}
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "model": model.__class__.__name__,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "dataset": dataset.dataset_name,
+        "fingerprint": dataset.fingerprint(),
+        "num_users": model.num_users,
+        "num_items": model.num_items,
+        "topk": model.topK,
+        "clip_negative": snapshot.clip_negative,
+        "arrays": {name: name + ".npy" for name in arrays},
+        "ids": ids,
+        "properties": model.conf,
+    }
+
+    os.makedirs(base_path, exist_ok=True)
+    while True:
+        versions = [int(name) for name in os.listdir(base_path) if name.isdigit()]
+        path = os.path.join(base_path, str(max(versions, default=0) + 1))
+        try:
+            os.mkdir(path)
+            break
+        except FileExistsError:
+            # taken by a concurrent export
+            continue
+    temp_path = os.path.join(base_path, ".%s.%d.tmp" % (os.path.basename(path), os.getpid()))
+    os.makedirs(temp_path)
+    try:
+        for name, array in arrays.items():
+            np.save(os.path.join(temp_path, name + ".npy"), np.ascontiguousarray(array))
+        with open(os.path.join(temp_path, "manifest.json"), "w") as file:
+            json.dump(manifest, file, indent=2, default=str)
+        # the manifest comes last, completing the version
+        for name in sorted(os.listdir(temp_path), key=lambda name: name == "manifest.json"):
+            os.rename(os.path.join(temp_path, name), os.path.join(path, name))
+        os.rmdir(temp_path)
+    except BaseException:
+        shutil.rmtree(temp_path, ignore_errors=True)
+        shutil.rmtree(path, ignore_errors=True)
+        raise
+
+    logging.getLogger(__name__).info("exported %s to %s" % (manifest["model"], path))
+    return path
+
+def latest_version(base_path):
+    """Returns the path of the newest complete version directory of base_path."""
+    versions = [int(name) for name in os.listdir(base_path)
+                if name.isdigit() and os.path.exists(os.path.join(base_path, name, "manifest.json"))]
+    if not versions:
+        raise FileNotFoundError("No exported versions in " + str(base_path))
+    return os.path.join(base_path, str(max(versions)))
+
+class Artifact(EmbeddingSnapshot):
+    """An exported model opened for scoring, with memory-mapped factors.
+
+    It has the scoring interface of EmbeddingSnapshot, so it can be evaluated
+    in place of the model once a dataset is given.
+    """
+    def __init__(self, path, dataset=None):
+        """Opens an artifact.
+
+        path -- version directory written by export_model, or its base directory for the newest version
+        dataset -- dataset to evaluate the artifact on (default None)
+        """
+        if not os.path.exists(os.path.join(path, "manifest.json")):
+            path = latest_version(path)
+        with open(os.path.join(path, "manifest.json")) as file:
+            manifest = json.load(file)
+        if manifest["format_version"] > FORMAT_VERSION:
+            raise ValueError("Artifact " + str(path) + " has format version " + str(manifest["format_version"])
+                             + ", this version of neurec reads up to " + str(FORMAT_VERSION))
+
+        self.path = path
+        self.manifest = manifest
+        self.model_name = manifest["model"]
+        self.properties = manifest["properties"]
+        self.dataset = dataset
+        self.num_users = manifest["num_users"]
+        self.num_items = manifest["num_items"]
+        self.topK = manifest["topk"]
+        self.clip_negative = manifest["clip_negative"]
+        arrays = {name: np.load(os.path.join(path, file), mmap_mode="r") for name, file in manifest["arrays"].items()}
+        self.user_embeddings = arrays["user_factors"]
+        self.item_embeddings = arrays["item_factors"]
+        self.item_bias = arrays.get("item_bias")
+        self.raw_ids = {}
+        self.id_maps = {}
+        for kind, ids in manifest["ids"].items():
+            if "hash_buckets" in ids:
+                self.id_maps[kind] = HashedIds(ids["hash_buckets"], ids["salt"])
+            else:
+                self.raw_ids[kind] = arrays[kind + "_ids"]
+
+    def get_inner_ids(self, kind, raw_ids):
+        """Returns the inner ids of raw ids, -1 for the ids unknown to the model.
+
+        kind -- "user" or "item"
+        raw_ids -- sequence of raw ids
+        """
+        if kind in self.id_maps:
+            return self.id_maps[kind].get_buckets(raw_ids)
+        if kind + "_order" not in self.raw_ids:
+            # sorting once per process keeps the lookups logarithmic without a dictionary
+            self.raw_ids[kind + "_order"] = np.argsort(self.raw_ids[kind])
+        known_ids, order = self.raw_ids[kind], self.raw_ids[kind + "_order"]
+        raw_ids = np.asarray(raw_ids, dtype=str)
+        position = np.minimum(np.searchsorted(known_ids, raw_ids, sorter=order), len(order) - 1)
+        inner_ids = order[position].astype(np.int32)
+        inner_ids[known_ids[inner_ids] != raw_ids] = -1
+        return inner_ids
+
+    def get_raw_ids(self, kind, inner_ids):
+        """Returns the raw ids of inner ids.
+
+        kind -- "user" or "item"
+        inner_ids -- array of inner ids
+        """
+        if kind in self.id_maps:
+            raise ValueError("The raw " + kind + " ids are hashed and cannot be recovered")
+        return self.raw_ids[kind][np.asarray(inner_ids)]
+
+    def recommend(self, user_id, k=None, exclude=None):
+        """Returns the inner ids of the k best items of a user, best first.
+
+        user_id -- inner id of the user
+        k -- number of items (default, the artifact's topk)
+        exclude -- inner ids of items not to recommend, e.g. the training items (default None)
+        """
+        k = self.topK if k is None else k
+        ratings = self.predict(user_id, np.arange(self.num_items))
+        if exclude is not None:
+            ratings[np.asarray(exclude)] = -np.inf
+        k = min(k, self.num_items)
+        best = np.argpartition(-ratings, k - 1)[:k]
+        return best[np.argsort(-ratings[best], kind="stable")]
@@ -0,0 +1,73 @@
+"""On-disk cache of matrices derived from the training data.
+
+Cached files are named after the dataset fingerprint, so they are reused by every
+run on the same training split and ignored as soon as the split changes.
+"""
+import logging
+import os
+import numpy as np
+import scipy.sparse as sp
+from neurec.util.properties import Properties
+
+def get_cache_path(dataset, name):
+    """Returns the path of a cache file of a dataset.
+
+    The directory is set by the data.cache.path property (default, a cache
+    directory next to the dataset files).
+
+    dataset -- dataset the cached data was derived from
+    name -- name of the cached data, including the settings it depends on
+    """
+    directory = Properties().getProperty("data.cache.path", None)
+    if directory is None:
+        directory = os.path.join(dataset.path, "cache")
+    return os.path.join(directory, "%s_%s_%s.npz" % (dataset.dataset_name, name, dataset.fingerprint()))
+
+def cached_sparse_matrix(dataset, name, build):
+    """Returns a sparse matrix from the cache, building and caching it when missing.
+
+    dataset -- dataset the matrix is derived from
+    name -- name of the matrix, including the settings it depends on
+    build -- function returning the matrix
+    """
+    return _cached(dataset, name, build, sp.load_npz, sp.save_npz)
+
+def cached_arrays(dataset, name, build):
+    """Returns a list of arrays from the cache, building and caching them when missing.
+
+    dataset -- dataset the arrays are derived from
+    name -- name of the arrays, including the settings they depend on
+    build -- function returning a list of arrays
+    """
+    def load(path):
+        with np.load(path) as data:
+            return [data["arr_%d" % i] for i in range(len(data.files))]
+
+    def save(file, arrays):
+        np.savez(file, *arrays)
+
+    return _cached(dataset, name, build, load, save)
+
+def _cached(dataset, name, build, load, save):
+    logger = logging.getLogger(__name__)
+    path = get_cache_path(dataset, name)
+    if os.path.exists(path):
+        try:
+            value = load(path)
+            logger.info("loaded %s from %s" % (name, path))
+            return value
+        except (OSError, ValueError, KeyError) as error:
+            logger.warning("could not read %s, rebuilding it: %s" % (path, error))
+
+    value = build()
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first, so concurrent runs never read a partial file
+        temp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(temp_path, "wb") as file:
+            save(file, value)
+        os.replace(temp_path, path)
+        logger.info("saved %s to %s" % (name, path))
+    except OSError as error:
+        logger.warning("could not cache %s: %s" % (name, error))
+    return value
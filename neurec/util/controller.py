@@ -0,0 +1,139 @@
+"""Controls the evaluation schedule of a model's training loop."""
+import logging
+import tensorflow as tf
+from concurrent.futures import ThreadPoolExecutor
+from neurec.evaluation import Evaluate
+from neurec.util import parallel
+from neurec.util.properties import Properties
+
+class TrainingController(object):
+    """Evaluates a model during training and decides when it should stop.
+
+    The controller monitors one evaluation metric. When a validation set is
+    available (data.validation=true) the metric is read from the validation set,
+    otherwise from the test set. Training stops after `patience` evaluations
+    without improvement; a patience of 0 disables early stopping.
+
+    With asynchronous evaluation, models that can take a snapshot of their
+    factors are evaluated by a background worker while training continues.
+    Results are logged with the epoch they were taken at, and early stopping
+    acts on them as soon as they are ready.
+    """
+    def __init__(self, model, metric="ndcg", patience=0, restore=True, asynchronous=False):
+        """Setups the controller for a model.
+
+        model -- model being trained
+        metric -- name of the metric to monitor (default "ndcg")
+        patience -- evaluations without improvement before stopping (default 0, never stop)
+        restore -- restore the weights of the best evaluation when training finishes (default True)
+        asynchronous -- evaluate snapshots in a background worker (default False)
+        """
+        self.logger = logging.getLogger(__name__)
+        self.model = model
+        self.metric = metric.lower()
+        self.patience = patience
+        self.restore = restore
+        self.asynchronous = asynchronous
+        self.best_epoch = None
+        self.best_score = None
+        self.best_weights = None
+        self.bad_evaluations = 0
+        self.executor = None
+        self.pending = []
+
+    @classmethod
+    def from_properties(cls, model):
+        """Returns a controller configured by the rec.earlystop.* and rec.evaluate.async properties."""
+        properties = Properties()
+        return cls(model,
+                   metric=properties.getProperty("rec.earlystop.metric", "ndcg"),
+                   patience=properties.getProperty("rec.earlystop.patience", 0),
+                   restore=properties.getProperty("rec.earlystop.restore", True),
+                   asynchronous=properties.getProperty("rec.evaluate.async", False))
+
+    def evaluate(self, epoch):
+        """Evaluates the model after an epoch and returns True when training should stop.
+
+        In data-parallel runs only the chief worker evaluates, and all workers stop together.
+
+        epoch -- index of the epoch that just finished
+        """
+        if not parallel.is_chief():
+            return parallel.share_flag(False)
+        return parallel.share_flag(self._evaluate_epoch(epoch))
+
+    def _evaluate_epoch(self, epoch):
+        snapshot = self.model.snapshot() if self.asynchronous else None
+        if snapshot is None:
+            results = self._evaluate(self.model)
+            return self._update(epoch, results, self._get_weights)
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        weights = self._get_weights() if self._keeps_weights() else None
+        future = self.executor.submit(self._evaluate, snapshot, " (iter %d)" % (epoch + 1))
+        self.pending.append((epoch, future, weights))
+        return self._collect(wait=False)
+
+    def finish(self):
+        """Waits for background evaluations and restores the weights of the best evaluation."""
+        self._collect(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.best_weights is None:
+            return
+
+        self._set_weights(self.best_weights)
+        self.logger.info("[restored weights of iter %d: %s = %.6f]"
+                         % (self.best_epoch + 1, self.metric, self.best_score))
+        self.best_weights = None
+
+    def _evaluate(self, model, tag=""):
+        dataset = self.model.dataset
+        if dataset.validMatrix is not None:
+            return Evaluate.evaluate_model(model, dataset, dataset.validMatrix, dataset.validNegatives, tag="Valid" + tag)
+        return Evaluate.evaluate_model(model, dataset, dataset.testMatrix, dataset.testNegatives, tag="Test" + tag)
+
+    def _collect(self, wait):
+        stop = False
+        while self.pending and (wait or self.pending[0][1].done()):
+            epoch, future, weights = self.pending.pop(0)
+            stop = self._update(epoch, future.result(), lambda: weights) or stop
+        return stop
+
+    def _update(self, epoch, results, get_weights):
+        if self.patience <= 0:
+            return False
+
+        try:
+            score = results[self.metric]
+        except KeyError:
+            raise KeyError("Metric " + str(self.metric) + " not available. Choose one of " + str(list(results)))
+
+        if self.best_score is None or score > self.best_score:
+            self.best_epoch = epoch
+            self.best_score = score
+            self.bad_evaluations = 0
+            if self.restore:
+                self.best_weights = get_weights()
+            return False
+
+        self.bad_evaluations += 1
+        if self.bad_evaluations >= self.patience:
+            self.logger.info("[early stop at iter %d: best %s = %.6f at iter %d]"
+                             % (epoch + 1, self.metric, self.best_score, self.best_epoch + 1))
+            return True
+        return False
+
+    def _keeps_weights(self):
+        return self.restore and self.patience > 0
+
+    def _get_weights(self):
+        return self.model.sess.run(tf.trainable_variables())
+
+    def _set_weights(self, weights):
+        for variable, value in zip(tf.trainable_variables(), weights):
+            variable.load(value, self.model.sess)
+        self.model.invalidate_snapshot()
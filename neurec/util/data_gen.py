@@ -1,4 +1,7 @@
 import numpy as np
+from neurec.util.parallel import sharded
+
+@sharded
 def _get_pairwise_all_data(dataset):
     user_input, item_input_pos,item_input_neg = [], [], []
     trainMatrix = dataset.trainMatrix
@@ -21,6 +24,7 @@ def _get_pairwise_all_data(dataset):
     item_input_neg=item_input_neg[shuffle_index]
     return user_input, item_input_pos,item_input_neg 
 
+@sharded
 def _get_pairwise_all_highorder_data(dataset,high_order):
     user_input, item_input_pos,item_input_recents,item_input_neg = [], [], [],[]
     trainMatrix = dataset.trainMatrix
@@ -55,6 +59,7 @@ def _get_pairwise_all_highorder_data(dataset,high_order):
     item_input_neg = item_input_neg[shuffle_index]    
     return user_input, item_input_pos,item_input_recents,item_input_neg 
 
+@sharded
 def _get_pairwise_all_firstorder_data(dataset):
     user_input, item_input_pos,item_input_recent,item_input_neg = [], [], [],[]
     trainMatrix = dataset.trainMatrix
@@ -86,6 +91,7 @@ def _get_pairwise_all_firstorder_data(dataset):
     item_input_neg = item_input_neg[shuffle_index]    
     return user_input,item_input_pos,item_input_recent,item_input_neg 
 
+@sharded
 def _get_pairwise_all_likefism_data(dataset):
     user_input_pos,user_input_neg, num_idx_pos, num_idx_neg, item_input_pos,item_input_neg = [], [], [],[],[],[]
     trainMatrix = dataset.trainMatrix
@@ -124,6 +130,7 @@ def _get_pairwise_all_likefism_data(dataset):
     item_input_neg = item_input_neg[shuffle_index]    
     return user_input_pos,user_input_neg, num_idx_pos, num_idx_neg, item_input_pos,item_input_neg
 
+@sharded
 def _get_pointwise_all_likefism_data(dataset,num_negatives):
     user_input,num_idx,item_input,lables = [],[],[],[]
     num_users = dataset.num_users
@@ -161,6 +168,7 @@ def _get_pointwise_all_likefism_data(dataset,num_negatives):
     lables = lables[shuffle_index]
     return user_input,num_idx,item_input,lables
 
+@sharded
 def _get_pointwise_all_data(dataset,num_negatives):
     user_input,item_input,lables = [],[],[]
     trainMatrix = dataset.trainMatrix
@@ -189,6 +197,7 @@ def _get_pointwise_all_data(dataset,num_negatives):
     lables = lables[shuffle_index]
     return user_input,item_input,lables
 
+@sharded
 def _get_pointwise_all_highorder_data(dataset,high_order,num_negatives):
     user_input, item_input,item_input_recents,lables = [], [], [], []
     trainMatrix = dataset.trainMatrix
@@ -231,6 +240,7 @@ def _get_pointwise_all_highorder_data(dataset,high_order,num_negatives):
     lables = lables[shuffle_index]    
     return user_input, item_input, item_input_recents, lables 
 
+@sharded
 def _get_pointwise_all_firstorder_data(dataset,num_negatives):
     trainMatrix = dataset.trainMatrix
     trainDict = dataset.trainDict 
@@ -0,0 +1,297 @@
+"""Embedding tables that can be split into several variables along their rows, or compressed.
+
+The tables of very large vocabularies are partitioned with the embedding_partitioner
+property:
+    none -- one variable per table (default)
+    fixed -- embedding_partitions shards of equal size
+    min_max -- shards of at least embedding_min_slice_bytes bytes (default 256KB),
+               and at most embedding_partitions of them
+
+Lookups gather the rows of every shard in parallel. tf.train.Saver stores a
+partitioned table as a single variable, so a checkpoint can be restored with
+any partitioning of the tables.
+
+With embedding_hash_rows > 0, tables with more rows are stored as hash embeddings
+(see HashedTable) of embedding_hash_rows rows and embedding_hash_functions
+hashes (default 2), so their memory does not depend on the number of ids.
+
+Item tables created with the training counts of the items are compressed by
+popularity (see FrequencyTable) with the embedding_compression property:
+    none -- one full row per item (default)
+    mixed -- the tail items, with fewer than embedding_tail_count training
+             interactions (default 5), have embedding_tail_size factors (default
+             an eighth of the factors), projected to all the factors by a shared matrix
+    shared -- the tail items share embedding_shared_rows full rows (default 1024)
+"""
+from abc import ABC, abstractmethod
+import logging
+import zlib
+import numpy as np
+import tensorflow as tf
+from neurec.util.properties import Properties
+
+# a Mersenne prime larger than any id, for the universal hashes
+_PRIME = (1 << 31) - 1
+
+class CompositeTable(ABC):
+    """Abstract class of the embedding tables assembled from several tables, its parts.
+
+    Subclasses set num_rows and parts, and define lookup and expand.
+    """
+    @abstractmethod
+    def lookup(self, ids):
+        """Returns the rows at ids."""
+        pass
+
+    @abstractmethod
+    def expand(self, values):
+        """Returns the whole table from the NumPy values of the parts."""
+        pass
+
+class HashedTable(CompositeTable):
+    """An embedding table whose rows are sums of the rows of a smaller table.
+
+    Row i is the sum of the rows h_1(i), ..., h_k(i) of the shared table, with the
+    universal hashes h_j(i) = ((a_j i + b_j) mod p) mod hash_rows. Two ids get the
+    same embedding only when all their k hashes collide.
+    """
+    def __init__(self, table, num_rows, num_hashes, seed):
+        """Setups the hashes of the table.
+
+        table -- shared table, a variable or a partitioned variable
+        num_rows -- number of rows (ids) of the table
+        num_hashes -- number of rows summed per id
+        seed -- seed of the hash coefficients
+        """
+        self.parts = [table]
+        self.num_rows = num_rows
+        self.hash_rows = table.shape[0].value
+        random_state = np.random.RandomState(seed)
+        self.a = random_state.randint(1, _PRIME, size=num_hashes).astype(np.int64)
+        self.b = random_state.randint(0, _PRIME, size=num_hashes).astype(np.int64)
+
+    def lookup(self, ids):
+        # one more axis for the k hashes
+        ids = tf.cast(tf.expand_dims(ids, -1), tf.int64)
+        rows = tf.mod(tf.mod(ids * self.a + self.b, _PRIME), self.hash_rows)
+        return tf.reduce_sum(lookup(self.parts[0], rows), axis=-2)
+
+    def expand(self, values):
+        ids = np.arange(self.num_rows, dtype=np.int64)[:, None]
+        return np.sum(values[0][(ids * self.a + self.b) % _PRIME % self.hash_rows], axis=1)
+
+class FrequencyTable(CompositeTable):
+    """An item table that stores the rows of the rare (tail) items in a smaller table.
+
+    The head items have their own rows in the head table. The tail rows are read
+    from the tail table, then multiplied by the projection when they have fewer
+    factors than the head rows.
+    """
+    def __init__(self, head, tail, projection, is_head, positions):
+        """Setups the table from its parts.
+
+        head -- table of the head items
+        tail -- table of the tail items
+        projection -- [tail factors, factors] variable, or None when the tail rows have all the factors
+        is_head -- boolean array, True for the head items
+        positions -- array of the row of every item in its table
+        """
+        self.parts = [head, tail] + ([projection] if projection is not None else [])
+        self.num_rows = len(is_head)
+        self.num_factors = head.shape[1].value
+        self.is_head = is_head
+        self.positions = positions
+        self.has_projection = projection is not None
+        self._bands = tf.constant(is_head.astype(np.int32))
+        self._positions = tf.constant(positions)
+
+    def lookup(self, ids):
+        flat_ids = tf.reshape(ids, [-1])
+        bands = tf.gather(self._bands, flat_ids)
+        tail_positions, head_positions = tf.dynamic_partition(tf.gather(self._positions, flat_ids), bands, 2)
+        tail_index, head_index = tf.dynamic_partition(tf.range(tf.size(flat_ids)), bands, 2)
+        tail_rows = lookup(self.parts[1], tail_positions)
+        if self.has_projection:
+            tail_rows = tf.matmul(tail_rows, self.parts[2])
+        rows = tf.dynamic_stitch([tail_index, head_index], [tail_rows, lookup(self.parts[0], head_positions)])
+        return tf.reshape(rows, tf.concat([tf.shape(ids), [self.num_factors]], 0))
+
+    def expand(self, values):
+        table = np.empty((self.num_rows, self.num_factors), dtype=values[0].dtype)
+        table[self.is_head] = values[0][self.positions[self.is_head]]
+        tail_rows = values[1][self.positions[~self.is_head]]
+        table[~self.is_head] = np.dot(tail_rows, values[2]) if self.has_projection else tail_rows
+        return table
+
+def get_partitioner():
+    """Returns the partitioner set by the embedding_* properties, or None."""
+    properties = Properties()
+    partitioner = properties.getProperty("embedding_partitioner", "none").lower()
+    num_partitions = properties.getProperty("embedding_partitions", 1)
+    if partitioner == "none":
+        return None
+    if partitioner == "fixed":
+        return tf.fixed_size_partitioner(num_partitions)
+    if partitioner == "min_max":
+        min_slice_bytes = properties.getProperty("embedding_min_slice_bytes", 256 << 10)
+        return tf.min_max_variable_partitioner(max_partitions=num_partitions, min_slice_size=min_slice_bytes)
+    raise ValueError("Embedding partitioner " + str(partitioner) + " not recognised. Choose one of none, fixed, min_max")
+
+def embedding_table(name, shape, initializer, counts=None):
+    """Returns a float32 embedding table, partitioned and compressed as configured.
+
+    name -- name of the table
+    shape -- [rows, factors]
+    initializer -- TensorFlow initializer, or array of the initial values
+    counts -- training interactions of every row, to compress an item table by popularity (default None)
+    """
+    properties = Properties()
+    compression = properties.getProperty("embedding_compression", "none").lower()
+    hash_rows = properties.getProperty("embedding_hash_rows", 0)
+    if counts is not None and compression != "none":
+        if isinstance(initializer, np.ndarray):
+            raise ValueError("Pretrained embeddings cannot be compressed. Set embedding_compression=none")
+        return _frequency_table(name, shape, initializer, np.asarray(counts), compression)
+
+    if hash_rows <= 0 or hash_rows >= shape[0]:
+        if isinstance(initializer, np.ndarray):
+            initializer = _array_initializer(initializer)
+        return tf.get_variable(name, shape=shape, dtype=tf.float32, initializer=initializer,
+                               partitioner=get_partitioner())
+
+    if isinstance(initializer, np.ndarray):
+        raise ValueError("Pretrained embeddings cannot be hashed. Set embedding_hash_rows=0")
+    num_hashes = properties.getProperty("embedding_hash_functions", 2)
+    table = tf.get_variable(name, shape=[hash_rows, shape[1]], dtype=tf.float32, initializer=initializer,
+                            partitioner=get_partitioner())
+    _log_memory(name, "%d rows hashed %d ways into %d rows" % (shape[0], num_hashes, hash_rows),
+                hash_rows * shape[1], shape)
+    return HashedTable(table, shape[0], num_hashes, zlib.crc32(name.encode()))
+
+def _frequency_table(name, shape, initializer, counts, compression):
+    properties = Properties()
+    is_head = counts >= properties.getProperty("embedding_tail_count", 5)
+    num_head = int(np.count_nonzero(is_head))
+    num_tail = len(is_head) - num_head
+    positions = np.empty(len(is_head), dtype=np.int32)
+    positions[is_head] = np.arange(num_head)
+    positions[~is_head] = np.arange(num_tail)
+
+    projection = None
+    if compression == "mixed":
+        tail_size = properties.getProperty("embedding_tail_size", max(shape[1] // 8, 1))
+        tail_shape = [num_tail, tail_size]
+        projection = tf.get_variable(name + "_projection", shape=[tail_size, shape[1]], dtype=tf.float32,
+                                     initializer=tf.glorot_uniform_initializer())
+    elif compression == "shared":
+        shared_rows = properties.getProperty("embedding_shared_rows", 1024)
+        positions[~is_head] %= shared_rows
+        tail_shape = [min(num_tail, shared_rows), shape[1]]
+    else:
+        raise ValueError("Embedding compression " + str(compression) + " not recognised. Choose one of none, mixed, shared")
+
+    # variables need at least one row, even when a band is empty
+    head = tf.get_variable(name, shape=[max(num_head, 1), shape[1]], dtype=tf.float32,
+                           initializer=initializer, partitioner=get_partitioner())
+    tail = tf.get_variable(name + "_tail", shape=[max(tail_shape[0], 1), tail_shape[1]], dtype=tf.float32,
+                           initializer=initializer, partitioner=get_partitioner())
+    size = num_head * shape[1] + tail_shape[0] * tail_shape[1]
+    if projection is not None:
+        size += tail_shape[1] * shape[1]
+    _log_memory(name, "%d head rows, %d tail items in %d x %d rows" % (num_head, num_tail, tail_shape[0], tail_shape[1]),
+                size, shape)
+    return FrequencyTable(head, tail, projection, is_head, positions)
+
+def _log_memory(name, description, size, shape):
+    logging.getLogger(__name__).info("%s: %s, %.1f MB instead of %.1f MB (%.1fx smaller)"
+                                     % (name, description, size * 4 / 2**20, shape[0] * shape[1] * 4 / 2**20,
+                                        shape[0] * shape[1] / max(size, 1)))
+
+def _array_initializer(values):
+    def initializer(shape, dtype=tf.float32, partition_info=None):
+        offset = 0 if partition_info is None else partition_info.var_offset[0]
+        return tf.constant(values[offset:offset + shape[0]], dtype=dtype)
+    return initializer
+
+def lookup(table, ids):
+    """Returns the rows of table at ids.
+
+    table -- embedding table
+    ids -- tensor of row ids
+    """
+    if isinstance(table, CompositeTable):
+        return table.lookup(ids)
+    # the partitioners give contiguous row ranges to the shards, which is the "div" strategy
+    return tf.nn.embedding_lookup(table, ids, partition_strategy="div")
+
+def is_compressed(table):
+    """Returns True when table does not store one row per id, so it cannot be loaded row by row."""
+    return isinstance(table, CompositeTable)
+
+def get_variables(table):
+    """Returns the list of variables holding the shards of table."""
+    if isinstance(table, CompositeTable):
+        return [variable for part in table.parts for variable in get_variables(part)]
+    if isinstance(table, tf.PartitionedVariable):
+        return list(table)
+    return [table]
+
+def as_tensor(table):
+    """Returns the whole table as one tensor, for the models that use every row."""
+    if isinstance(table, CompositeTable):
+        return table.lookup(tf.range(table.num_rows))
+    shards = get_variables(table)
+    return shards[0] if len(shards) == 1 else tf.concat(shards, 0)
+
+def gradient(loss, table):
+    """Returns the gradient of loss with respect to the looked up rows of table.
+
+    The result is a tf.IndexedSlices whose indices are rows of the whole table.
+
+    loss -- scalar tensor
+    table -- embedding table
+    """
+    if is_compressed(table):
+        raise ValueError("The gradient of the rows of compressed embedding tables is not available")
+    shards = get_variables(table)
+    grads = tf.gradients(loss, shards)
+    if len(shards) == 1:
+        return grads[0]
+    offsets = np.cumsum([0] + [variable.shape[0].value for variable in shards[:-1]])
+    indices = [grad.indices + tf.cast(offset, grad.indices.dtype) for grad, offset in zip(grads, offsets)]
+    return tf.IndexedSlices(tf.concat([grad.values for grad in grads], 0), tf.concat(indices, 0))
+
+def get_values(sess, tables):
+    """Returns NumPy copies of tables.
+
+    sess -- session holding the tables
+    tables -- list of embedding tables
+    """
+    values = sess.run([get_variables(table) for table in tables])
+    return [_assemble(table, shards) for table, shards in zip(tables, values)]
+
+def _assemble(table, shards):
+    # shards holds the values of get_variables(table), in the same order
+    if isinstance(table, CompositeTable):
+        parts = []
+        for part in table.parts:
+            num_shards = len(get_variables(part))
+            parts.append(_assemble(part, shards[:num_shards]))
+            shards = shards[num_shards:]
+        return table.expand(parts)
+    return shards[0] if len(shards) == 1 else np.concatenate(shards)
+
+def load(table, value, sess):
+    """Writes value into table, shard by shard.
+
+    table -- embedding table
+    value -- array of the shape of the whole table
+    sess -- session holding the table
+    """
+    if is_compressed(table):
+        raise ValueError("Compressed embedding tables cannot be loaded row by row")
+    start = 0
+    for variable in get_variables(table):
+        rows = variable.shape[0].value
+        variable.load(value[start:start + rows], sess)
+        start += rows
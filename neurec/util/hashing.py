@@ -0,0 +1,82 @@
+"""Hashing trick for unbounded user and item id spaces.
+
+With data.hash.users or data.hash.items set, the splitters map raw ids to a
+fixed number of buckets instead of numbering them in a dictionary, so memory
+does not grow with the number of distinct ids. Ids that fall into the same
+bucket share their row of the interaction matrix and of the embedding tables.
+"""
+import hashlib
+import math
+import numpy as np
+
+class HashedIds(object):
+    """Maps raw ids to inner ids by hashing, in place of a {raw id: inner id} dictionary.
+
+    Every raw id has an inner id, so `raw_id in ids` is always True, and len()
+    is the number of buckets. Only a bitmap of the used buckets is kept, from
+    which the number of distinct ids and of collisions is estimated.
+    """
+    def __init__(self, num_buckets, salt):
+        """Setups the map.
+
+        num_buckets -- number of inner ids
+        salt -- string making the hashes of different id spaces independent, e.g. "user"
+        """
+        self.num_buckets = num_buckets
+        self.salt = salt.encode()
+        self.used = np.zeros(num_buckets, dtype=bool)
+
+    def __contains__(self, raw_id):
+        return True
+
+    def __getitem__(self, raw_id):
+        digest = hashlib.blake2b(str(raw_id).encode(), digest_size=8, salt=self.salt).digest()
+        bucket = int.from_bytes(digest, "little") % self.num_buckets
+        self.used[bucket] = True
+        return bucket
+
+    def __len__(self):
+        return self.num_buckets
+
+    def get_buckets(self, raw_ids):
+        """Returns the inner ids of a sequence of raw ids as an int32 array."""
+        return np.array([self[raw_id] for raw_id in raw_ids], dtype=np.int32)
+
+    def collision_stats(self):
+        """Returns (used buckets, estimated distinct ids, estimated fraction of ids sharing a bucket).
+
+        The number of ids is estimated from the fraction of empty buckets, as by
+        linear counting.
+        """
+        num_used = int(np.count_nonzero(self.used))
+        num_empty = self.num_buckets - num_used
+        if num_empty == 0 or self.num_buckets == 1:
+            return num_used, float("inf"), 1.0
+        num_ids = math.log(num_empty / self.num_buckets) / math.log(1 - 1 / self.num_buckets)
+        if num_ids <= 0:
+            return num_used, 0.0, 0.0
+        # ids sharing a bucket = ids - buckets holding exactly one id, expected n (1 - 1/B)^(n-1) of them
+        num_alone = num_ids * (1 - 1 / self.num_buckets) ** (num_ids - 1)
+        return num_used, num_ids, 1 - num_alone / num_ids
+
+    def log_stats(self, logger, name):
+        """Logs the bucket usage and the estimated collision rate.
+
+        logger -- logger to write to
+        name -- name of the id space, e.g. "user"
+        """
+        num_used, num_ids, collision_rate = self.collision_stats()
+        logger.info("hashed %s ids into %d buckets: %d used, ~%.0f distinct ids, ~%.2f%% of them share a bucket"
+                    % (name, self.num_buckets, num_used, num_ids, 100 * collision_rate))
+
+def log_stats(logger, userids, itemids):
+    """Logs the collision statistics of the hashed ones of the user and item id maps."""
+    for ids, name in ((userids, "user"), (itemids, "item")):
+        if isinstance(ids, HashedIds):
+            ids.log_stats(logger, name)
+
+def get_id_map(num_buckets, salt):
+    """Returns a HashedIds map when num_buckets > 0, else an empty dictionary to number the ids."""
+    if num_buckets > 0:
+        return HashedIds(num_buckets, salt)
+    return {}
@@ -0,0 +1,173 @@
+"""Lock-free multi-process SGD (Hogwild) for pairwise dot-product models.
+
+The factor tables live in multiprocessing.shared_memory. Every epoch the sampled
+training triples are copied to shared memory and split into contiguous shards,
+and each worker process runs minibatch BPR steps on its shard, reading and
+writing the shared tables without locks.
+
+A model is described by its tables and its score terms. The score of an item i
+for the query columns x is the sum over the terms (query_table, query_column,
+item_table) of <tables[query_table][x[query_column]], tables[item_table][i]>.
+MF has one term (users, 0, items); FPMC adds the transition term of the recent item.
+"""
+import multiprocessing as mp
+import queue
+import numpy as np
+from neurec.util import embedding
+from neurec.util.shared import SharedArray
+
+def _scatter_add(table, rows, values):
+    # sums the values of repeated rows before adding them, which is much faster than np.add.at
+    order = np.argsort(rows, kind="stable")
+    rows = rows[order]
+    starts = np.concatenate(([0], np.flatnonzero(rows[1:] != rows[:-1]) + 1))
+    table[rows[starts]] += np.add.reduceat(values[order], starts, axis=0)
+
+def bpr_step(tables, terms, queries, item_pos, item_neg, learning_rate, reg):
+    """Applies one SGD step of the regularized BPR loss in place and returns the loss.
+
+    tables -- list of factor tables
+    terms -- list of (query_table, query_column, item_table) score terms
+    queries -- list of query columns of the batch (user ids, recent items, ...)
+    item_pos -- positive items of the batch
+    item_neg -- negative items of the batch
+    learning_rate -- step size
+    reg -- weight of the squared norm of every looked up row
+    """
+    lookups = []
+    result = np.zeros(len(item_pos), dtype=np.float32)
+    for query_table, query_column, item_table in terms:
+        query = tables[query_table][queries[query_column]]
+        pos = tables[item_table][item_pos]
+        neg = tables[item_table][item_neg]
+        result += np.sum(query * (pos - neg), axis=1)
+        lookups.append((query, pos, neg))
+
+    loss = np.sum(np.logaddexp(0, -result))
+    # d(-log sigmoid(x))/dx = -sigmoid(-x)
+    weight = (0.5 * (1 - np.tanh(0.5 * result)))[:, None]
+    for (query_table, query_column, item_table), (query, pos, neg) in zip(terms, lookups):
+        loss += reg * (np.sum(np.square(query)) + np.sum(np.square(pos)) + np.sum(np.square(neg)))
+        _scatter_add(tables[query_table], queries[query_column], learning_rate * (weight * (pos - neg) - 2 * reg * query))
+        _scatter_add(tables[item_table], item_pos, learning_rate * (weight * query - 2 * reg * pos))
+        _scatter_add(tables[item_table], item_neg, learning_rate * (-weight * query - 2 * reg * neg))
+    return loss
+
+def _worker(table_specs, terms, learning_rate, reg, tasks, results):
+    tables = [SharedArray.attach(spec) for spec in table_specs]
+    arrays = [table.array for table in tables]
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        input_specs, start, end, batch_size = task
+        inputs = [SharedArray.attach(spec) for spec in input_specs]
+        try:
+            loss = 0.0
+            item_pos, item_neg = inputs[0].array, inputs[1].array
+            for batch_start in range(start, end, batch_size):
+                batch = slice(batch_start, min(batch_start + batch_size, end))
+                queries = [query.array[batch] for query in inputs[2:]]
+                loss += bpr_step(arrays, terms, queries, item_pos[batch], item_neg[batch], learning_rate, reg)
+            results.put(loss)
+        except Exception as error:
+            results.put(error)
+        finally:
+            for shared in inputs:
+                shared.close()
+    arrays = None
+    for table in tables:
+        table.close()
+
+class HogwildTrainer(object):
+    """Trains the factor tables of a pairwise dot-product model with Hogwild SGD.
+
+    The worker processes are forked once and live until close() is called; they
+    only run NumPy code, never TensorFlow.
+    """
+    def __init__(self, tables, terms, num_workers, learning_rate, reg):
+        """Copies the tables to shared memory and starts the workers.
+
+        tables -- list of initial factor tables, e.g. read from the model's variables
+        terms -- list of (query_table, query_column, item_table) score terms
+        num_workers -- number of worker processes
+        learning_rate -- SGD step size
+        reg -- weight of the squared norm of every looked up row
+        """
+        self.tables = [SharedArray.copy_of(np.asarray(table, dtype=np.float32)) for table in tables]
+        self.num_workers = num_workers
+        context = mp.get_context("fork")
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        table_specs = [table.spec() for table in self.tables]
+        self.workers = [context.Process(target=_worker, daemon=True,
+                                        args=(table_specs, terms, learning_rate, reg, self.tasks, self.results))
+                        for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def train_epoch(self, batch_size, queries, item_pos, item_neg):
+        """Runs one pass over the training triples and returns the total loss.
+
+        batch_size -- number of triples of a step
+        queries -- list of query columns (user ids, recent items, ...)
+        item_pos -- positive items
+        item_neg -- negative items
+        """
+        inputs = [SharedArray.copy_of(np.asarray(column, dtype=np.int64))
+                  for column in [item_pos, item_neg] + list(queries)]
+        try:
+            bounds = np.linspace(0, len(item_pos), self.num_workers + 1).astype(np.int64)
+            input_specs = [shared.spec() for shared in inputs]
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                self.tasks.put((input_specs, int(start), int(end), batch_size))
+            results = self._get_results()
+        finally:
+            for shared in inputs:
+                shared.close()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return float(np.sum(results))
+
+    def _get_results(self):
+        # polls, so that a worker killed without posting its result (e.g. by the OOM killer) fails the epoch
+        results = []
+        while len(results) < self.num_workers:
+            try:
+                results.append(self.results.get(timeout=1))
+            except queue.Empty:
+                dead = [worker for worker in self.workers if not worker.is_alive()]
+                if dead:
+                    raise RuntimeError("Hogwild workers died with exit codes " + str([worker.exitcode for worker in dead]))
+        return results
+
+    def get_tables(self):
+        """Returns copies of the current factor tables."""
+        return [table.array.copy() for table in self.tables]
+
+    def load_into(self, variables, sess):
+        """Writes the factor tables into TensorFlow variables, for evaluation or further training.
+
+        variables -- embedding tables matching the tables, in the same order
+        sess -- session holding the variables
+        """
+        for variable, table in zip(variables, self.tables):
+            embedding.load(variable, table.array, sess)
+
+    def close(self):
+        """Stops the workers and releases the shared memory."""
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        for table in self.tables:
+            table.close()
+        self.tables = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
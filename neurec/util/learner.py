@@ -1,20 +1,80 @@
 import tensorflow as tf
+from neurec.util import parallel
 def optimizer(learner,loss,learning_rate,momentum=0.9):
     optimizer=None
     if learner.lower() == "adagrad":
         optimizer = tf.train.AdagradOptimizer(learning_rate=learning_rate,\
-                     initial_accumulator_value=1e-8).minimize(loss)
+                     initial_accumulator_value=1e-8)
     elif learner.lower() == "rmsprop":
-        optimizer = tf.train.RMSPropOptimizer(learning_rate).minimize(loss)
+        optimizer = tf.train.RMSPropOptimizer(learning_rate)
     elif learner.lower() == "adam":
-        optimizer = tf.train.AdamOptimizer(learning_rate).minimize(loss)
+        optimizer = tf.train.AdamOptimizer(learning_rate)
     elif learner.lower() == "gd" :
-        optimizer = tf.train.GradientDescentOptimizer(learning_rate).minimize(loss)
+        optimizer = tf.train.GradientDescentOptimizer(learning_rate)
     elif learner.lower() == "momentum" :
-        optimizer = tf.train.MomentumOptimizer(learning_rate,momentum).minimize(loss)
+        optimizer = tf.train.MomentumOptimizer(learning_rate,momentum)
+    elif learner.lower() == "lazyadam":
+        # updates the moments of the looked up rows only
+        optimizer = tf.contrib.opt.LazyAdamOptimizer(learning_rate)
+    elif learner.lower() == "sparse_adagrad":
+        return sparse_adagrad(loss, learning_rate)
+    elif learner.lower() == "sparse_sgd":
+        return sparse_sgd(loss, learning_rate)
     else :
         raise ValueError("please select a suitable optimizer")
-    return optimizer
+    # averages the gradients over the workers in data-parallel runs
+    return parallel.minimize(optimizer, loss)
+
+def _gradients(loss):
+    variables = tf.trainable_variables()
+    gradients = tf.gradients(loss, variables)
+    return parallel.average_gradients(list(zip(gradients, variables)))
+
+def _sum_slices(grad):
+    # sums the slices of the rows looked up several times in the batch
+    rows, index = tf.unique(grad.indices)
+    values = tf.unsorted_segment_sum(grad.values, index, tf.size(rows))
+    return rows, values
+
+def sparse_sgd(loss, learning_rate):
+    """Returns a gradient descent step that writes the gradient rows of embedding
+    lookups with scatter_sub, so its cost scales with the batch, not the table."""
+    updates = []
+    for grad, var in _gradients(loss):
+        if isinstance(grad, tf.IndexedSlices):
+            updates.append(tf.scatter_sub(var, grad.indices, learning_rate * grad.values))
+        else:
+            updates.append(tf.assign_sub(var, learning_rate * grad))
+    return tf.group(*updates)
+
+def sparse_adagrad(loss, learning_rate, initial_accumulator_value=1e-8):
+    """Returns an Adagrad step with one accumulator per row of each variable.
+
+    The accumulator of a row sums the mean squared gradient of the row, and only
+    the rows looked up in the batch are read and written.
+    """
+    updates = []
+    for grad, var in _gradients(loss):
+        shape = var.shape.as_list()
+        reduce_axes = list(range(1, len(shape)))
+        accumulator = tf.Variable(tf.constant(initial_accumulator_value, shape=shape[:1] + [1] * len(reduce_axes)),
+                                  trainable=False, name=var.op.name.replace("/", "_") + "_accumulator")
+        if isinstance(grad, tf.IndexedSlices):
+            rows, values = _sum_slices(grad)
+            squares = tf.square(values)
+            if reduce_axes:
+                squares = tf.reduce_mean(squares, axis=reduce_axes, keepdims=True)
+            with tf.control_dependencies([tf.scatter_add(accumulator, rows, squares)]):
+                scale = learning_rate * tf.rsqrt(tf.gather(accumulator, rows))
+            updates.append(tf.scatter_sub(var, rows, scale * values))
+        else:
+            squares = tf.square(grad)
+            if reduce_axes:
+                squares = tf.reduce_mean(squares, axis=reduce_axes, keepdims=True)
+            with tf.control_dependencies([tf.assign_add(accumulator, squares)]):
+                scale = learning_rate * tf.rsqrt(accumulator.read_value())
+            updates.append(tf.assign_sub(var, scale * grad))
+    return tf.group(*updates)
 
 def pairwise_loss(loss_function,y,margin=1):
     loss=None
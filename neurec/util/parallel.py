@@ -0,0 +1,346 @@
+"""Local data-parallel training of TensorFlow models in several processes.
+
+Every worker process builds the same model and trains it on a shard of each
+epoch's training instances (see sharded). Before every update the gradients of
+the workers are exchanged over shared memory: dense gradients are averaged by an
+all-reduce, and the rows of sparse embedding gradients are gathered, so a step
+moves the looked up rows only. All workers apply the same update and keep
+identical weights. Only the chief worker, rank 0, evaluates the model; its early
+stopping decision is shared with the others. The chief logs the steps per second
+of every epoch, from which the scaling over the number of workers is read.
+
+Workers are forked from the calling process, so this mode runs on Linux only.
+Models opt in with the data_parallel class attribute: they must draw their
+training instances from neurec.util.data_gen and build their updates with
+minimize, so that all workers run the same number of steps.
+"""
+import functools
+import logging
+import multiprocessing as mp
+import os
+import threading
+from time import time
+import uuid
+import numpy as np
+import tensorflow as tf
+from neurec.util.shared import SharedArray, require_shared_memory
+
+_context = None
+
+class WorkerContext(object):
+    """Rank, synchronization primitives and step counters of a data-parallel worker."""
+    def __init__(self, rank, num_workers, barrier, token, seed):
+        self.rank = rank
+        self.num_workers = num_workers
+        self.barrier = barrier
+        self.token = token
+        self.seed = seed
+        self.buffers = []
+        self.num_buffers = 0
+        self.num_samples = 0
+        self.flag_reducer = None
+        self.num_instances = 0
+        self.num_steps = 0
+        self.epoch_start = None
+        self.last_step = None
+
+    def wait(self):
+        self.barrier.wait()
+
+    def shared(self, shape, dtype):
+        """Returns a new SharedArray seen by all workers; must be called by all workers in the same order."""
+        self.num_buffers += 1
+        name = "%s_%d" % (self.token, self.num_buffers)
+        if self.rank == 0:
+            buffer = SharedArray(shape, dtype, name=name)
+        self.wait()
+        if self.rank != 0:
+            buffer = SharedArray.attach((name, shape, np.dtype(dtype).str))
+        self.buffers.append(buffer)
+        return buffer
+
+    def release(self, buffer):
+        self.buffers.remove(buffer)
+        buffer.close()
+
+    def count_step(self):
+        self.num_steps += 1
+        self.last_step = time()
+
+    def log_epoch(self):
+        """Logs the throughput of the steps run since the last sampling, then resets the counters."""
+        if self.num_steps > 0 and self.epoch_start is not None and self.last_step > self.epoch_start:
+            elapsed = self.last_step - self.epoch_start
+            logging.getLogger(__name__).info("[data-parallel epoch %d : %d workers, %d steps in %fs, %.1f steps/sec, %.0f instances/sec]"
+                                             % (self.num_samples, self.num_workers, self.num_steps, elapsed,
+                                                self.num_steps / elapsed, self.num_instances / elapsed))
+        self.num_steps = 0
+
+    def close(self):
+        for buffer in self.buffers:
+            buffer.close()
+        self.buffers = []
+
+class AllReduce(object):
+    """Averages float32 arrays of a fixed total size over all workers.
+
+    Each worker writes its values to its row of a shared buffer, reduces one chunk
+    of the columns into the last row, and reads the whole last row back.
+    """
+    def __init__(self, context, size):
+        """Creates the shared buffer; must be called by all workers in the same order.
+
+        context -- WorkerContext of this worker
+        size -- total number of values reduced per call
+        """
+        self.context = context
+        self.buffer = context.shared((context.num_workers + 1, size), np.float32)
+        bounds = np.linspace(0, size, context.num_workers + 1).astype(np.int64)
+        self.chunk = slice(bounds[context.rank], bounds[context.rank + 1])
+
+    def mean(self, arrays):
+        """Returns the means of arrays over all workers, with their shapes."""
+        self.write(arrays)
+        self.context.wait()
+        self.reduce()
+        self.context.wait()
+        return self.read(arrays)
+
+    def write(self, arrays):
+        if arrays:
+            self.buffer.array[self.context.rank] = np.concatenate([np.ravel(array) for array in arrays])
+
+    def reduce(self):
+        buffer = self.buffer.array
+        num_workers = self.context.num_workers
+        buffer[num_workers, self.chunk] = np.mean(buffer[:num_workers, self.chunk], axis=0)
+
+    def read(self, arrays):
+        flat = self.buffer.array[self.context.num_workers].copy()
+        offsets = np.cumsum([0] + [np.size(array) for array in arrays])
+        return [flat[start:end].reshape(np.shape(array)) for array, start, end in zip(arrays, offsets[:-1], offsets[1:])]
+
+class GradientExchange(object):
+    """Averages dense gradients and gathers the rows of sparse gradients over all workers.
+
+    The dense gradients go through an AllReduce. Each worker writes the rows of
+    its sparse gradients to its slot of a shared buffer per gradient and reads the
+    rows of all workers back, scaled by 1 / num_workers: their concatenation,
+    with repeated indices, is the averaged gradient. The slots grow when a worker
+    has more rows than they hold.
+    """
+    def __init__(self, context, dense_size, row_sizes):
+        """Creates the shared buffers; must be called by all workers in the same order.
+
+        context -- WorkerContext of this worker
+        dense_size -- total number of values of the dense gradients
+        row_sizes -- number of values per row of each sparse gradient
+        """
+        self.context = context
+        self.dense = AllReduce(context, dense_size)
+        self.row_sizes = row_sizes
+        self.counts = context.shared((context.num_workers, max(len(row_sizes), 1)), np.int64)
+        self.slots = [None] * len(row_sizes)
+
+    def exchange(self, dense, sparse):
+        """Returns the averaged dense gradients and the gathered (indices, values) of the sparse ones.
+
+        dense -- list of dense gradients
+        sparse -- list of (indices, values) pairs
+        """
+        context = self.context
+        rank = context.rank
+        self.dense.write(dense)
+        self.counts.array[rank, :len(sparse)] = [len(indices) for indices, _ in sparse]
+        context.wait()
+        self.dense.reduce()
+        counts = self.counts.array.copy()
+        for i, (indices, values) in enumerate(sparse):
+            self._reserve(i, counts[:, i].max())
+            slot_indices, slot_values = self.slots[i]
+            slot_indices.array[rank, :len(indices)] = indices
+            slot_values.array[rank, :len(indices)] = np.reshape(values, (len(indices), self.row_sizes[i]))
+        context.wait()
+        gathered = []
+        for i, (_, values) in enumerate(sparse):
+            slot_indices, slot_values = self.slots[i]
+            gathered.append((np.concatenate([slot_indices.array[worker, :count] for worker, count in enumerate(counts[:, i])]),
+                             np.concatenate([slot_values.array[worker, :count] for worker, count in enumerate(counts[:, i])])
+                             .reshape((-1,) + np.shape(values)[1:]) / np.float32(context.num_workers)))
+        context.count_step()
+        return self.dense.read(dense), gathered
+
+    def _reserve(self, i, num_rows):
+        # every worker sees the same counts, so all of them enlarge the slots together
+        if self.slots[i] is not None and self.slots[i][0].array.shape[1] >= num_rows:
+            return
+        capacity = num_rows if self.slots[i] is None else max(num_rows, 2 * self.slots[i][0].array.shape[1])
+        if self.slots[i] is not None:
+            for buffer in self.slots[i]:
+                self.context.release(buffer)
+        num_workers = self.context.num_workers
+        self.slots[i] = (self.context.shared((num_workers, max(capacity, 1)), np.int64),
+                         self.context.shared((num_workers, max(capacity, 1), self.row_sizes[i]), np.float32))
+
+def is_active():
+    """Returns True in the processes of a data-parallel run."""
+    return _context is not None
+
+def is_chief():
+    """Returns True unless this process is a data-parallel worker other than rank 0."""
+    return _context is None or _context.rank == 0
+
+def share_flag(flag):
+    """Returns True on every worker when flag is True on any worker.
+
+    flag -- boolean of this worker
+    """
+    if _context is None:
+        return flag
+    if _context.flag_reducer is None:
+        _context.flag_reducer = AllReduce(_context, 1)
+    return bool(_context.flag_reducer.mean([np.array([float(flag)], dtype=np.float32)])[0][0] > 0)
+
+def average_gradients(grads_and_vars):
+    """Returns grads_and_vars with the gradients averaged over the workers.
+
+    Sparse gradients, such as those of embedding lookups, stay sparse: the rows of
+    all workers are gathered instead of reducing the whole table.
+
+    grads_and_vars -- list of (gradient, variable) pairs, as from Optimizer.compute_gradients
+    """
+    grads_and_vars = [(grad, var) for grad, var in grads_and_vars if grad is not None]
+    if _context is None or not grads_and_vars:
+        return grads_and_vars
+    dense = [(grad, var) for grad, var in grads_and_vars if not isinstance(grad, tf.IndexedSlices)]
+    sparse = [(grad, var) for grad, var in grads_and_vars if isinstance(grad, tf.IndexedSlices)]
+    exchange = GradientExchange(_context, sum(var.shape.num_elements() for _, var in dense),
+                                [var.shape[1:].num_elements() for _, var in sparse])
+
+    def exchange_arrays(*arrays):
+        dense_arrays = list(arrays[:len(dense)])
+        sparse_arrays = list(zip(arrays[len(dense)::2], arrays[len(dense) + 1::2]))
+        averaged, gathered = exchange.exchange(dense_arrays, sparse_arrays)
+        return averaged + [array for pair in gathered for array in pair]
+
+    inputs = [tf.cast(grad, tf.float32) for grad, _ in dense]
+    for grad, _ in sparse:
+        inputs += [tf.cast(grad.indices, tf.int64), tf.cast(grad.values, tf.float32)]
+    outputs = tf.py_func(exchange_arrays, inputs, [tf.float32] * len(dense) + [tf.int64, tf.float32] * len(sparse))
+
+    averaged = {}
+    for output, (grad, var) in zip(outputs[:len(dense)], dense):
+        output.set_shape(var.shape)
+        averaged[var] = tf.cast(output, var.dtype.base_dtype)
+    for indices, values, (grad, var) in zip(outputs[len(dense)::2], outputs[len(dense) + 1::2], sparse):
+        indices.set_shape([None])
+        values.set_shape(grad.values.shape)
+        averaged[var] = tf.IndexedSlices(tf.cast(values, grad.values.dtype), tf.cast(indices, grad.indices.dtype),
+                                         grad.dense_shape)
+    return [(averaged[var], var) for _, var in grads_and_vars]
+
+def minimize(optimizer, loss, var_list=None):
+    """Returns optimizer.minimize(loss), averaging the gradients over the workers in data-parallel runs.
+
+    optimizer -- tf.train.Optimizer
+    loss -- loss to minimize
+    var_list -- variables to update (default, all trainable variables)
+    """
+    if _context is None:
+        return optimizer.minimize(loss, var_list=var_list)
+    return optimizer.apply_gradients(average_gradients(optimizer.compute_gradients(loss, var_list=var_list)))
+
+def synchronize_variables(sess):
+    """Sets the trainable variables of every worker to their mean over the workers.
+
+    sess -- session holding the variables
+    """
+    if _context is None:
+        return
+    variables = tf.trainable_variables()
+    reducer = AllReduce(_context, sum(var.shape.num_elements() for var in variables))
+    for variable, value in zip(variables, reducer.mean(sess.run(variables))):
+        variable.load(value, sess)
+
+def sharded(sample):
+    """Decorates a data_gen sampler so that each worker gets its shard of the instances.
+
+    All workers draw the same instances from a common seed and keep equal, disjoint
+    slices of them, so they run the same number of batches. The seed of every
+    sampling is derived from the seed drawn by run_workers from the seed of setup().
+    """
+    @functools.wraps(sample)
+    def sample_shard(*args, **kwargs):
+        if _context is None:
+            return sample(*args, **kwargs)
+        # a sampling starts a new epoch
+        _context.log_epoch()
+        _context.num_samples += 1
+        np.random.seed((_context.seed + _context.num_samples) % 2**32)
+        instances = sample(*args, **kwargs)
+        shard_size = len(instances[0]) // _context.num_workers
+        start = _context.rank * shard_size
+        _context.num_instances = shard_size * _context.num_workers
+        _context.epoch_start = time()
+        return tuple(column[start:start + shard_size] for column in instances)
+    return sample_shard
+
+def run_workers(num_workers, target, *args):
+    """Runs target(*args) in num_workers data-parallel workers and waits for them.
+
+    Rank 0 runs in this process; the other workers are forked from it and log
+    warnings only. An error in any worker aborts the others.
+
+    num_workers -- number of workers
+    target -- function training the model
+    """
+    global _context
+    require_shared_memory()
+    # Python 3.8 only, like shared_memory
+    from multiprocessing import resource_tracker
+    context = mp.get_context("fork")
+    barrier = context.Barrier(num_workers)
+    # the workers must share the tracker of this process, or they unlink its buffers when they exit
+    resource_tracker.ensure_running()
+    token = "neurec_%d_%s" % (os.getpid(), uuid.uuid4().hex[:8])
+    # drawn from the generator seeded by setup(), so the seed also sets the sampling of the workers
+    seed = np.random.randint(2**31 - 1)
+    processes = [context.Process(target=_run_worker, args=(WorkerContext(rank, num_workers, barrier, token, seed), target, args))
+                 for rank in range(1, num_workers)]
+    for process in processes:
+        process.start()
+
+    _context = WorkerContext(0, num_workers, barrier, token, seed)
+    aborted = None
+    try:
+        target(*args)
+        _context.log_epoch()
+    except threading.BrokenBarrierError as error:
+        # another worker failed, reported below
+        aborted = error
+    except BaseException:
+        barrier.abort()
+        raise
+    finally:
+        _context.close()
+        _context = None
+        for process in processes:
+            process.join()
+
+    failed = [rank for rank, process in enumerate(processes, 1) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError("Data-parallel workers " + str(failed) + " failed.")
+    if aborted is not None:
+        raise aborted
+
+def _run_worker(context, target, args):
+    global _context
+    _context = context
+    logging.getLogger().setLevel(logging.WARNING)
+    try:
+        target(*args)
+    except BaseException:
+        context.barrier.abort()
+        raise
+    finally:
+        context.close()
@@ -3,6 +3,8 @@ from neurec.util.singleton import Singleton
 from neurec.util import reader
 from neurec.data.properties import types
 
+_REQUIRED = object()
+
 class Properties(metaclass=Singleton):
     """A class to handle property settings."""
     def __init__(self, properties="", section="DEFAULT"):
@@ -25,11 +27,18 @@ class Properties(metaclass=Singleton):
         """
         self.__properties = reader.file(path)
 
-    def getProperty(self, name):
-        """Returns the value for a property."""
+    def getProperty(self, name, default=_REQUIRED):
+        """Returns the value for a property.
+
+        name -- name of the property
+        default -- value returned when the property is not set (default raises a KeyError)
+        """
         try:
             value = self.__properties[self.__section][name]
         except KeyError:
+            if default is not _REQUIRED:
+                return default
+
             raise KeyError('Key ' + str(name) + ' not found in properties. Add to your properties')
 
         return self.__convertProperty(name, value)
@@ -0,0 +1,46 @@
+"""Scores users in blocks for models that rank all items of a user at once."""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+class UserBlockScorer(object):
+    """Serves predict() from the scores of aligned blocks of users.
+
+    The evaluators ask for one user at a time, mostly in increasing order. Models
+    whose forward pass outputs the scores of every item (autoencoders) waste most
+    of a session run on a single user, so the scorer runs a whole block of
+    users, keeps the last blocks and answers the following users from them.
+    """
+    def __init__(self, score_users, num_users, num_items, max_elements=1 << 24, max_blocks=2):
+        """Setups the scorer.
+
+        score_users -- function returning the scores of all items for an array of users
+        num_users -- number of users
+        num_items -- number of items
+        max_elements -- maximum number of scores in a block (default 2^24)
+        max_blocks -- number of blocks kept at once (default 2)
+        """
+        self.score_users = score_users
+        self.num_users = num_users
+        self.block_size = max(1, max_elements // max(num_items, 1))
+        self.max_blocks = max_blocks
+        self.blocks = OrderedDict()
+        self.lock = threading.Lock()
+
+    def predict(self, user_id, items):
+        block_id = user_id // self.block_size
+        with self.lock:
+            ratings = self.blocks.get(block_id)
+            if ratings is None:
+                start = block_id * self.block_size
+                users = np.arange(start, min(start + self.block_size, self.num_users), dtype=np.int32)
+                ratings = self.score_users(users)
+                self.blocks[block_id] = ratings
+                if len(self.blocks) > self.max_blocks:
+                    self.blocks.popitem(last=False)
+        return ratings[user_id - block_id * self.block_size, items]
+
+    def reset(self):
+        """Drops the cached blocks; call after any step that changes the weights."""
+        with self.lock:
+            self.blocks.clear()
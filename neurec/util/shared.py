@@ -0,0 +1,55 @@
+"""NumPy arrays shared between the processes of a machine.
+
+multiprocessing.shared_memory needs Python 3.8, so it is only imported when a
+shared array is created, by the data-parallel and Hogwild trainers.
+"""
+import sys
+import numpy as np
+
+def require_shared_memory():
+    """Raises a RuntimeError when multiprocessing.shared_memory is not available."""
+    if sys.version_info < (3, 8):
+        raise RuntimeError("rec.train.workers and hogwild_workers need Python 3.8 or newer (multiprocessing.shared_memory), "
+                           "this is Python " + sys.version.split()[0])
+
+class SharedArray(object):
+    """A NumPy array backed by a multiprocessing.shared_memory block."""
+    def __init__(self, shape, dtype, name=None, create=True):
+        """Creates a shared array, or attaches to an existing one.
+
+        shape -- shape of the array
+        dtype -- dtype of the array
+        name -- name of the shared memory block (default None, a generated name)
+        create -- create the block, otherwise attach to the block called name (default True)
+        """
+        require_shared_memory()
+        from multiprocessing import shared_memory
+        dtype = np.dtype(dtype)
+        size = max(int(np.prod(shape)) * dtype.itemsize, 1)
+        # only the creating process unlinks the block
+        self.owner = create
+        self.memory = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def copy_of(cls, array):
+        """Returns a new shared array holding a copy of array."""
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        """Attaches to the shared array described by spec."""
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name, create=False)
+
+    def spec(self):
+        """Returns the (name, shape, dtype) description used to attach from another process."""
+        return self.memory.name, self.array.shape, self.array.dtype.str
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
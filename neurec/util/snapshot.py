@@ -0,0 +1,36 @@
+"""Copies of learned factors that can be scored without a TensorFlow session."""
+import numpy as np
+
+class EmbeddingSnapshot(object):
+    """Scores items with NumPy from a copy of a model's user and item factors.
+
+    A snapshot exposes the attributes used by the evaluators (dataset, num_users,
+    num_items, topK and predict), so it can be evaluated in place of the model
+    while the model keeps training.
+    """
+    def __init__(self, model, user_embeddings, item_embeddings, item_bias=None, clip_negative=False):
+        """Setups the snapshot from NumPy copies of the factors.
+
+        model -- model the factors were taken from
+        user_embeddings -- array of shape (num_users, factors)
+        item_embeddings -- array of shape (num_items, factors)
+        item_bias -- optional array of shape (num_items,)
+        clip_negative -- clip negative scores to zero, for models with a relu output (default False)
+        """
+        self.model_name = model.__class__.__name__
+        self.dataset = model.dataset
+        self.num_users = model.num_users
+        self.num_items = model.num_items
+        self.topK = model.topK
+        self.user_embeddings = user_embeddings
+        self.item_embeddings = item_embeddings
+        self.item_bias = item_bias
+        self.clip_negative = clip_negative
+
+    def predict(self, user_id, items):
+        ratings = np.dot(self.item_embeddings[items], self.user_embeddings[user_id])
+        if self.item_bias is not None:
+            ratings += self.item_bias[items]
+        if self.clip_negative:
+            np.maximum(ratings, 0, out=ratings)
+        return ratings
@@ -1,4 +1,5 @@
 import tensorflow as tf
+import numpy as np
 import time
 def activation_function(act,act_input):
         act_func = None
@@ -18,6 +19,20 @@ def activation_function(act,act_input):
         else:
             raise NotImplementedError("ERROR")
         return act_func  
+def csr_to_sparse_tensor(matrix):
+    """Returns a scipy sparse matrix as a tf.SparseTensorValue to feed a sparse placeholder."""
+    coo = matrix.tocoo()
+    indices = np.stack([coo.row, coo.col], axis=1).astype(np.int64)
+    return tf.SparseTensorValue(indices, coo.data.astype(np.float32), coo.shape)
+def sparse_l2_normalize(sp_input):
+    """Row-wise tf.nn.l2_normalize of a 2-D SparseTensor."""
+    rows = sp_input.indices[:, 0]
+    square_sum = tf.unsorted_segment_sum(tf.square(sp_input.values), rows, sp_input.dense_shape[0])
+    inv_norm = tf.rsqrt(tf.maximum(square_sum, 1e-12))
+    return tf.SparseTensor(sp_input.indices, sp_input.values * tf.gather(inv_norm, rows), sp_input.dense_shape)
+def sparse_dropout(sp_input, keep_prob):
+    """tf.nn.dropout of the non-zero values of a SparseTensor."""
+    return tf.SparseTensor(sp_input.indices, tf.nn.dropout(sp_input.values, keep_prob), sp_input.dense_shape)
 def getlocaltime():
     date = time.strftime('%y-%m-%d', time.localtime())
     current_time = time.strftime('%H:%M:%S', time.localtime())      
\ No newline at end of file